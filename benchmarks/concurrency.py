@@ -0,0 +1,113 @@
+"""Concurrent throughput of a running chatbot app.
+
+Sends the same authenticated request from N concurrent clients and reports the
+throughput and latency percentiles, plus the time to the first byte for the
+streaming `/chat/stream` endpoint. Run it against the dummy app before and
+after a change to compare, e.g.:
+
+    uvicorn rag.dummy_app_b2c:app --workers 1 --port 8000
+    BENCH_TOKEN=<jwt> python benchmarks/concurrency.py \
+        --conversation <uuid> --concurrency 1 8 32 --requests 200
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import httpx
+
+
+async def _worker(
+    client, queue, latencies, first_bytes, errors, method, path, body, headers
+):
+    while True:
+        try:
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        start = time.perf_counter()
+        async with client.stream(method, path, json=body, headers=headers) as response:
+            first_byte = None
+            async for _ in response.aiter_raw():
+                if first_byte is None:
+                    first_byte = time.perf_counter() - start
+        latencies.append(time.perf_counter() - start)
+        first_bytes.append(first_byte if first_byte is not None else latencies[-1])
+        if response.status_code >= 400:
+            errors.append(response.status_code)
+
+
+async def run(args, concurrency: int) -> dict:
+    headers = {"Authorization": f"Bearer {os.environ['BENCH_TOKEN']}"}
+    if args.managed_client:
+        headers["managed-client-uuid"] = args.managed_client
+    body = None
+    if args.method == "POST" and args.path in ("/chat", "/chat/stream"):
+        body = {"question": args.question, "conversation_uuid": args.conversation}
+
+    queue = asyncio.Queue()
+    for _ in range(args.requests):
+        queue.put_nowait(None)
+
+    latencies, first_bytes, errors = [], [], []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=args.url, limits=limits, timeout=args.timeout
+    ) as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                _worker(
+                    client,
+                    queue,
+                    latencies,
+                    first_bytes,
+                    errors,
+                    args.method,
+                    args.path,
+                    body,
+                    headers,
+                )
+                for _ in range(concurrency)
+            )
+        )
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+        "ttfb_p50_ms": statistics.median(first_bytes) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--method", default="POST")
+    parser.add_argument("--path", default="/chat")
+    parser.add_argument("--conversation", help="conversation uuid for /chat")
+    parser.add_argument("--managed-client", help="managed-client-uuid (B2B apps)")
+    parser.add_argument("--question", default="Suis-je couvert en cas de vol ?")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    for concurrency in args.concurrency:
+        result = asyncio.run(run(args, concurrency))
+        print(
+            "concurrency={concurrency:>3} requests={requests} errors={errors} "
+            "throughput={throughput_rps:.1f} req/s p50={p50_ms:.1f} ms "
+            "p99={p99_ms:.1f} ms ttfb_p50={ttfb_p50_ms:.1f} ms".format(**result)
+        )
+
+
+if __name__ == "__main__":
+    main()
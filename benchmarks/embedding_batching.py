@@ -0,0 +1,114 @@
+"""Latency and throughput of the question embeddings, with and without batching.
+
+Embeds distinct questions from N concurrent coroutines, either one model call
+per question in the blocking executor or through the `EmbeddingBatcher`, and
+reports the throughput and latency percentiles of both, e.g.:
+
+    python benchmarks/embedding_batching.py --concurrency 1 8 32 --requests 256
+
+`--simulate-ms` replaces the model with a sleep of a fixed cost per call plus
+a cost per text, to try the batching parameters without loading the model.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from rag.chatbot.embeddings import EmbeddingBatcher
+from rag.constants import MODEL_NAME
+from rag.executor import run_blocking, shutdown_executor
+
+
+def simulated_embedding_function(call_ms: float, text_ms: float, dimension: int = 768):
+    def embed(input):
+        time.sleep((call_ms + text_ms * len(input)) / 1000)
+        return [[0.0] * dimension for _ in input]
+
+    return embed
+
+
+async def _worker(embed, queue, latencies):
+    while True:
+        try:
+            question = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        start = time.perf_counter()
+        await embed(question)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(embed, concurrency: int, requests: int, offset: int) -> dict:
+    queue = asyncio.Queue()
+    for i in range(requests):
+        # Distinct questions, the model is called for every one of them
+        queue.put_nowait(f"Suis-je couvert en cas de vol ? ({offset + i})")
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(_worker(embed, queue, latencies) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "throughput_qps": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+    }
+
+
+async def main(args):
+    if args.simulate_ms is not None:
+        embedding_function = simulated_embedding_function(*args.simulate_ms)
+    else:
+        from chromadb.utils.embedding_functions import (
+            SentenceTransformerEmbeddingFunction,
+        )
+
+        embedding_function = SentenceTransformerEmbeddingFunction(
+            model_name=args.model
+        )
+        # Load the model before measuring
+        embedding_function(["warmup"])
+
+    async def unbatched(question):
+        return (await run_blocking(embedding_function, [question]))[0]
+
+    batcher = EmbeddingBatcher(
+        embedding_function,
+        max_wait_ms=args.max_wait_ms,
+        max_batch_size=args.max_batch_size,
+    )
+
+    offset = 0
+    for concurrency in args.concurrency:
+        for name, embed in (("unbatched", unbatched), ("batched", batcher.embed)):
+            result = await run(embed, concurrency, args.requests, offset)
+            offset += args.requests
+            print(
+                f"{name:>9} "
+                "concurrency={concurrency:>3} throughput={throughput_qps:.1f} q/s "
+                "p50={p50_ms:.1f} ms p99={p99_ms:.1f} ms".format(**result)
+            )
+
+    await batcher.stop()
+    shutdown_executor()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument(
+        "--simulate-ms",
+        type=float,
+        nargs=2,
+        metavar=("CALL_MS", "TEXT_MS"),
+        help="simulate the model instead of loading it",
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,140 @@
+"""Resident memory of the workers, with the embedding model loaded by each
+worker or by the embedding sidecar.
+
+Spawns N worker processes, like `uvicorn --workers N`, which embed a few
+questions either with their own copy of the model or through the sidecar, and
+reports the RSS of every process and in total, e.g.:
+
+    PYTHONPATH=. python benchmarks/embedding_memory.py --workers 4
+
+`--simulate-mb` replaces the model with random weights of that size, to run it
+without downloading the model.
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import zlib
+
+import numpy as np
+
+from rag.chatbot.embedding_sidecar import EmbeddingSidecar, SidecarEmbeddingFunction
+
+QUESTIONS = [
+    "Suis-je couvert en cas de vol ?",
+    "Quelle est ma franchise pour un dégât des eaux ?",
+    "Mon vélo est-il assuré hors de chez moi ?",
+]
+
+
+class SimulatedModel:
+    """Random weights of `size_mb` MB, all read by every embedding like the
+    weights of a real model."""
+
+    def __init__(self, size_mb: int, dimension: int = 768):
+        rows = size_mb * 2**20 // (4 * dimension)
+        self.weights = np.random.default_rng(0).standard_normal(
+            (rows, dimension), dtype=np.float32
+        )
+
+    def __call__(self, input):
+        features = np.zeros((len(input), len(self.weights)), dtype=np.float32)
+        for i, text in enumerate(input):
+            for word in text.split():
+                features[i, zlib.crc32(word.encode()) % len(self.weights)] += 1
+        return features @ self.weights
+
+
+def load_embedding_function(simulate_mb):
+    if simulate_mb:
+        return SimulatedModel(simulate_mb)
+    from rag.utils import load_sentence_transformer_ef
+
+    return load_sentence_transformer_ef()
+
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def worker(socket_path, simulate_mb, ready, stop):
+    if socket_path:
+        embedding_function = SidecarEmbeddingFunction(socket_path)
+    else:
+        embedding_function = load_embedding_function(simulate_mb)
+    embedding_function(QUESTIONS)
+    ready.put(os.getpid())
+    stop.wait()
+
+
+def sidecar(socket_path, simulate_mb, ready):
+    embedding_function = load_embedding_function(simulate_mb)
+    embedding_function(["warmup"])
+    with EmbeddingSidecar(socket_path, embedding_function) as server:
+        ready.put(os.getpid())
+        server.serve_forever()
+
+
+def measure(context, workers: int, simulate_mb, socket_path=None) -> None:
+    ready, stop = context.Queue(), context.Event()
+    processes = []
+    sidecar_pid = None
+    if socket_path:
+        process = context.Process(
+            target=sidecar, args=(socket_path, simulate_mb, ready), daemon=True
+        )
+        process.start()
+        processes.append(process)
+        sidecar_pid = ready.get()
+
+    for _ in range(workers):
+        process = context.Process(
+            target=worker, args=(socket_path, simulate_mb, ready, stop)
+        )
+        process.start()
+        processes.append(process)
+    # Measure once every worker has embedded, while they are all alive
+    worker_rss = [rss_mb(ready.get()) for _ in range(workers)]
+    sidecar_rss = rss_mb(sidecar_pid) if sidecar_pid else 0.0
+
+    name = "sidecar" if socket_path else "per-worker"
+    print(
+        f"{name:>10}: workers={' '.join(f'{rss:.0f}' for rss in worker_rss)} MB "
+        f"sidecar={sidecar_rss:.0f} MB "
+        f"total={sum(worker_rss) + sidecar_rss:.0f} MB"
+    )
+
+    stop.set()
+    for process in processes:
+        if process.pid == sidecar_pid:
+            process.terminate()
+        process.join()
+
+
+def main(args):
+    # The uvicorn workers are spawned, not forked
+    context = multiprocessing.get_context("spawn")
+    measure(context, args.workers, args.simulate_mb)
+    with tempfile.TemporaryDirectory() as directory:
+        measure(
+            context,
+            args.workers,
+            args.simulate_mb,
+            socket_path=os.path.join(directory, "embeddings.sock"),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--simulate-mb",
+        type=int,
+        help="simulate a model of this size instead of loading it",
+    )
+    main(parser.parse_args())
@@ -0,0 +1,182 @@
+"""Latency of the hot `QueryConversations` queries on a seeded database.
+
+Seeds synthetic users, conversations and messages (1M messages by default)
+with `generate_series`, then runs each hot query on random users and
+conversations and reports its p50/p99 latency. Use a dedicated database, the
+seeded rows are not removed:
+
+    POSTGRES_DB=chatbot_bench alembic upgrade head
+    POSTGRES_DB=chatbot_bench PYTHONPATH=. python benchmarks/query_latency.py
+
+To measure the queries without the indexes of the migration 0002, run
+`alembic downgrade 0001`, benchmark with `--no-seed`, then `alembic upgrade head`.
+The listings read the conversation counters of the migration 0003, and
+`get_usage` the daily rollups of the migration 0004.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import random
+import statistics
+import time
+import uuid
+from datetime import date, timedelta
+
+from sqlalchemy import text
+
+from rag.config import Postgres
+from rag.database import Database
+from rag.query import QueryConversations
+
+SEED_CONVERSATIONS = """
+INSERT INTO conversations (uuid, name, user_uuid, created_by)
+SELECT md5('conversation' || i)::uuid, 'bench_' || i,
+       md5('user' || i % :users)::uuid, md5('user' || i % :users)::uuid
+FROM generate_series(1, :conversations) AS i
+"""
+
+SEED_MESSAGES = """
+INSERT INTO conversation_messages (conversation_uuid, message, tokens, cost, send_at)
+SELECT md5('conversation' || 1 + i % :conversations)::uuid,
+       '{"type": "human", "data": {"content": "Suis-je couvert ?"}}'::jsonb,
+       20, 0.0001, now() - i * interval '1 second'
+FROM generate_series(1, :messages) AS i
+"""
+
+# The messages are not added through `PostgresChatMessageHistory`
+SEED_COUNTERS = """
+UPDATE conversations
+SET message_count = stats.message_count,
+    total_tokens = stats.total_tokens,
+    last_message_at = stats.last_message_at
+FROM (
+    SELECT conversation_uuid, count(*) AS message_count,
+           sum(tokens) AS total_tokens, max(send_at) AS last_message_at
+    FROM conversation_messages
+    GROUP BY conversation_uuid
+) AS stats
+WHERE conversations.uuid = stats.conversation_uuid
+"""
+
+SEED_USAGE = """
+INSERT INTO conversation_usage_daily
+    (conversation_uuid, day, user_uuid, message_count, tokens, cost)
+SELECT messages.conversation_uuid, messages.send_at::date, conversations.user_uuid,
+       count(*), sum(messages.tokens), sum(messages.cost)
+FROM conversation_messages AS messages
+JOIN conversations ON conversations.uuid = messages.conversation_uuid
+GROUP BY 1, 2, 3
+"""
+
+SEED_USER_INSURANCES = """
+INSERT INTO user_insurances (user_sub, package_id, deductible, sum_insured)
+SELECT md5('user' || i % :users)::uuid::text, NULL, 200, '10000'
+FROM generate_series(1, :users * 2) AS i
+"""
+
+
+def md5_uuid(value: str) -> str:
+    # Same as md5(value)::uuid in the seeding queries
+    return str(uuid.UUID(hashlib.md5(value.encode()).hexdigest()))
+
+
+async def seed(database: Database, args) -> None:
+    params = {
+        "users": args.users,
+        "conversations": args.conversations,
+        "messages": args.messages,
+    }
+    async with database.engine.begin() as connection:
+        seeded = await connection.scalar(
+            text("SELECT count(*) FROM conversations WHERE name LIKE 'bench_%'")
+        )
+        if seeded:
+            print(f"already seeded with {seeded} conversations")
+            return
+
+        start = time.perf_counter()
+        for query in (
+            SEED_CONVERSATIONS,
+            SEED_MESSAGES,
+            SEED_COUNTERS,
+            SEED_USAGE,
+            SEED_USER_INSURANCES,
+        ):
+            await connection.execute(text(query), params)
+        print(f"seeded in {time.perf_counter() - start:.1f} s")
+
+    async with database.engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await connection.execute(text("ANALYZE"))
+
+
+async def measure(database: Database, name: str, query, repeat: int) -> None:
+    latencies = []
+    for _ in range(repeat):
+        async with database.Session() as session:
+            start = time.perf_counter()
+            await query(QueryConversations(session))
+            latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    print(
+        f"{name:>35}: p50={statistics.median(latencies) * 1000:7.2f} ms "
+        f"p99={latencies[int(0.99 * (len(latencies) - 1))] * 1000:7.2f} ms"
+    )
+
+
+async def main(args):
+    database = Database(connection_string=Postgres().postgre_url)
+    if args.seed:
+        await seed(database, args)
+
+    def random_conversation():
+        # Conversation i belongs to the user i % users
+        conversation = random.randint(1, args.conversations)
+        return (
+            conversation,
+            md5_uuid(f"conversation{conversation}"),
+            md5_uuid(f"user{conversation % args.users}"),
+        )
+
+    queries = {
+        "user_owns_conversation": lambda q, i, conv, user: q.user_owns_conversation(
+            user_uuid=user, conversation_uuid=conv
+        ),
+        "get_conversation_messages_by_uuid": lambda q, i, conv, user: (
+            q.get_conversation_messages_by_uuid(conv)
+        ),
+        "get_list_conversations_by_user": lambda q, i, conv, user: (
+            q.get_list_conversations_by_user(user)
+        ),
+        "get_conversations_page": lambda q, i, conv, user: (
+            q.get_conversations_page(user, limit=5)
+        ),
+        "get_usage": lambda q, i, conv, user: q.get_usage(
+            user, date.today() - timedelta(days=29), date.today()
+        ),
+        "conversation_name_exists": lambda q, i, conv, user: (
+            q.conversation_name_exists(user, f"bench_{i}")
+        ),
+        "get_user_packages": lambda q, i, conv, user: q.get_user_packages(user),
+    }
+    for name, query in queries.items():
+        await measure(
+            database,
+            name,
+            lambda q, query=query: query(q, *random_conversation()),
+            args.repeat,
+        )
+
+    await database.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--conversations", type=int, default=50000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--no-seed", dest="seed", action="store_false")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,75 @@
+"""Microbenchmark of the bearer token verification of `rag.auth`.
+
+Signs a token with a throw-away RSA key and times `verify_token` on:
+
+- the cold path: the public key is parsed from the JWK and the signature is
+  verified, as for the first request after a JWKS refresh;
+- the warm-key path: the public key is cached, the signature is verified, as
+  for the first request with a new token;
+- the warm-token path: the token was already verified and is still valid.
+
+    PYTHONPATH=. python benchmarks/token_verification.py --number 2000
+"""
+
+import argparse
+import json
+import os
+import time
+import timeit
+
+# `rag.auth` creates its DynamoDB table at import, no request is sent
+os.environ.setdefault("AWS_REGION", "eu-west-1")
+os.environ.setdefault("DYNAMO_DB_TABLE", "benchmark")
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from rag import auth
+
+
+def make_token_and_keys():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": "benchmark", "alg": "RS256", "use": "sig"})
+    token = jwt.encode(
+        {
+            "sub": "benchmark",
+            "aud": auth.CLIENT_ID,
+            "iss": auth.COGNITO_ISSUER,
+            "exp": int(time.time()) + 3600,
+        },
+        private_key,
+        algorithm="RS256",
+        headers={"kid": "benchmark"},
+    )
+    return token, {"benchmark": jwk}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    token, keys = make_token_and_keys()
+
+    def cold():
+        auth.public_key_cache.clear()
+        auth.verified_token_cache.clear()
+        auth.verify_token(token, keys)
+
+    def warm_key():
+        auth.verified_token_cache.clear()
+        auth.verify_token(token, keys)
+
+    def warm_token():
+        auth.verify_token(token, keys)
+
+    paths = (("cold", cold), ("warm-key", warm_key), ("warm-token", warm_token))
+    for name, func in paths:
+        func()
+        elapsed = timeit.timeit(func, number=args.number)
+        print(f"{name:>10}: {elapsed / args.number * 1e6:8.1f} us/token")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,86 @@
 # import os
 # import uvicorn
+# from contextlib import asynccontextmanager
 # import uuid
-# from datetime import datetime
+# from typing import AsyncIterator, Optional
+# from datetime import date, datetime
 # from langchain_community.callbacks import get_openai_callback
 # from langchain_core.messages import message_to_dict
 
-# from fastapi.responses import JSONResponse
-# from fastapi import FastAPI, HTTPException, status, Depends, Body, Header
+# from fastapi.responses import JSONResponse, StreamingResponse
+# from fastapi import (
+#     BackgroundTasks,
+#     FastAPI,
+#     HTTPException,
+#     Query,
+#     status,
+#     Depends,
+#     Body,
+#     Header,
+# )
 # from fastapi.middleware.cors import CORSMiddleware
 
 
 # from rag.utils import (
-#     format_package_data, 
-#     # sentence_transformer_ef
-#     )
-# from rag.auth import decode_token, user_can_manage_client
-# from rag.query import QueryConversations
+#     decode_conversations_cursor,
+#     usage_range,
+#     encode_conversations_cursor,
+#     format_sse,
+#     load_sentence_transformer_ef,
+# )
+# from rag.auth import decode_token, auser_can_manage_client, jwks_manager
+# from rag.database import Database
+# from rag.ownership import ConversationOwnershipCache
+# from rag.query import (
+#     ConversationAccessError,
+#     ConversationNameExistsError,
+#     ConversationNotFoundError,
+#     QueryConversations,
+# )
+# from rag.packages import UserPackageCache
+# from rag.pool import (
+#     open_connection_pools,
+#     close_connection_pools,
+#     get_pool_stats,
+# )
+# from rag.executor import run_blocking, shutdown_executor
+# from rag.resources import Resources
 # from rag.config import (
+#     AnswerCache,
+#     ChatHistory,
 #     ChatQuestion,
+#     OwnershipCache,
 #     Postgres,
 #     ConversationUpdateRequest,
-#     VectorDatabaseFilter,
+#     EmbeddingBatching,
+#     EmbeddingCache,
+#     EmbeddingSidecar,
+#     PackageCache,
+#     PromptBudget,
+#     PromptCache,
+#     Startup,
+#     SummaryMemory,
 # )
 # from rag.chatbot.memory import PostgresChatMessageHistory
-# from rag.chatbot.llm import LangChainChatbot
+# from rag.chatbot.llm import LangChainChatbot, split_cost, stream_usage
+# from rag.chatbot.embeddings import CachedEmbeddingFunction, EmbeddingBatcher
+# from rag.chatbot.answer_cache import SemanticAnswerCache
+# from rag.chatbot.embedding_sidecar import SidecarEmbeddingFunction
+# from rag.chatbot.prompt_assembly import PromptAssembler
+# from rag.chatbot.prompt_cache import PromptResponseCache
 # from rag.chatbot.retriever import VectorZurichChromaDbClient
-# from rag.constants import DB_PATH, COLLECTION_NAME
+# from rag.chatbot.summary_memory import ConversationSummaryBufferMemory
+# from rag.constants import (
+#     COLLECTION_NAME,
+#     DB_PATH,
+#     CONVERSATIONS_PAGE_MAX_SIZE,
+#     CONVERSATIONS_PAGE_SIZE,
+#     MESSAGES_PAGE_MAX_SIZE,
+#     MESSAGES_PAGE_SIZE,
+#     MODEL_NAME,
+#     SSE_HEADERS,
+#     TABLE_CONVERSATION_USAGE,
+# )
 # from dotenv import load_dotenv
 
 # load_dotenv()
@@ -38,25 +93,157 @@
 # # Access the postgre_url property from the instance
 # conn_string = postgres_instance.postgre_url
 
-# # Get the query client
-# query_db = QueryConversations(connection_string=conn_string)
+# # The database engine, each request gets its own session from its pool
+# database = Database(connection_string=conn_string)
+
+# # Package context of the users, it rarely changes
+# package_cache_config = PackageCache()
+# user_package_cache = UserPackageCache(
+#     max_size=package_cache_config.CACHE_SIZE, ttl=package_cache_config.CACHE_TTL
+# )
+
+# # When the turns of /chat are stored
+# chat_history_config = ChatHistory()
+
+# # Owners of the conversations, checked on each chat question
+# ownership_cache_config = OwnershipCache()
+# ownership_cache = ConversationOwnershipCache(
+#     max_size=ownership_cache_config.CACHE_SIZE, ttl=ownership_cache_config.CACHE_TTL
+# )
+
+# # Answers of the questions asked at the start of a conversation, shared by
+# # the users with the same packages
+# answer_cache_config = AnswerCache()
+# answer_cache = SemanticAnswerCache(
+#     threshold=answer_cache_config.THRESHOLD,
+#     ttl=answer_cache_config.CACHE_TTL,
+#     max_size=answer_cache_config.CACHE_SIZE,
+#     max_history=answer_cache_config.MAX_HISTORY,
+#     disk_path=answer_cache_config.CACHE_PATH,
+# )
+# # Responses of the model at temperature 0 to the exact same prompt
+# prompt_cache = PromptResponseCache.from_config(PromptCache())
+# # Rolling summary of the conversations and their latest messages
+# summary_memory_config = SummaryMemory()
+
+# embedding_cache_config = EmbeddingCache()
+# embedding_batching_config = EmbeddingBatching()
+# embedding_sidecar_config = EmbeddingSidecar()
+
 
+# def load_question_embeddings() -> CachedEmbeddingFunction:
+#     """Cache of the question embeddings, in memory and optionally on disk,
+#     around the embedding model, or the embedding sidecar shared by the workers
+#     when `EMBEDDING_SOCKET_PATH` is set."""
+#     if embedding_sidecar_config.SOCKET_PATH:
+#         embedding_function = SidecarEmbeddingFunction(
+#             embedding_sidecar_config.SOCKET_PATH,
+#             timeout=embedding_sidecar_config.TIMEOUT,
+#         )
+#     else:
+#         embedding_function = load_sentence_transformer_ef()
+#     return CachedEmbeddingFunction(
+#         embedding_function,
+#         model_name=MODEL_NAME,
+#         max_size=embedding_cache_config.CACHE_SIZE,
+#         disk_path=embedding_cache_config.CACHE_PATH,
+#     )
 
-# chroma_collection: VectorZurichChromaDbClient = (
-#     VectorZurichChromaDbClient.get_retriever(
+
+# async def open_vector_store() -> VectorZurichChromaDbClient:
+#     question_embeddings = await resources.get("embeddings")
+#     # Embed the questions of concurrent requests in one batch
+#     question_embedding_batcher = EmbeddingBatcher(
+#         question_embeddings,
+#         max_wait_ms=embedding_batching_config.MAX_WAIT_MS,
+#         max_batch_size=embedding_batching_config.MAX_BATCH_SIZE,
+#     )
+#     return await run_blocking(
+#         VectorZurichChromaDbClient.get_retriever,
 #         collection_name=COLLECTION_NAME,
 #         db_path=DB_PATH,
-#         embeddings=sentence_transformer_ef,
+#         embeddings=question_embeddings,
+#         embedding_batcher=question_embedding_batcher,
 #     )
-# )
 
+
+# # Created in the lifespan, in parallel, rather than at import
+# resources = Resources()
+# resources.add("database", database.init_db, close=Database.close)
+# # The shared chat history pool, opened once per worker
+# resources.add(
+#     "chat_history_pool",
+#     lambda: open_connection_pools(conn_string),
+#     close=lambda _: close_connection_pools(),
+# )
+# resources.add("embeddings", load_question_embeddings, blocking=True)
+# resources.add(
+#     "vector_store",
+#     open_vector_store,
+#     close=lambda vector_store: vector_store.embedding_batcher.stop(),
+# )
 # # The langchain chain
-# chain = LangChainChatbot.rag_from_config(
-#     config_path="./openai_config.yml", api_type="openai"
+# resources.add(
+#     "llm",
+#     lambda: LangChainChatbot.rag_from_config(
+#         config_path="./openai_config.yml", api_type="openai"
+#     ),
+#     blocking=True,
 # )
 
+
+# async def load_prompt_assembler() -> PromptAssembler:
+#     chain = await resources.get("llm")
+#     # Count the tokens with the tokenizer of the model
+#     return await run_blocking(
+#         PromptAssembler.from_config, PromptBudget(), chain.last.model_name
+#     )
+
+
+# resources.add("prompt_assembler", load_prompt_assembler)
+
+
+# async def get_query_db() -> AsyncIterator[QueryConversations]:
+#     """The session of a request, once the database is migrated."""
+#     await resources.get("database")
+#     async for query_db in database.get_query_db():
+#         yield query_db
+
+
+# async def store_turn(
+#     chat_memory: PostgresChatMessageHistory,
+#     background_tasks: BackgroundTasks,
+#     **turn,
+# ) -> None:
+#     """Persist a turn in one INSERT.
+
+#     By default once the response has been sent: a failure is only logged, and a
+#     question sent right after the response may not read the turn in its history
+#     yet. With CHAT_HISTORY_PERSIST_INLINE the turn is stored before the
+#     response, which fails when the turn cannot be stored.
+#     """
+#     if chat_history_config.PERSIST_INLINE:
+#         await chat_memory.aadd_turn(**turn)
+#     else:
+#         background_tasks.add_task(chat_memory.asave_turn, **turn)
+
+
+# @asynccontextmanager
+# async def lifespan(app: FastAPI):
+#     startup_config = Startup()
+#     await resources.start(
+#         lazy=startup_config.LAZY_RESOURCES, background=startup_config.IN_BACKGROUND
+#     )
+#     yield
+#     await resources.close()
+#     answer_cache.close()
+#     prompt_cache.close()
+#     await jwks_manager.aclose()
+#     shutdown_executor()
+
+
 # # FastApi app
-# app = FastAPI()
+# app = FastAPI(lifespan=lifespan)
 
 # # Add CORS middleware to the application
 # app.add_middleware(
@@ -70,21 +257,29 @@
 
 # @app.post("/chat")
 # async def chat(
+#     background_tasks: BackgroundTasks,
 #     question: ChatQuestion = Body(...),
 #     playload=Depends(decode_token),
 #     managed_client_uuid: uuid.UUID = Header(...),
+#     query_db: QueryConversations = Depends(get_query_db),
 # ):
 
 #     # Check if the client is the owner of the conversation.
-#     if not query_db.user_owns_conversation(
-#         user_uuid=managed_client_uuid, conversation_uuid=question.conversation_uuid
-#     ):
+#     try:
+#         await ownership_cache.check(
+#             query_db,
+#             user_uuid=managed_client_uuid,
+#             conversation_uuid=question.conversation_uuid,
+#         )
+#     except (ConversationNotFoundError, ConversationAccessError):
+#         # A missing conversation answers like the conversations of the other
+#         # users, so that its existence is not revealed
 #         raise HTTPException(
 #             status_code=status.HTTP_403_FORBIDDEN,
 #             detail="Client does not have the rights to access this conversation",
 #         )
 
-#     if not user_can_manage_client(
+#     if not await auser_can_manage_client(
 #         managed_client_uuid=managed_client_uuid,
 #         user_sub=playload["sub"],
 #         user_email=playload["email"],
@@ -94,10 +289,9 @@
 #             detail="User does not manage this client",
 #         )
 
-#     # user package_info
-#     user_package = query_db.get_user_packages(user_uuid=str(managed_client_uuid))
-#     list_user_packages, deductible_info, sum_insured_info = format_package_data(
-#         data=user_package
+#     # user package_info, cached per user and language
+#     user_package = await user_package_cache.get(
+#         query_db, user_uuid=str(managed_client_uuid)
 #     )
 
 #     # chat memory
@@ -105,72 +299,394 @@
 #         conversation_uuid=question.conversation_uuid,
 #         connection_string=conn_string,
 #         table_name=os.getenv("TABLE_NAME_CONVERSATION_MESSAGES"),
+#         conversations_table=os.getenv("TABLE_NAME_CONVERSATION"),
+#         usage_table=TABLE_CONVERSATION_USAGE,
 #     )
+#     # Summary of the older messages and the messages after it, bounded
+#     # however long the conversation
+#     prompt_assembler = await resources.get("prompt_assembler")
+#     summary_memory = await ConversationSummaryBufferMemory.from_config(
+#         chat_memory, prompt_assembler.count, summary_memory_config
+#     ).aload()
+#     chat_history = summary_memory.messages
+
 #     # chat history for prompt
-#     chat_history_prompt = chat_memory.messages[-2 * 2 :]
+#     chat_history_prompt = chat_history
 
 #     # chat history for json response
-#     chat_history_dict = [message_to_dict(message) for message in chat_memory.messages]
+#     chat_history_dict = [message_to_dict(message) for message in chat_history]
+
+#     chroma_collection = await resources.get("vector_store")
+#     chain = await resources.get("llm")
 
-#     # Retriver filter
-#     user_filter = VectorDatabaseFilter(mapping_package=list_user_packages).filters()
+#     # Answer of a similar question of a user with the same packages
+#     answer_cache_key = user_package.answer_cache_key
+#     question_embedding = None
+#     cached = None
+#     if summary_memory.summary is None and answer_cache.accepts(chat_history):
+#         question_embedding = await chroma_collection.aembed_question(question.question)
+#         # Scores every answer of the partition, and may delete expired answers
+#         # from the sqlite file
+#         cached = await run_blocking(
+#             answer_cache.lookup, answer_cache_key, question_embedding
+#         )
+#     if cached is not None:
+#         # No model call, the turn costs nothing
+#         await store_turn(
+#             chat_memory,
+#             background_tasks,
+#             human_message=question.question,
+#             ai_message=cached.answer,
+#             human_tokens=0,
+#             ai_tokens=0,
+#             human_cost=0.0,
+#             ai_cost=0.0,
+#         )
+#         return JSONResponse(
+#             content={
+#                 "question": question.question,
+#                 "response": cached.answer,
+#                 "chat_history": chat_history_dict,
+#                 "summary": summary_memory.summary,
+#                 "total_tokens": 0,
+#                 "total_cost": 0.0,
+#                 "cached": True,
+#             },
+#             status_code=200,
+#         )
 
-#     # User package
-#     user_package_data_info, list_ids_retriver = (
-#         chroma_collection.get_zurich_package_info(
-#             filter_packages=user_filter, user_question=question.question, top_k=3
+#     # User package documents, most relevant first
+#     package_documents, list_ids_retriver = (
+#         await chroma_collection.aget_zurich_package_documents(
+#             filter_packages=user_package.filter,
+#             user_question=question.question,
+#             top_k=3,
 #         )
 #     )
 
 #     # General Condition
-#     general_condition = chroma_collection.get_zurich_general_condition()
+#     general_condition = await run_blocking(
+#         chroma_collection.get_zurich_general_condition
+#     )
 
-#     # Context for the LLM
-#     context = (
-#         f"{user_package_data_info}\nThe insurance general condition:{general_condition}"
+#     # Fit the documents, the history and the general condition in the token
+#     # budget of the prompt
+#     assembled_prompt = await run_blocking(
+#         prompt_assembler.assemble,
+#         question=question.question,
+#         deductible=user_package.deductible,
+#         sum_insured=user_package.sum_insured,
+#         package_documents=package_documents,
+#         general_condition=general_condition,
+#         chat_history=chat_history_prompt,
+#         summary=summary_memory.summary or "",
 #     )
 
-#     # Request LLM
-#     with get_openai_callback() as cb:
-#         res = chain.invoke(
+#     prompt_messages = (
+#         await chain.first.ainvoke(
 #             {
 #                 "question": question.question,
-#                 "chat_history": chat_history_prompt,
-#                 "deductible": deductible_info,
-#                 "sum_insured": sum_insured_info,
-#                 "context": context,
+#                 "chat_history": assembled_prompt.chat_history,
+#                 "summary": summary_memory.summary or "",
+#                 "deductible": user_package.deductible,
+#                 "sum_insured": user_package.sum_insured,
+#                 "context": assembled_prompt.context,
 #             }
 #         )
+#     ).to_messages()
 
-#     # Add human message to the DB
-#     chat_memory.add_user_message(
-#         message=question.question, tokens=cb.prompt_tokens, cost=cb.total_cost
-#     )
+#     # Request LLM, unless it already answered the same prompt. A cached
+#     # response leaves the callback, hence the tokens and cost, at zero
+#     with get_openai_callback() as cb:
+#         response = await prompt_cache.aget(prompt_messages, chain.last)
+#         prompt_cached = response is not None
+#         if not prompt_cached:
+#             response = (await chain.last.ainvoke(prompt_messages)).content
+#             background_tasks.add_task(
+#                 prompt_cache.aset, prompt_messages, chain.last, response
+#             )
 
-#     # Add AI message to the DB
-#     chat_memory.add_ai_message(
-#         message=res.content, tokens=cb.completion_tokens, cost=cb.total_cost
+#     # The prompt cost goes with the question and the completion cost with the
+#     # answer, the usage adds them up
+#     human_cost, ai_cost = split_cost(
+#         chain.last, cb.total_cost, cb.prompt_tokens, cb.completion_tokens
+#     )
+#     await store_turn(
+#         chat_memory,
+#         background_tasks,
+#         human_message=question.question,
+#         ai_message=response,
+#         human_tokens=cb.prompt_tokens,
+#         ai_tokens=cb.completion_tokens,
+#         human_cost=human_cost,
+#         ai_cost=ai_cost,
+#     )
+#     # Fold the older messages into the summary once they are too long
+#     background_tasks.add_task(
+#         summary_memory.aupdate_summary, chain.last, question.question, response
 #     )
+#     if question_embedding is not None:
+#         background_tasks.add_task(
+#             answer_cache.add,
+#             answer_cache_key,
+#             question_embedding,
+#             question.question,
+#             response,
+#         )
 
 #     response_data = {
 #         "question": question.question,
-#         "response": res.content,
+#         "response": response,
 #         "chat_history": chat_history_dict,
+#         "summary": summary_memory.summary,
 #         "total_tokens": cb.total_tokens,
 #         "total_cost": cb.total_cost,
+#         "cached": prompt_cached,
+#         "prompt_tokens_breakdown": assembled_prompt.breakdown(),
 #     }
 
 #     return JSONResponse(content=response_data, status_code=200)
 
 
+# @app.post("/chat/stream")
+# async def chat_stream(
+#     background_tasks: BackgroundTasks,
+#     question: ChatQuestion = Body(...),
+#     playload=Depends(decode_token),
+#     managed_client_uuid: uuid.UUID = Header(...),
+#     query_db: QueryConversations = Depends(get_query_db),
+# ):
+#     """
+#     Streams the answer to a chat question as Server-Sent Events.
+
+#     Same checks, history and context as `/chat`. Each chunk of the answer is
+#     sent in a `token` event. When the answer is complete the turn is persisted
+#     and an `end` event carries the same content as the `/chat` response plus
+#     the prompt and completion tokens. An `error` event is sent if the answer
+#     cannot be generated or persisted.
+#     """
+
+#     # Check if the client is the owner of the conversation.
+#     try:
+#         await ownership_cache.check(
+#             query_db,
+#             user_uuid=managed_client_uuid,
+#             conversation_uuid=question.conversation_uuid,
+#         )
+#     except (ConversationNotFoundError, ConversationAccessError):
+#         # A missing conversation answers like the conversations of the other
+#         # users, so that its existence is not revealed
+#         raise HTTPException(
+#             status_code=status.HTTP_403_FORBIDDEN,
+#             detail="Client does not have the rights to access this conversation",
+#         )
+
+#     if not await auser_can_manage_client(
+#         managed_client_uuid=managed_client_uuid,
+#         user_sub=playload["sub"],
+#         user_email=playload["email"],
+#     ):
+#         raise HTTPException(
+#             status_code=status.HTTP_403_FORBIDDEN,
+#             detail="User does not manage this client",
+#         )
+
+#     # user package_info, cached per user and language
+#     user_package = await user_package_cache.get(
+#         query_db, user_uuid=str(managed_client_uuid)
+#     )
+
+#     # chat memory
+#     chat_memory = PostgresChatMessageHistory(
+#         conversation_uuid=question.conversation_uuid,
+#         connection_string=conn_string,
+#         table_name=os.getenv("TABLE_NAME_CONVERSATION_MESSAGES"),
+#         conversations_table=os.getenv("TABLE_NAME_CONVERSATION"),
+#         usage_table=TABLE_CONVERSATION_USAGE,
+#     )
+#     # Summary of the older messages and the messages after it, bounded
+#     # however long the conversation
+#     prompt_assembler = await resources.get("prompt_assembler")
+#     summary_memory = await ConversationSummaryBufferMemory.from_config(
+#         chat_memory, prompt_assembler.count, summary_memory_config
+#     ).aload()
+#     chat_history = summary_memory.messages
+
+#     # chat history for prompt
+#     chat_history_prompt = chat_history
+
+#     # chat history for json response
+#     chat_history_dict = [message_to_dict(message) for message in chat_history]
+
+#     chroma_collection = await resources.get("vector_store")
+#     chain = await resources.get("llm")
+
+#     # Answer of a similar question of a user with the same packages
+#     answer_cache_key = user_package.answer_cache_key
+#     question_embedding = None
+#     cached = None
+#     if summary_memory.summary is None and answer_cache.accepts(chat_history):
+#         question_embedding = await chroma_collection.aembed_question(question.question)
+#         # Scores every answer of the partition, and may delete expired answers
+#         # from the sqlite file
+#         cached = await run_blocking(
+#             answer_cache.lookup, answer_cache_key, question_embedding
+#         )
+#     if cached is not None:
+
+#         async def cached_event_stream():
+#             yield format_sse("token", {"content": cached.answer})
+#             try:
+#                 # No model call, the turn costs nothing
+#                 await chat_memory.aadd_turn(
+#                     human_message=question.question,
+#                     ai_message=cached.answer,
+#                     human_tokens=0,
+#                     ai_tokens=0,
+#                     human_cost=0.0,
+#                     ai_cost=0.0,
+#                 )
+#             except Exception as error:
+#                 yield format_sse("error", {"detail": str(error)})
+#                 return
+
+#             yield format_sse(
+#                 "end",
+#                 {
+#                     "question": question.question,
+#                     "response": cached.answer,
+#                     "chat_history": chat_history_dict,
+#                     "summary": summary_memory.summary,
+#                     "prompt_tokens": 0,
+#                     "completion_tokens": 0,
+#                     "total_tokens": 0,
+#                     "total_cost": 0.0,
+#                     "cached": True,
+#                 },
+#             )
+
+#         return StreamingResponse(
+#             cached_event_stream(), media_type="text/event-stream", headers=SSE_HEADERS
+#         )
+
+#     # User package documents, most relevant first
+#     package_documents, list_ids_retriver = (
+#         await chroma_collection.aget_zurich_package_documents(
+#             filter_packages=user_package.filter,
+#             user_question=question.question,
+#             top_k=3,
+#         )
+#     )
+
+#     # General Condition
+#     general_condition = await run_blocking(
+#         chroma_collection.get_zurich_general_condition
+#     )
+
+#     # Fit the documents, the history and the general condition in the token
+#     # budget of the prompt
+#     assembled_prompt = await run_blocking(
+#         prompt_assembler.assemble,
+#         question=question.question,
+#         deductible=user_package.deductible,
+#         sum_insured=user_package.sum_insured,
+#         package_documents=package_documents,
+#         general_condition=general_condition,
+#         chat_history=chat_history_prompt,
+#         summary=summary_memory.summary or "",
+#     )
+
+#     inputs = {
+#         "question": question.question,
+#         "chat_history": assembled_prompt.chat_history,
+#         "summary": summary_memory.summary or "",
+#         "deductible": user_package.deductible,
+#         "sum_insured": user_package.sum_insured,
+#         "context": assembled_prompt.context,
+#     }
+
+#     async def event_stream():
+#         answer = []
+#         try:
+#             prompt_messages = (await chain.first.ainvoke(inputs)).to_messages()
+#             # The model already answered the same prompt
+#             response = await prompt_cache.aget(prompt_messages, chain.last)
+#             prompt_cached = response is not None
+#             if prompt_cached:
+#                 yield format_sse("token", {"content": response})
+#                 usage = {
+#                     "prompt_tokens": 0,
+#                     "completion_tokens": 0,
+#                     "total_tokens": 0,
+#                     "prompt_cost": 0.0,
+#                     "completion_cost": 0.0,
+#                     "total_cost": 0.0,
+#                 }
+#             else:
+#                 async for chunk in chain.last.astream(prompt_messages):
+#                     answer.append(chunk.content)
+#                     yield format_sse("token", {"content": chunk.content})
+
+#                 response = "".join(answer)
+#                 usage = await run_blocking(
+#                     stream_usage, chain.last, prompt_messages, response
+#                 )
+#                 await prompt_cache.aset(prompt_messages, chain.last, response)
+
+#             await chat_memory.aadd_turn(
+#                 human_message=question.question,
+#                 ai_message=response,
+#                 human_tokens=usage["prompt_tokens"],
+#                 ai_tokens=usage["completion_tokens"],
+#                 human_cost=usage["prompt_cost"],
+#                 ai_cost=usage["completion_cost"],
+#             )
+#             background_tasks.add_task(
+#                 summary_memory.aupdate_summary,
+#                 chain.last,
+#                 question.question,
+#                 response,
+#             )
+#             if question_embedding is not None:
+#                 await run_blocking(
+#                     answer_cache.add,
+#                     answer_cache_key,
+#                     question_embedding,
+#                     question.question,
+#                     response,
+#                 )
+#         except Exception as error:
+#             yield format_sse("error", {"detail": str(error)})
+#             return
+
+#         yield format_sse(
+#             "end",
+#             {
+#                 "question": question.question,
+#                 "response": response,
+#                 "chat_history": chat_history_dict,
+#                 "summary": summary_memory.summary,
+#                 **usage,
+#                 "cached": prompt_cached,
+#                 "prompt_tokens_breakdown": assembled_prompt.breakdown(),
+#             },
+#         )
+
+#     return StreamingResponse(
+#         event_stream(), media_type="text/event-stream", headers=SSE_HEADERS
+#     )
+
+
 # @app.post("/conversation")
 # async def create_new_conversation(
-#     playload=Depends(decode_token), managed_client_uuid: uuid.UUID = Header(...)
+#     playload=Depends(decode_token),
+#     managed_client_uuid: uuid.UUID = Header(...),
+#     query_db: QueryConversations = Depends(get_query_db),
 # ):
 #     conv_uuid = str(uuid.uuid4())
 #     conv_name = f"conv_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
 
-#     if not user_can_manage_client(
+#     if not await auser_can_manage_client(
 #         managed_client_uuid=managed_client_uuid,
 #         user_sub=playload["sub"],
 #         user_email=playload["email"],
@@ -181,24 +697,27 @@
 #         )
 
 #     try:
-#         query_db.create_new_conversation(
+#         await query_db.create_new_conversation(
 #             user_uuid=managed_client_uuid, conv_uuid=conv_uuid, conv_name=conv_name
 #         )
+#         ownership_cache.add(user_uuid=managed_client_uuid, conversation_uuid=conv_uuid)
 
 #         chat_memory = PostgresChatMessageHistory(
 #             conversation_uuid=conv_uuid,
 #             connection_string=conn_string,
 #             table_name=os.getenv("TABLE_NAME_CONVERSATION_MESSAGES"),
+#             conversations_table=os.getenv("TABLE_NAME_CONVERSATION"),
+#             usage_table=TABLE_CONVERSATION_USAGE,
 #         )
 
-#         chat_memory.add_ai_message(
+#         await chat_memory.aadd_ai_message(
 #             message="Bienvenu chez Insurapolis, comment puis-je vous aider ?",
 #             cost=0,
 #             tokens=12,
 #         )
 
 #         chat_history_dict = [
-#             message_to_dict(message) for message in chat_memory.messages
+#             message_to_dict(message) for message in await chat_memory.aget_messages()
 #         ]
 
 #         response_data = {
@@ -216,10 +735,14 @@
 
 # @app.get("/conversations")
 # async def list_conversations(
-#     playload=Depends(decode_token), managed_client_uuid: uuid.UUID = Header(...)
+#     before: Optional[str] = Query(default=None),
+#     limit: Optional[int] = Query(default=None, ge=1, le=CONVERSATIONS_PAGE_MAX_SIZE),
+#     playload=Depends(decode_token),
+#     managed_client_uuid: uuid.UUID = Header(...),
+#     query_db: QueryConversations = Depends(get_query_db),
 # ):
 
-#     if not user_can_manage_client(
+#     if not await auser_can_manage_client(
 #         managed_client_uuid=managed_client_uuid,
 #         user_sub=playload["sub"],
 #         user_email=playload["email"],
@@ -230,10 +753,28 @@
 #         )
 
 #     try:
-#         list_conversations_uuid = query_db.get_list_conversations_by_user(
-#             user_uuid=managed_client_uuid
+#         cursor = decode_conversations_cursor(before) if before is not None else None
+#     except ValueError:
+#         raise HTTPException(
+#             status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
 #         )
 
+#     try:
+#         # Whole list, or one keyset page when requested
+#         next_before = None
+#         if limit is None and cursor is None:
+#             list_conversations_uuid = await query_db.get_list_conversations_by_user(
+#                 user_uuid=managed_client_uuid
+#             )
+#         else:
+#             list_conversations_uuid, next_before = (
+#                 await query_db.get_conversations_page(
+#                     user_uuid=managed_client_uuid,
+#                     before=cursor,
+#                     limit=limit or CONVERSATIONS_PAGE_SIZE,
+#                 )
+#             )
+
 #         response = {
 #             "user_email": playload["email"],
 #             "managed_client_uuid": str(managed_client_uuid),
@@ -245,6 +786,9 @@
 #                 }
 #                 for row in list_conversations_uuid
 #             ],
+#             "next_before": (
+#                 encode_conversations_cursor(next_before) if next_before else None
+#             ),
 #         }
 
 #         return JSONResponse(content=response, status_code=status.HTTP_200_OK)
@@ -255,11 +799,14 @@
 # @app.get("/conversation/{conversation_uuid}")
 # async def get_conversation(
 #     conversation_uuid: str,
+#     after_id: Optional[int] = Query(default=None),
+#     limit: Optional[int] = Query(default=None, ge=1, le=MESSAGES_PAGE_MAX_SIZE),
 #     playload=Depends(decode_token),
 #     managed_client_uuid: uuid.UUID = Header(...),
+#     query_db: QueryConversations = Depends(get_query_db),
 # ):
 
-#     if not user_can_manage_client(
+#     if not await auser_can_manage_client(
 #         managed_client_uuid=managed_client_uuid,
 #         user_sub=playload["sub"],
 #         user_email=playload["email"],
@@ -269,37 +816,51 @@
 #             detail="Active user does not managed this client",
 #         )
 
-#     # Check if the client is the owner of the conversation.
-#     if not query_db.user_owns_conversation(
-#         user_uuid=managed_client_uuid, conversation_uuid=conversation_uuid
-#     ):
-#         raise HTTPException(
-#             status_code=status.HTTP_403_FORBIDDEN,
-#             detail="User does not have the rights to access this conversation",
-#         )
-
 #     try:
-#         # Fetch conversation messages by UUID
-#         conversation = query_db.get_conversation_messages_by_uuid(
-#             conv_uuid=conversation_uuid
-#         )
-#         if conversation:
-#             return JSONResponse(
-#                 content={
-#                     "user_email": playload["email"],
-#                     "managed_client_uuid": str(managed_client_uuid),
-#                     "conversation": conversation,
-#                 },
-#                 status_code=status.HTTP_200_OK,
+#         # Fetch conversation messages by UUID, one keyset page when requested,
+#         # the owner is checked in the same query
+#         next_after_id = None
+#         if limit is None and after_id is None:
+#             conversation = await query_db.get_conversation_messages_by_uuid(
+#                 conv_uuid=conversation_uuid, user_uuid=managed_client_uuid
 #             )
 #         else:
-#             raise HTTPException(
-#                 status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+#             conversation, next_after_id = await query_db.get_conversation_messages_page(
+#                 conv_uuid=conversation_uuid,
+#                 after_id=after_id,
+#                 limit=limit or MESSAGES_PAGE_SIZE,
+#                 user_uuid=managed_client_uuid,
 #             )
+#     except ConversationNotFoundError:
+#         raise HTTPException(
+#             status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+#         )
+#     except ConversationAccessError:
+#         raise HTTPException(
+#             status_code=status.HTTP_403_FORBIDDEN,
+#             detail="User does not have the rights to access this conversation",
+#         )
 #     except ValueError as e:
 #         # Handle potential ValueError from the database operation or data processing
 #         raise HTTPException(status_code=500, detail=str(e))
 
+#     # A conversation without messages is not found, as before the owner check;
+#     # only a page after the last message is empty
+#     if not conversation and after_id is None:
+#         raise HTTPException(
+#             status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+#         )
+
+#     return JSONResponse(
+#         content={
+#             "user_email": playload["email"],
+#             "managed_client_uuid": str(managed_client_uuid),
+#             "conversation": conversation,
+#             "next_after_id": next_after_id,
+#         },
+#         status_code=status.HTTP_200_OK,
+#     )
+
 
 # @app.put("/conversation/{conversation_uuid}")
 # async def update_conversation(
@@ -307,9 +868,10 @@
 #     request_body: ConversationUpdateRequest,
 #     playload=Depends(decode_token),
 #     managed_client_uuid: uuid.UUID = Header(...),
+#     query_db: QueryConversations = Depends(get_query_db),
 # ):
 
-#     if not user_can_manage_client(
+#     if not await auser_can_manage_client(
 #         managed_client_uuid=managed_client_uuid,
 #         user_sub=playload["sub"],
 #         user_email=playload["email"],
@@ -322,45 +884,48 @@
 #     # Extract the new name from the request body
 #     new_name = request_body.name
 
-#     if not query_db.user_owns_conversation(
-#         user_uuid=managed_client_uuid, conversation_uuid=conversation_uuid
-#     ):
+#     try:
+#         # Update the conversation name by UUID, the owner and the name are
+#         # checked in the same statement
+#         success = await query_db.update_conversation_name(
+#             conversation_uuid, new_name, user_uuid=managed_client_uuid
+#         )
+#     except ConversationNotFoundError:
+#         raise HTTPException(
+#             status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+#         )
+#     except ConversationAccessError:
 #         raise HTTPException(
 #             status_code=status.HTTP_403_FORBIDDEN,
 #             detail="User does not have the rights to access this conversation",
 #         )
-
-#     if query_db.conversation_name_exists(
-#         user_uuid=managed_client_uuid, conversation_name=new_name
-#     ):
+#     except ConversationNameExistsError:
 #         raise HTTPException(
 #             status_code=status.HTTP_400_BAD_REQUEST,
 #             detail="Conversation name already exists",
 #         )
-#     try:
-#         # Update the conversation name by UUID
-#         success = query_db.update_conversation_name(conversation_uuid, new_name)
-#         if success:
-#             return {
-#                 "managed_client_uuid": str(managed_client_uuid),
-#                 "message": "Conversation name updated successfully",
-#             }
-#         else:
-#             raise HTTPException(
-#                 status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
-#             )
 #     except Exception as e:
 #         # Log the error or handle it as per your application's requirements
 #         raise HTTPException(status_code=500, detail=str(e))
 
+#     if success:
+#         return {
+#             "managed_client_uuid": str(managed_client_uuid),
+#             "message": "Conversation name updated successfully",
+#         }
+#     raise HTTPException(
+#         status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+#     )
+
 
 # @app.delete("/conversation/{conversation_uuid}")
 # async def delete_conversation(
 #     conversation_uuid: str,
 #     playload=Depends(decode_token),
 #     managed_client_uuid: uuid.UUID = Header(...),
+#     query_db: QueryConversations = Depends(get_query_db),
 # ):
-#     if not user_can_manage_client(
+#     if not await auser_can_manage_client(
 #         managed_client_uuid=managed_client_uuid,
 #         user_sub=playload["sub"],
 #         user_email=playload["email"],
@@ -372,31 +937,185 @@
 
 #     try:
 #         # Call the method to delete the conversation by UUID
-#         success = query_db.delete_conversation(conversation_uuid)
-#         if success:
-#             return JSONResponse(
-#                 content={
-#                     "managed_client_uuid": str(managed_client_uuid),
-#                     "message": "Conversation deleted successfully",
-#                 },
-#                 status_code=200,
-#             )
-#         else:
-#             raise HTTPException(status_code=404, detail="Conversation not found")
+#         success = await query_db.delete_conversation(
+#             conversation_uuid, user_uuid=managed_client_uuid
+#         )
+#     except ConversationNotFoundError:
+#         raise HTTPException(
+#             status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+#         )
+#     except ConversationAccessError:
+#         raise HTTPException(
+#             status_code=status.HTTP_403_FORBIDDEN,
+#             detail="User does not have the rights to access this conversation",
+#         )
 #     except Exception as e:
 #         raise HTTPException(status_code=500, detail=str(e))
 
+#     if success:
+#         ownership_cache.invalidate(conversation_uuid)
+#         return JSONResponse(
+#             content={
+#                 "managed_client_uuid": str(managed_client_uuid),
+#                 "message": "Conversation deleted successfully",
+#             },
+#             status_code=200,
+#         )
+#     raise HTTPException(
+#         status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+#     )
+
 
 # @app.post("/get-user-tokens")
 # async def get_user_tokens(
-#     playload=Depends(decode_token), managed_user_uuid: uuid.UUID = Header(...)
+#     playload=Depends(decode_token),
+#     managed_user_uuid: uuid.UUID = Header(...),
+#     query_db: QueryConversations = Depends(get_query_db),
 # ):
-#     tokens_used = query_db.get_total_tokens_used_per_user(user_uuid=playload["sub"])
+#     tokens_used = await query_db.get_total_tokens_used_per_user(
+#         user_uuid=playload["sub"]
+#     )
 
 #     return JSONResponse(
 #         content={"tokens": tokens_used, "user_uuid": playload["sub"]}, status_code=200
 #     )
 
 
+# @app.get("/usage")
+# async def get_usage(
+#     start: Optional[date] = Query(default=None),
+#     end: Optional[date] = Query(default=None),
+#     playload=Depends(decode_token),
+#     managed_client_uuid: uuid.UUID = Header(...),
+#     query_db: QueryConversations = Depends(get_query_db),
+# ):
+#     """
+#     Returns the tokens and cost used by the managed client from `start` to `end`
+#     included (ISO dates, the last USAGE_DEFAULT_DAYS days by default), in total,
+#     per day and per conversation. Served from the daily usage rollups, for
+#     dashboards and quota checks.
+#     """
+#     if not await auser_can_manage_client(
+#         managed_client_uuid=managed_client_uuid,
+#         user_sub=playload["sub"],
+#         user_email=playload["email"],
+#     ):
+#         raise HTTPException(
+#             status_code=status.HTTP_403_FORBIDDEN,
+#             detail="Active user does not managed this client",
+#         )
+
+#     try:
+#         start, end = usage_range(start, end)
+#     except ValueError as e:
+#         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+#     usage = await query_db.get_usage(
+#         user_uuid=managed_client_uuid, start=start, end=end
+#     )
+
+#     return JSONResponse(
+#         content={
+#             "managed_client_uuid": str(managed_client_uuid),
+#             "start": start.isoformat(),
+#             "end": end.isoformat(),
+#             **usage,
+#         },
+#         status_code=status.HTTP_200_OK,
+#     )
+
+
+# @app.get("/health/live")
+# async def liveness():
+#     """
+#     Returns 200 as long as the worker serves requests, even while its resources
+#     are warming up.
+#     """
+#     return JSONResponse(content={"status": "alive"}, status_code=status.HTTP_200_OK)
+
+
+# @app.get("/health/ready")
+# async def readiness():
+#     """
+#     Returns 200 once the resources created at startup (database, chat history
+#     pool, embedding model, vector store, LLM client) are ready and 503 before,
+#     with the state and the startup time of each resource.
+#     """
+#     return JSONResponse(
+#         content=resources.status(),
+#         status_code=status.HTTP_200_OK
+#         if resources.ready
+#         else status.HTTP_503_SERVICE_UNAVAILABLE,
+#     )
+
+
+# @app.get("/metrics/db-pool", dependencies=[Depends(decode_token)])
+# async def db_pool_metrics():
+#     """
+#     Returns the state of the connection pools of this worker: the SQLAlchemy
+#     engine pool (size, checked out connections, overflow, checkout wait time)
+#     and the psycopg pools of the chat history.
+#     """
+#     return JSONResponse(
+#         content={"engine": database.pool_status(), "chat_history": get_pool_stats()},
+#         status_code=status.HTTP_200_OK,
+#     )
+
+
+# @app.get("/metrics/embeddings", dependencies=[Depends(decode_token)])
+# async def embedding_metrics():
+#     """
+#     Returns the hit ratio of the question embedding cache and the latency of
+#     the embeddings computed by the model, for this worker.
+#     """
+#     question_embeddings = await resources.get("embeddings")
+#     return JSONResponse(
+#         content=question_embeddings.stats.to_dict(), status_code=status.HTTP_200_OK
+#     )
+
+
+# @app.get("/metrics/answer-cache", dependencies=[Depends(decode_token)])
+# async def answer_cache_metrics():
+#     """
+#     Returns the hit ratio of the semantic answer cache of this worker, and the
+#     questions that could not use it because of the history of their
+#     conversation.
+#     """
+#     return JSONResponse(
+#         content={**answer_cache.stats.to_dict(), "size": len(answer_cache)},
+#         status_code=status.HTTP_200_OK,
+#     )
+
+
+# @app.get("/metrics/prompt-cache", dependencies=[Depends(decode_token)])
+# async def prompt_cache_metrics():
+#     """
+#     Returns the hit ratio and the latency of the backend of the exact-match
+#     prompt cache, as seen by this worker.
+#     """
+#     return JSONResponse(
+#         content=prompt_cache.stats.to_dict(), status_code=status.HTTP_200_OK
+#     )
+
+
+# @app.get("/metrics/packages", dependencies=[Depends(decode_token)])
+# async def package_metrics():
+#     """
+#     Returns the hit ratio of the package context cache of this worker.
+#     """
+#     return JSONResponse(
+#         content=user_package_cache.stats.to_dict(), status_code=status.HTTP_200_OK
+#     )
+
+
+# @app.get("/metrics/ownership", dependencies=[Depends(decode_token)])
+# async def ownership_metrics():
+#     """
+#     Returns the hit ratio of the conversation ownership cache of this worker.
+#     """
+#     return JSONResponse(
+#         content=ownership_cache.stats.to_dict(), status_code=status.HTTP_200_OK
+#     )
+
+
 # if __name__ == "__main__":
 #     uvicorn.run("app_b2b:app", host="localhost", port=8000, reload=True)
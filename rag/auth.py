@@ -1,14 +1,21 @@
-import httpx
 import boto3
+import hashlib
 import uuid
 from datetime import datetime, timezone
 import jwt
-import time
 from fastapi import HTTPException, Header, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import os
 from dotenv import load_dotenv
 
+from rag.cache import TTLCache
+from rag.jwks import JWKSManager
+from rag.permissions import (
+    DynamoDBManagedClients,
+    PermissionCache,
+    SqliteManagedClients,
+)
+
 load_dotenv()
 
 AWS_REGION = os.getenv("AWS_REGION")
@@ -21,6 +28,15 @@ COGNITO_ISSUER = f"https://cognito-idp.{AWS_REGION}.amazonaws.com/{USER_POOL_ID}
 COGNITO_JWKS_URI = f"{COGNITO_ISSUER}/.well-known/jwks.json"
 
 CACHE_TIME = 86400  # seconds
+# Read the JWKS from this file instead of Cognito, e.g. for tests
+JWKS_PATH = os.getenv("JWKS_PATH")
+JWKS_UNKNOWN_KID_INTERVAL = float(os.getenv("JWKS_UNKNOWN_KID_INTERVAL", "60"))
+VERIFIED_TOKEN_CACHE_SIZE = int(os.getenv("VERIFIED_TOKEN_CACHE_SIZE", "10000"))
+PERMISSION_CACHE_SIZE = int(os.getenv("PERMISSION_CACHE_SIZE", "10000"))
+PERMISSION_CACHE_TTL = float(os.getenv("PERMISSION_CACHE_TTL", "300"))
+PERMISSION_CACHE_NEGATIVE_TTL = float(os.getenv("PERMISSION_CACHE_NEGATIVE_TTL", "60"))
+# Read the managed clients from this sqlite file instead of DynamoDB
+MANAGED_CLIENTS_SQLITE_PATH = os.getenv("MANAGED_CLIENTS_SQLITE_PATH")
 
 # DynamoDB
 session = boto3.Session(
@@ -30,70 +46,113 @@ session = boto3.Session(
 )
 dynamodb = session.resource("dynamodb")
 table = dynamodb.Table(DYNAMO_DB_TABLE)
+dynamodb_managed_clients = DynamoDBManagedClients(table)
 
 # Cache
-jwks_cache = {"keys": None, "fetched_time": 0}
+jwks_manager = JWKSManager(
+    COGNITO_JWKS_URI,
+    ttl=CACHE_TIME,
+    unknown_kid_interval=JWKS_UNKNOWN_KID_INTERVAL,
+    local_path=JWKS_PATH,
+)
+# Public keys parsed from the JWKS, with their JWK, per kid
+public_key_cache = {}
+# Payloads of the verified tokens, keyed by the token hash until they expire
+verified_token_cache = TTLCache(max_size=VERIFIED_TOKEN_CACHE_SIZE)
+# Clients managed by each user
+permission_cache = PermissionCache(
+    SqliteManagedClients(MANAGED_CLIENTS_SQLITE_PATH)
+    if MANAGED_CLIENTS_SQLITE_PATH
+    else dynamodb_managed_clients,
+    max_size=PERMISSION_CACHE_SIZE,
+    ttl=PERMISSION_CACHE_TTL,
+    negative_ttl=PERMISSION_CACHE_NEGATIVE_TTL,
+)
 
 security = HTTPBearer()
 
 
 async def fetch_cognito_keys():
-    if jwks_cache["keys"] and (time.time() - jwks_cache["fetched_time"] < CACHE_TIME):
-        return jwks_cache["keys"]
-    async with httpx.AsyncClient() as client:
-        response = await client.get(COGNITO_JWKS_URI)
-        response.raise_for_status()
-        jwks_cache["keys"] = {key["kid"]: key for key in response.json()["keys"]}
-        jwks_cache["fetched_time"] = time.time()
-    return jwks_cache["keys"]
+    return await jwks_manager.get_keys()
 
 
-async def decode_token(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    keys=Depends(fetch_cognito_keys),
-):
-    token = credentials.credentials
+def get_public_key(kid: str, keys: dict):
+    """Return the public key of `kid`, parsed from its JWK on first use."""
+    jwk = keys[kid]
+    cached_jwk, public_key = public_key_cache.get(kid, (None, None))
+    # The JWKS objects are replaced when they are refreshed
+    if cached_jwk is not jwk:
+        public_key = jwt.algorithms.RSAAlgorithm.from_jwk(jwk)
+        public_key_cache[kid] = (jwk, public_key)
+    return public_key
 
-    try:
-        unverified_headers = jwt.get_unverified_header(token)
-
-        if unverified_headers["kid"] not in keys:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="JWK not found for given kid",
-            )
-        public_key = jwt.algorithms.RSAAlgorithm.from_jwk(
-            keys[unverified_headers["kid"]]
+
+def verify_token(token: str, keys: dict) -> dict:
+    """
+    Verify the signature and the claims of `token` and return its payload.
+
+    The payload of a verified token is cached until the token expires, so that
+    the next requests with the same token skip the RSA verification.
+    """
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    payload = verified_token_cache.get(token_hash)
+    if payload is not None:
+        return dict(payload)
+
+    unverified_headers = jwt.get_unverified_header(token)
+
+    if unverified_headers["kid"] not in keys:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="JWK not found for given kid",
         )
-        payload = jwt.decode(
-            token,
-            public_key,
-            algorithms=["RS256"],
-            audience=CLIENT_ID,
-            issuer=COGNITO_ISSUER,
+    public_key = get_public_key(unverified_headers["kid"], keys)
+    payload = jwt.decode(
+        token,
+        public_key,
+        algorithms=["RS256"],
+        audience=CLIENT_ID,
+        issuer=COGNITO_ISSUER,
+    )
+
+    # Additional payload validations
+    current_time = datetime.now(timezone.utc).timestamp()
+    if payload.get("exp") is None or current_time > payload["exp"]:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token has expired, please re-login",
         )
 
-        # Additional payload validations
-        current_time = datetime.now(timezone.utc).timestamp()
-        if payload.get("exp") is None or current_time > payload["exp"]:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token has expired, please re-login",
-            )
+    if payload.get("aud") != CLIENT_ID:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid token: Incorrect audience",
+        )
 
-        if payload.get("aud") != CLIENT_ID:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Invalid token: Incorrect audience",
-            )
+    if payload.get("iss") != COGNITO_ISSUER:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid token: Incorrect issuer",
+        )
+
+    verified_token_cache.set(
+        token_hash, dict(payload), ttl=payload["exp"] - current_time
+    )
+    return payload
 
-        if payload.get("iss") != COGNITO_ISSUER:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Invalid token: Incorrect issuer",
-            )
 
-        return payload
+async def decode_token(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    keys=Depends(fetch_cognito_keys),
+):
+    token = credentials.credentials
+
+    try:
+        kid = jwt.get_unverified_header(token).get("kid")
+        if kid not in keys:
+            # The keys may have been rotated since they were fetched
+            keys = await jwks_manager.refresh_unknown_kid(kid)
+        return verify_token(token, keys)
 
     except jwt.ExpiredSignatureError:
         raise HTTPException(
@@ -120,20 +179,24 @@ def user_can_manage_client(managed_client_uuid: uuid.UUID, user_sub: str, user_e
     """
 
     try:
-        response = table.get_item(Key={"id": str(user_sub), "email": str(user_email)})
-
-        item = response.get("Item", None)
-        list_managed_user_dicts = item.get("managedUsers", None)
-
-        if list_managed_user_dicts:
-            # Convert list of dictionaries with user IDs to list of UUIDs
-            list_managed_user_uuids = [
-                uuid.UUID(user_dict["id"]) for user_dict in list_managed_user_dicts
-            ]
-            if managed_client_uuid in list_managed_user_uuids:
-                return True
-
-        return False
+        managed_clients = dynamodb_managed_clients.get_managed_clients(
+            user_sub=user_sub, user_email=user_email
+        )
+        return managed_client_uuid in (managed_clients or ())
     except Exception as e:
         print("Failed to query DynamoDB:", str(e))
         return False
+
+
+async def auser_can_manage_client(
+    managed_client_uuid: uuid.UUID, user_sub: str, user_email: str
+) -> bool:
+    """
+    Async and cached version of `user_can_manage_client`. The managed clients
+    of the user are looked up in the executor, then kept in `permission_cache`.
+    """
+    return await permission_cache.can_manage(
+        managed_client_uuid=managed_client_uuid,
+        user_sub=user_sub,
+        user_email=user_email,
+    )
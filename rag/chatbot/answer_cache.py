@@ -0,0 +1,284 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.messages import BaseMessage
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CachedAnswer:
+    partition: str
+    question: str
+    answer: str
+    created_at: float
+
+
+class AnswerCacheStats:
+    """Hit/miss counters of a `SemanticAnswerCache`."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.stored = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def to_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            # Questions asked after too long a history to use the cache
+            "skipped": self.skipped,
+            "stored": self.stored,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SqliteAnswerStore:
+    """On-disk copy of the cached answers, reloaded at startup."""
+
+    def __init__(self, path: str):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS answers (id INTEGER PRIMARY KEY, "
+                "partition TEXT NOT NULL, embedding BLOB NOT NULL, "
+                "question TEXT NOT NULL, answer TEXT NOT NULL, "
+                "created_at REAL NOT NULL)"
+            )
+
+    def load(self, created_after: float, limit: int) -> list:
+        """The newest answers created after `created_after`, oldest first."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, partition, embedding, question, answer, created_at "
+                "FROM answers WHERE created_at > ? ORDER BY created_at DESC LIMIT ?",
+                (created_after, limit),
+            ).fetchall()
+        return [
+            (
+                row_id,
+                CachedAnswer(partition, question, answer, created_at),
+                np.frombuffer(embedding, dtype=np.float32),
+            )
+            for row_id, partition, embedding, question, answer, created_at in reversed(
+                rows
+            )
+        ]
+
+    def add(self, answer: CachedAnswer, embedding: np.ndarray) -> int:
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO answers "
+                "(partition, embedding, question, answer, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    answer.partition,
+                    embedding.astype(np.float32).tobytes(),
+                    answer.question,
+                    answer.answer,
+                    answer.created_at,
+                ),
+            )
+        return cursor.lastrowid
+
+    def delete(self, ids: Sequence[int]) -> None:
+        if not ids:
+            return
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "DELETE FROM answers WHERE id = ?", [(row_id,) for row_id in ids]
+            )
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM answers")
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class _Partition:
+    """Normalized embeddings of the cached questions of a partition, stacked
+    in one matrix when they are searched."""
+
+    def __init__(self):
+        self.embeddings: Dict[int, np.ndarray] = {}
+        self._ids: Optional[List[int]] = None
+        self._matrix: Optional[np.ndarray] = None
+
+    def add(self, entry_id: int, embedding: np.ndarray) -> None:
+        self.embeddings[entry_id] = embedding
+        self._ids = None
+
+    def remove(self, entry_id: int) -> None:
+        if self.embeddings.pop(entry_id, None) is not None:
+            self._ids = None
+
+    def scores(self, embedding: np.ndarray):
+        if self._ids is None:
+            self._ids = list(self.embeddings)
+            self._matrix = np.stack([self.embeddings[i] for i in self._ids])
+        return self._ids, self._matrix @ embedding
+
+
+class SemanticAnswerCache:
+    """Cache of the answers of the chatbot, found by the similarity of the
+    questions.
+
+    The answers are partitioned by the package context of the user (see
+    `UserPackageContext.answer_cache_key`): a question gets the cached answer
+    of a question of the same partition whose embedding has a cosine
+    similarity of at least `threshold`. Only the questions asked after at
+    most `max_history` questions of the same conversation use the cache, the
+    later ones depend on the history. Answers expire after `ttl` seconds and
+    the least recently used is evicted beyond `max_size` answers. When
+    `disk_path` is given, the answers are also kept in a sqlite file and
+    reloaded at startup.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.95,
+        ttl: float = 86400.0,
+        max_size: int = 10000,
+        max_history: int = 0,
+        disk_path: Optional[str] = None,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_history = max_history
+        self.store = SqliteAnswerStore(disk_path) if disk_path else None
+        self.stats = AnswerCacheStats()
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._partitions: Dict[str, _Partition] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        if self.store is not None:
+            for row_id, answer, embedding in self.store.load(
+                time.time() - self.ttl, self.max_size
+            ):
+                self._insert(row_id, answer, embedding)
+            self._next_id = max(self._entries, default=0)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def accepts(self, chat_history: Sequence[BaseMessage]) -> bool:
+        """Whether a question asked after `chat_history` can use the cache."""
+        if not self.enabled:
+            return False
+        questions = sum(message.type == "human" for message in chat_history)
+        if questions > self.max_history:
+            self.stats.skipped += 1
+            return False
+        return True
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _insert(self, entry_id: int, answer: CachedAnswer, embedding) -> None:
+        self._entries[entry_id] = answer
+        self._partitions.setdefault(answer.partition, _Partition()).add(
+            entry_id, embedding
+        )
+
+    def _remove(self, entry_id: int) -> None:
+        answer = self._entries.pop(entry_id)
+        partition = self._partitions[answer.partition]
+        partition.remove(entry_id)
+        if not partition.embeddings:
+            del self._partitions[answer.partition]
+
+    def lookup(self, partition: str, embedding) -> Optional[CachedAnswer]:
+        """Return the cached answer of the most similar question of
+        `partition`, if similar enough. Scores all the answers of the partition
+        and deletes the expired ones from the sqlite file when there is one,
+        call it from a worker thread."""
+        embedding = self._normalize(embedding)
+        expired = []
+        with self._lock:
+            answer = None
+            if partition in self._partitions:
+                ids, scores = self._partitions[partition].scores(embedding)
+                oldest = time.time() - self.ttl
+                for index in np.argsort(-scores):
+                    if scores[index] < self.threshold:
+                        break
+                    entry_id = ids[index]
+                    if self._entries[entry_id].created_at <= oldest:
+                        expired.append(entry_id)
+                        continue
+                    answer = self._entries[entry_id]
+                    self._entries.move_to_end(entry_id)
+                    break
+
+            for entry_id in expired:
+                self._remove(entry_id)
+            self.stats.expirations += len(expired)
+            if answer is None:
+                self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+
+        if expired and self.store is not None:
+            self.store.delete(expired)
+        return answer
+
+    def add(self, partition: str, embedding, question: str, answer: str) -> None:
+        """Cache the `answer` to `question`. Writes to the sqlite file when
+        there is one, call it from a worker thread."""
+        if not self.enabled:
+            return
+        cached = CachedAnswer(partition, question, answer, time.time())
+        embedding = self._normalize(embedding)
+        entry_id = self.store.add(cached, embedding) if self.store else None
+
+        evicted = []
+        with self._lock:
+            if entry_id is None:
+                self._next_id += 1
+                entry_id = self._next_id
+            self._insert(entry_id, cached, embedding)
+            self.stats.stored += 1
+            while len(self._entries) > self.max_size:
+                evicted.append(next(iter(self._entries)))
+                self._remove(evicted[-1])
+            self.stats.evictions += len(evicted)
+
+        if evicted and self.store is not None:
+            self.store.delete(evicted)
+
+    def clear(self) -> None:
+        """Drop every answer, e.g. after rebuilding the vector database."""
+        with self._lock:
+            self._entries.clear()
+            self._partitions.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def close(self) -> None:
+        if self.store is not None:
+            self.store.close()
@@ -0,0 +1,174 @@
+"""Embedding sidecar, one process holding the embedding model for every worker.
+
+With N uvicorn workers, each worker loads its own copy of the
+SentenceTransformer model. The sidecar loads it once and serves the
+embeddings over a Unix socket; the workers embed through
+`SidecarEmbeddingFunction`, an embedding function like the Chroma ones, and
+never load the model (nor import torch):
+
+    python -m rag.chatbot.embedding_sidecar --socket /tmp/embeddings.sock
+    EMBEDDING_SOCKET_PATH=/tmp/embeddings.sock uvicorn rag.app_b2c:app --workers 4
+
+A request is the JSON list of the texts, a response the float32 embeddings,
+both prefixed by their length.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+from typing import Callable, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+Embedding = List[float]
+
+# Length of a request, status and length of a response
+REQUEST_HEADER = struct.Struct(">I")
+RESPONSE_HEADER = struct.Struct(">BI")
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+
+class EmbeddingSidecarError(RuntimeError):
+    """The sidecar could not embed the texts."""
+
+
+def _recv_exactly(connection: socket.socket, size: int) -> bytes:
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = connection.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("Connection closed by the peer")
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
+class SidecarEmbeddingFunction:
+    """Embedding function computing the embeddings in the sidecar listening on
+    `socket_path`.
+
+    Each thread keeps its own connection, opened on first use and opened again
+    when the sidecar restarts.
+    """
+
+    def __init__(self, socket_path: str, timeout: float = 30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self) -> socket.socket:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        connection.connect(self.socket_path)
+        self._local.connection = connection
+        return connection
+
+    def _close(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _request(self, payload: bytes) -> bytes:
+        connection = getattr(self._local, "connection", None) or self._connect()
+        try:
+            connection.sendall(REQUEST_HEADER.pack(len(payload)) + payload)
+            status, size = RESPONSE_HEADER.unpack(
+                _recv_exactly(connection, RESPONSE_HEADER.size)
+            )
+            body = _recv_exactly(connection, size)
+        except OSError:
+            # Half-read responses cannot be resumed
+            self._close()
+            raise
+        if status != STATUS_OK:
+            raise EmbeddingSidecarError(body.decode())
+        return body
+
+    def __call__(self, input: List[str]) -> List[Embedding]:
+        if not input:
+            return []
+        payload = json.dumps(list(input)).encode()
+        try:
+            body = self._request(payload)
+        except (ConnectionError, BrokenPipeError):
+            # The connection of this thread predates a restart of the sidecar
+            body = self._request(payload)
+        return np.frombuffer(body, dtype=np.float32).reshape(len(input), -1).tolist()
+
+
+class _EmbeddingHandler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        while True:
+            try:
+                (size,) = REQUEST_HEADER.unpack(
+                    _recv_exactly(self.request, REQUEST_HEADER.size)
+                )
+                texts = json.loads(_recv_exactly(self.request, size))
+            except ConnectionError:
+                return
+
+            try:
+                body = self.server.embed(texts)
+                status = STATUS_OK
+            except Exception as error:
+                logger.exception("Could not embed %d texts", len(texts))
+                body = repr(error).encode()
+                status = STATUS_ERROR
+            self.request.sendall(RESPONSE_HEADER.pack(status, len(body)) + body)
+
+
+class EmbeddingSidecar(socketserver.ThreadingUnixStreamServer):
+    """Unix socket server of the embeddings of `embedding_function`, one
+    thread per connected worker. The model is called by one thread at a time,
+    it already uses every core for a batch."""
+
+    daemon_threads = True
+
+    def __init__(
+        self, socket_path: str, embedding_function: Callable[[List[str]], list]
+    ):
+        if os.path.exists(socket_path):
+            # Left by a previous sidecar
+            os.unlink(socket_path)
+        self.socket_path = socket_path
+        self.embedding_function = embedding_function
+        self._lock = threading.Lock()
+        super().__init__(socket_path, _EmbeddingHandler)
+
+    def embed(self, texts: List[str]) -> bytes:
+        with self._lock:
+            embeddings = self.embedding_function(texts)
+        return np.asarray(embeddings, dtype=np.float32).tobytes()
+
+    def server_close(self) -> None:
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from rag.utils import load_sentence_transformer_ef
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", required=True, help="path of the Unix socket")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    embedding_function = load_sentence_transformer_ef()
+    # Load the weights before the workers connect
+    embedding_function(["warmup"])
+    with EmbeddingSidecar(args.socket, embedding_function) as server:
+        logger.info("Serving the embeddings on %s", args.socket)
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+Embedding = List[float]
+
+
+def normalize_question(text: str) -> str:
+    """Normalize a question so that trivial variations share a cache entry."""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class EmbeddingCacheStats:
+    """Hit/miss counters and embedding latency of a `CachedEmbeddingFunction`."""
+
+    def __init__(self):
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.embedding_calls = 0
+        self.embedding_time = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, memory_hits: int, disk_hits: int, misses: int) -> None:
+        with self._lock:
+            self.memory_hits += memory_hits
+            self.disk_hits += disk_hits
+            self.misses += misses
+
+    def record_embedding(self, elapsed: float) -> None:
+        with self._lock:
+            self.embedding_calls += 1
+            self.embedding_time += elapsed
+
+    def to_dict(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.memory_hits + self.disk_hits) / lookups
+            if lookups
+            else 0.0,
+            "embedding_calls": self.embedding_calls,
+            "avg_embedding_ms": self.embedding_time / self.embedding_calls * 1000
+            if self.embedding_calls
+            else 0.0,
+        }
+
+
+class SqliteEmbeddingStore:
+    """On-disk tier of the embedding cache, survives restarts."""
+
+    def __init__(self, path: str):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, embedding BLOB NOT NULL)"
+            )
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, Embedding]:
+        if not keys:
+            return {}
+        placeholders = ", ".join("?" for _ in keys)
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})",
+                list(keys),
+            ).fetchall()
+        return {
+            key: np.frombuffer(blob, dtype=np.float32).tolist() for key, blob in rows
+        }
+
+    def set_many(self, items: Dict[str, Embedding]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+                [
+                    (key, np.asarray(embedding, dtype=np.float32).tobytes())
+                    for key, embedding in items.items()
+                ],
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class CachedEmbeddingFunction:
+    """Chroma embedding function caching the embeddings of the questions.
+
+    Embeddings are keyed on the model name and the normalized text. They are
+    kept in an in-memory LRU and, when `disk_path` is given, in a sqlite file
+    so that they survive restarts. Only the texts missing from both tiers are
+    sent to the wrapped embedding function, in one batch.
+    """
+
+    def __init__(
+        self,
+        embedding_function: Callable[[List[str]], List[Embedding]],
+        model_name: str,
+        max_size: int = 10000,
+        disk_path: Optional[str] = None,
+    ):
+        self.embedding_function = embedding_function
+        self.model_name = model_name
+        self.max_size = max_size
+        self.store = SqliteEmbeddingStore(disk_path) if disk_path else None
+        self.stats = EmbeddingCacheStats()
+        self._memory: "OrderedDict[str, Embedding]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode()).hexdigest()
+
+    def _get_memory(self, key: str) -> Optional[Embedding]:
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+            return embedding
+
+    def lookup(self, text: str) -> Optional[Embedding]:
+        """Return the embedding of `text` if it is in the in-memory tier."""
+        embedding = self._get_memory(self._key(normalize_question(text)))
+        if embedding is not None:
+            self.stats.record(1, 0, 0)
+        return embedding
+
+    def _set_memory(self, items: Dict[str, Embedding]) -> None:
+        with self._lock:
+            for key, embedding in items.items():
+                self._memory[key] = embedding
+                self._memory.move_to_end(key)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def __call__(self, input: List[str]) -> List[Embedding]:
+        texts = [normalize_question(text) for text in input]
+        keys = [self._key(text) for text in texts]
+
+        found: Dict[str, Embedding] = {}
+        for key in keys:
+            embedding = self._get_memory(key)
+            if embedding is not None:
+                found[key] = embedding
+        memory_hits = len(found)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        disk_hits = 0
+        if missing and self.store is not None:
+            from_disk = self.store.get_many(missing)
+            disk_hits = len(from_disk)
+            found.update(from_disk)
+            self._set_memory(from_disk)
+
+        to_embed = {
+            key: text for key, text in zip(keys, texts) if key not in found
+        }
+        if to_embed:
+            start = time.perf_counter()
+            embeddings = self.embedding_function(list(to_embed.values()))
+            self.stats.record_embedding(time.perf_counter() - start)
+
+            computed = {
+                key: [float(value) for value in embedding]
+                for key, embedding in zip(to_embed, embeddings)
+            }
+            found.update(computed)
+            self._set_memory(computed)
+            if self.store is not None:
+                self.store.set_many(computed)
+
+        self.stats.record(memory_hits, disk_hits, len(to_embed))
+        return [found[key] for key in keys]
+
+
+class EmbeddingBatcher:
+    """Micro-batching of the embeddings requested by concurrent coroutines.
+
+    Texts arriving within `max_wait_ms` of the first one, up to
+    `max_batch_size`, are embedded with a single call to `embedding_function`
+    in a dedicated worker thread. When the embedding function has a `lookup`
+    method (see `CachedEmbeddingFunction`), cached texts skip the batch.
+    """
+
+    def __init__(
+        self,
+        embedding_function: Callable[[List[str]], List[Embedding]],
+        max_wait_ms: float = 5,
+        max_batch_size: int = 32,
+    ):
+        self.embedding_function = embedding_function
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="embedding"
+        )
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def embed(self, text: str) -> Embedding:
+        """Return the embedding of `text`, batched with the concurrent requests."""
+        lookup = getattr(self.embedding_function, "lookup", None)
+        if lookup is not None:
+            embedding = lookup(text)
+            if embedding is not None:
+                return embedding
+
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _next_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = await loop.run_in_executor(
+                    self._executor, self.embedding_function, texts
+                )
+            except Exception as error:
+                logger.error(error)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+    async def stop(self) -> None:
+        """Stop the worker task and release the embedding thread."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._executor.shutdown(wait=True)
@@ -1,16 +1,24 @@
 # https://gist.github.com/jvelezmagic/03ddf4c452d011aae36b2a0f73d72f68
 
-from typing import Any, Union
+from typing import Any, AsyncIterator, List, Tuple, Union
+import asyncio
+import codecs
+import logging
 import random
 import tiktoken
 from pathlib import Path
 from dotenv import load_dotenv
 
 # from langchain_community.chat_message_histories import PostgresChatMessageHistory
+from langchain_community.callbacks.openai_info import (
+    get_openai_token_cost_for_model,
+)
+from langchain_core.messages import BaseMessage
 from langchain_openai import AzureChatOpenAI, ChatOpenAI
 from langchain.prompts import (
     ChatPromptTemplate,
     HumanMessagePromptTemplate,
+    MessagesPlaceholder,
     SystemMessagePromptTemplate,
 )
 
@@ -36,6 +44,8 @@ from rag.chatbot.dummy_answer import (
     ANSWER_14,
 )
 
+logger = logging.getLogger(__name__)
+
 
 class LangChainChatbot:
     """
@@ -113,6 +123,8 @@ class LangChainChatbot:
         return ChatPromptTemplate(
             messages=[
                 SystemMessagePromptTemplate.from_template(SYSTEM_MESSAGE),
+                # The messages of the history, as chat messages
+                MessagesPlaceholder(variable_name="chat_history"),
                 HumanMessagePromptTemplate.from_template(HUMAN_MESSAGE),
             ]
         )
@@ -128,9 +140,92 @@ class LangChainChatbot:
         return chatbot_instance.prompt | chatbot_instance.llm
 
 
+def token_costs(
+    llm: ChatOpenAI, prompt_tokens: int, completion_tokens: int
+) -> Tuple[float, float]:
+    """
+    Cost of the prompt and of the completion tokens at the prices of the model.
+
+    :param llm: The language model that generated the answer.
+    :param prompt_tokens: The tokens of the prompt.
+    :param completion_tokens: The tokens of the answer.
+    :return: The cost of the prompt and the cost of the completion, both 0 when
+        the price of the model is unknown.
+    """
+    try:
+        return (
+            get_openai_token_cost_for_model(llm.model_name, prompt_tokens),
+            get_openai_token_cost_for_model(
+                llm.model_name, completion_tokens, is_completion=True
+            ),
+        )
+    except ValueError as error:
+        # Unknown model, e.g. an Azure deployment name
+        logger.warning(error)
+        return 0.0, 0.0
+
+
+def split_cost(
+    llm: ChatOpenAI, total_cost: float, prompt_tokens: int, completion_tokens: int
+) -> Tuple[float, float]:
+    """
+    Split the total cost reported by the OpenAI callback between the prompt and
+    the completion, in proportion of their prices.
+
+    The two parts always add up to `total_cost`: when the price of the model is
+    unknown, the whole cost goes to the completion.
+
+    :param llm: The language model that generated the answer.
+    :param total_cost: The cost of the call.
+    :param prompt_tokens: The tokens of the prompt.
+    :param completion_tokens: The tokens of the answer.
+    :return: The cost of the prompt and the cost of the completion.
+    """
+    prompt_cost, completion_cost = token_costs(llm, prompt_tokens, completion_tokens)
+    if prompt_cost + completion_cost <= 0:
+        return 0.0, total_cost
+    prompt_cost = total_cost * prompt_cost / (prompt_cost + completion_cost)
+    return prompt_cost, total_cost - prompt_cost
+
+
+def stream_usage(
+    llm: ChatOpenAI, prompt_messages: List[BaseMessage], answer: str
+) -> dict:
+    """
+    Token counts and cost of a streamed answer.
+
+    The OpenAI callback does not see the token usage of streamed responses, so
+    the tokens of the prompt and of the answer are counted with tiktoken.
+
+    :param llm: The language model that generated the answer.
+    :param prompt_messages: The messages sent to the model.
+    :param answer: The full streamed answer.
+    :return: Dictionary with the prompt, completion and total tokens and the
+        prompt, completion and total cost.
+    """
+    prompt_tokens = llm.get_num_tokens_from_messages(prompt_messages)
+    completion_tokens = llm.get_num_tokens(answer)
+    prompt_cost, completion_cost = token_costs(llm, prompt_tokens, completion_tokens)
+
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_cost": prompt_cost,
+        "completion_cost": completion_cost,
+        "total_cost": prompt_cost + completion_cost,
+    }
+
+
 class DummyConversation:
-    def __init__(self, model):
+    def __init__(self, model, stream_delay: float = 0.0):
+        """
+        :param model: The model whose tokenizer counts the tokens.
+        :param stream_delay: Seconds to wait before each streamed token, to
+            simulate the generation speed of the model.
+        """
         self.encoding = tiktoken.encoding_for_model(model)
+        self.stream_delay = stream_delay
         self.total_tokens = 0
         self.list_answer = [
             ANSWER_1,
@@ -172,3 +267,19 @@ class DummyConversation:
             "prompt_tokens": prompt_tokens,
             "completion_tokens": completion_tokens,
         }
+
+    async def astream(self, text: str) -> AsyncIterator[str]:
+        """
+        Streaming mode: yields the answer one token at a time.
+
+        :param text: The question, unused as the answers are canned.
+        """
+        response = self.response()
+        # A token can end in the middle of a multi-byte character
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for token in self.encoding.encode(response):
+            if self.stream_delay:
+                await asyncio.sleep(self.stream_delay)
+            chunk = decoder.decode(self.encoding.decode_single_token_bytes(token))
+            if chunk:
+                yield chunk
@@ -0,0 +1,248 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+import tiktoken
+from langchain_core.messages import BaseMessage
+
+from rag.chatbot.templates import HUMAN_MESSAGE, SYSTEM_MESSAGE
+from rag.config import PromptBudget
+
+logger = logging.getLogger(__name__)
+
+# Joins the package documents and the general conditions in the context
+GENERAL_CONDITION_SEPARATOR = "\nThe insurance general condition:"
+# Tokens added by the chat format to each message, and to prime the answer
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+
+@dataclass
+class AssembledPrompt:
+    """The sections of the prompt, cut to the budget, and their tokens."""
+
+    package_documents: List[str]
+    general_condition: str
+    chat_history: List[BaseMessage]
+    tokens: Dict[str, int]
+    max_tokens: int
+    # Documents or messages left out of each section, and the sections cut
+    dropped: Dict[str, int] = field(default_factory=dict)
+    truncated: List[str] = field(default_factory=list)
+
+    @property
+    def context(self) -> str:
+        return (
+            "\n".join(self.package_documents)
+            + GENERAL_CONDITION_SEPARATOR
+            + self.general_condition
+        )
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(self.tokens.values())
+
+    def breakdown(self) -> dict:
+        """Tokens per section, for the metadata of the response."""
+        return {
+            "sections": self.tokens,
+            "total": self.total_tokens,
+            "max_tokens": self.max_tokens,
+            "dropped": self.dropped,
+            "truncated": self.truncated,
+        }
+
+
+class PromptAssembler:
+    """Fits the sections of the prompt in `max_tokens` tokens, counted with
+    tiktoken.
+
+    The template, the question, the deductibles, the sums insured and the
+    summary of the conversation are always sent. What is left goes to the
+    package documents, then to the chat history, then to the general
+    conditions, each up to its own limit:
+
+    - the package documents, most relevant first, are kept whole while they
+      fit; the first one that does not is cut when at least
+      `min_chunk_tokens` are left, the less relevant ones are dropped;
+    - the oldest messages of the history are dropped first, each message
+      counts its content and the `TOKENS_PER_MESSAGE` of the chat format;
+    - the general conditions are cut at the end.
+
+    A `max_tokens` of 0 keeps every section whole, their tokens are still
+    reported.
+    """
+
+    def __init__(
+        self,
+        encoding: tiktoken.Encoding,
+        max_tokens: int = 6000,
+        package_documents_tokens: int = 2000,
+        chat_history_tokens: int = 1000,
+        general_conditions_tokens: int = 3000,
+        min_chunk_tokens: int = 50,
+    ):
+        self.encoding = encoding
+        self.max_tokens = max_tokens
+        self.limits = {
+            "package_documents": package_documents_tokens,
+            "chat_history": chat_history_tokens,
+            "general_conditions": general_conditions_tokens,
+        }
+        self.min_chunk_tokens = min_chunk_tokens
+        self.template_tokens = (
+            self.count(
+                SYSTEM_MESSAGE.format(
+                    deductible="",
+                    sum_insured="",
+                    context=GENERAL_CONDITION_SEPARATOR,
+                    summary="",
+                )
+            )
+            + self.count(HUMAN_MESSAGE.format(question=""))
+            + 2 * TOKENS_PER_MESSAGE
+            + TOKENS_PER_REPLY
+        )
+
+    @classmethod
+    def from_config(
+        cls, config: PromptBudget, model_name: Optional[str] = None
+    ) -> "PromptAssembler":
+        """The budget of `config`, counting the tokens with the encoding of
+        `model_name`."""
+        return cls(
+            encoding_for_model(model_name),
+            max_tokens=config.MAX_TOKENS,
+            package_documents_tokens=config.PACKAGE_DOCUMENTS_TOKENS,
+            chat_history_tokens=config.CHAT_HISTORY_TOKENS,
+            general_conditions_tokens=config.GENERAL_CONDITIONS_TOKENS,
+            min_chunk_tokens=config.MIN_CHUNK_TOKENS,
+        )
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoding.decode(tokens[: max(max_tokens, 0)])
+
+    def _limit(self, section: str, left: int) -> float:
+        if not self.max_tokens:
+            return float("inf")
+        return max(min(self.limits[section], left), 0)
+
+    def _fit_documents(self, documents: Sequence[str], limit: int, prompt) -> int:
+        used = 0
+        for document in documents:
+            # The documents are joined by a newline
+            separator = 1 if prompt.package_documents else 0
+            tokens = self.count(document) + separator
+            if used + tokens > limit:
+                left = limit - used - separator
+                if left >= self.min_chunk_tokens:
+                    prompt.package_documents.append(self.truncate(document, left))
+                    prompt.truncated.append("package_documents")
+                break
+            prompt.package_documents.append(document)
+            used += tokens
+
+        dropped = len(documents) - len(prompt.package_documents)
+        if dropped:
+            prompt.dropped["package_documents"] = dropped
+        return self.count("\n".join(prompt.package_documents))
+
+    def count_message(self, message: BaseMessage) -> int:
+        """Tokens of a message of the history, sent as a chat message."""
+        return self.count(message.content) + TOKENS_PER_MESSAGE
+
+    def _fit_history(self, chat_history: Sequence[BaseMessage], limit: int, prompt):
+        kept: List[BaseMessage] = []
+        used = 0
+        for message in reversed(chat_history):
+            tokens = self.count_message(message)
+            if used + tokens > limit:
+                break
+            kept.append(message)
+            used += tokens
+        kept.reverse()
+        prompt.chat_history = kept
+        if len(kept) < len(chat_history):
+            prompt.dropped["chat_history"] = len(chat_history) - len(kept)
+        return used
+
+    def assemble(
+        self,
+        question: str,
+        deductible: str,
+        sum_insured: str,
+        package_documents: Sequence[str],
+        general_condition: str,
+        chat_history: Sequence[BaseMessage],
+        summary: str = "",
+    ) -> AssembledPrompt:
+        """Cut the sections of the prompt to the budget.
+
+        Args:
+            package_documents (Sequence[str]): the documents of the packages of
+            the user, most relevant first.
+            chat_history (Sequence[BaseMessage]): the messages of the history,
+            oldest first.
+            summary (str): the summary of the messages before `chat_history`.
+        """
+        prompt = AssembledPrompt(
+            package_documents=[],
+            general_condition="",
+            chat_history=[],
+            tokens={
+                "template": self.template_tokens,
+                "question": self.count(question),
+                "deductible": self.count(str(deductible)),
+                "sum_insured": self.count(str(sum_insured)),
+                "summary": self.count(summary),
+            },
+            max_tokens=self.max_tokens,
+        )
+        left = self.max_tokens - sum(prompt.tokens.values())
+        if self.max_tokens and left < 0:
+            logger.warning(
+                "The fixed sections of the prompt take %d tokens, over the "
+                "budget of %d",
+                self.max_tokens - left,
+                self.max_tokens,
+            )
+
+        used = self._fit_documents(
+            package_documents, self._limit("package_documents", left), prompt
+        )
+        prompt.tokens["package_documents"] = used
+        left -= used
+
+        used = self._fit_history(
+            chat_history, self._limit("chat_history", left), prompt
+        )
+        prompt.tokens["chat_history"] = used
+        left -= used
+
+        limit = self._limit("general_conditions", left)
+        prompt.general_condition = (
+            general_condition
+            if limit == float("inf")
+            else self.truncate(general_condition, limit)
+        )
+        if prompt.general_condition != general_condition:
+            prompt.truncated.append("general_conditions")
+        prompt.tokens["general_conditions"] = self.count(prompt.general_condition)
+        return prompt
+
+
+def encoding_for_model(model_name: Optional[str] = None) -> tiktoken.Encoding:
+    """The tiktoken encoding of `model_name`, the one of the GPT-3.5 and GPT-4
+    models for unknown models, e.g. Azure deployment names."""
+    if model_name:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            logger.warning("No tiktoken encoding for %s, using cl100k_base", model_name)
+    return tiktoken.get_encoding("cl100k_base")
@@ -0,0 +1,266 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Optional, Sequence
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+
+from rag.cache import TTLCache
+from rag.config import PromptCache
+from rag.executor import run_blocking
+
+logger = logging.getLogger(__name__)
+
+
+class PromptCacheStats:
+    """Hit/miss counters and latencies of the backend of a
+    `PromptResponseCache`."""
+
+    def __init__(self, backend: str):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.errors = 0
+        self.gets = 0
+        self.get_time = 0.0
+        self.sets = 0
+        self.set_time = 0.0
+        self._lock = threading.Lock()
+
+    def record_get(self, elapsed: float, hit: bool) -> None:
+        with self._lock:
+            self.gets += 1
+            self.get_time += elapsed
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def record_set(self, elapsed: float) -> None:
+        with self._lock:
+            self.sets += 1
+            self.set_time += elapsed
+
+    def record_bypass(self) -> None:
+        with self._lock:
+            self.bypassed += 1
+
+    def to_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            # Models not at temperature 0, whose answers are not cached
+            "bypassed": self.bypassed,
+            "errors": self.errors,
+            "avg_get_ms": self.get_time / self.gets * 1000 if self.gets else 0.0,
+            "avg_set_ms": self.set_time / self.sets * 1000 if self.sets else 0.0,
+        }
+
+
+class MemoryPromptCacheBackend:
+    """In-memory LRU of the responses, per worker."""
+
+    name = "memory"
+    blocking = False
+
+    def __init__(self, max_size: int = 10000, ttl: float = 86400.0):
+        self.cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    def get(self, key: str) -> Optional[str]:
+        return self.cache.get(key)
+
+    def set(self, key: str, response: str) -> None:
+        self.cache.set(key, response)
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+    def close(self) -> None:
+        pass
+
+
+class SqlitePromptCacheBackend:
+    """Responses in a sqlite file, shared by the workers of a host and kept
+    across restarts."""
+
+    name = "sqlite"
+    blocking = True
+
+    def __init__(self, path: str, ttl: float = 86400.0):
+        self.ttl = ttl
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            # Several workers write to the file
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS prompt_responses "
+                "(key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "expires_at REAL NOT NULL)"
+            )
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response FROM prompt_responses "
+                "WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, response: str) -> None:
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO prompt_responses (key, response, expires_at) "
+                "VALUES (?, ?, ?)",
+                (key, response, now + self.ttl),
+            )
+            self._connection.execute(
+                "DELETE FROM prompt_responses WHERE expires_at <= ?", (now,)
+            )
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM prompt_responses")
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class RedisPromptCacheBackend:
+    """Responses in Redis, shared by every worker and host. Needs the `redis`
+    package, which is not a dependency of the app."""
+
+    name = "redis"
+    blocking = True
+
+    def __init__(
+        self, url: str, ttl: float = 86400.0, prefix: str = "prompt-response:"
+    ):
+        try:
+            import redis
+        except ImportError as error:
+            raise ImportError(
+                "The redis prompt cache needs the redis package: pip install redis"
+            ) from error
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[str]:
+        response = self.client.get(self.prefix + key)
+        return response.decode() if response is not None else None
+
+    def set(self, key: str, response: str) -> None:
+        self.client.set(self.prefix + key, response, ex=max(int(self.ttl), 1))
+
+    def clear(self) -> None:
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def close(self) -> None:
+        self.client.close()
+
+
+class PromptResponseCache:
+    """Exact-match cache of the responses of a chat model, keyed on the
+    rendered prompt messages and the model name.
+
+    Only the models at temperature 0 are cached, the others are bypassed, as
+    are all of them when there is no `backend`. The errors of the backend are
+    logged and counted, a request never fails because of the cache.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.stats = PromptCacheStats(backend.name if backend else None)
+
+    @classmethod
+    def from_config(cls, config: PromptCache) -> "PromptResponseCache":
+        """The cache of `config.BACKEND`, disabled when it is not set."""
+        if not config.BACKEND:
+            return cls()
+        if config.BACKEND == "memory":
+            backend = MemoryPromptCacheBackend(
+                max_size=config.CACHE_SIZE, ttl=config.CACHE_TTL
+            )
+        elif config.BACKEND == "sqlite":
+            backend = SqlitePromptCacheBackend(config.CACHE_PATH, ttl=config.CACHE_TTL)
+        elif config.BACKEND == "redis":
+            backend = RedisPromptCacheBackend(config.REDIS_URL, ttl=config.CACHE_TTL)
+        else:
+            raise ValueError(f"Unsupported prompt cache backend: {config.BACKEND}")
+        return cls(backend)
+
+    @staticmethod
+    def key(messages: Sequence[BaseMessage], model_name: str) -> str:
+        rendered = json.dumps(
+            [model_name, [[message.type, message.content] for message in messages]]
+        )
+        return hashlib.sha256(rendered.encode()).hexdigest()
+
+    @staticmethod
+    def model_name(llm: BaseChatModel) -> str:
+        # The deployment of an Azure model tells its version
+        return getattr(llm, "deployment_name", None) or llm.model_name
+
+    def _cacheable(self, llm: BaseChatModel) -> bool:
+        return self.backend is not None and getattr(llm, "temperature", None) == 0
+
+    async def _call(self, method, *args):
+        # sqlite and redis do I/O, keep them off the event loop
+        if self.backend.blocking:
+            return await run_blocking(method, *args)
+        return method(*args)
+
+    async def aget(
+        self, messages: Sequence[BaseMessage], llm: BaseChatModel
+    ) -> Optional[str]:
+        """The cached response of `llm` to `messages`, if any."""
+        if not self._cacheable(llm):
+            # Counted once per call, on the lookup that precedes its `aset`
+            if self.backend is not None:
+                self.stats.record_bypass()
+            return None
+        key = self.key(messages, self.model_name(llm))
+        start = time.perf_counter()
+        try:
+            response = await self._call(self.backend.get, key)
+        except Exception as error:
+            self.stats.errors += 1
+            logger.error("Prompt cache %s: %s", self.backend.name, error)
+            return None
+        self.stats.record_get(time.perf_counter() - start, response is not None)
+        return response
+
+    async def aset(
+        self, messages: Sequence[BaseMessage], llm: BaseChatModel, response: str
+    ) -> None:
+        """Cache the `response` of `llm` to `messages`."""
+        if not self._cacheable(llm):
+            return
+        key = self.key(messages, self.model_name(llm))
+        start = time.perf_counter()
+        try:
+            await self._call(self.backend.set, key, response)
+        except Exception as error:
+            self.stats.errors += 1
+            logger.error("Prompt cache %s: %s", self.backend.name, error)
+            return
+        self.stats.record_set(time.perf_counter() - start)
+
+    def close(self) -> None:
+        if self.backend is not None:
+            self.backend.close()
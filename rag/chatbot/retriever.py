@@ -1,13 +1,23 @@
 from __future__ import annotations
 
+import hashlib
+import json
+import logging
+import math
 import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
 import pandas as pd
 import chromadb
-from chromadb import Collection
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+from chromadb import ClientAPI, Collection, EmbeddingFunction
 from langchain_community.vectorstores import Chroma
 
 from rag.schema import InsuranceData
+from rag.executor import run_blocking
+from rag.chatbot.embeddings import EmbeddingBatcher
 
 from rag.constants import (
     COL_INDEX,
@@ -18,19 +28,50 @@ from rag.constants import (
     COL_ARTICLE,
     COL_COMPANY,
     COL_EMBEDDINGS,
+    GENERAL_CONDITION_CHECK_INTERVAL,
+    VECTOR_DB_BATCH_SIZE,
 )
 
+logger = logging.getLogger(__name__)
+
+METADATA_COLUMNS = [COL_TYPE, COL_CATEGORY, COL_PACKAGE, COL_ARTICLE, COL_COMPANY]
+# Metadata key of the hash of the content of a row
+CONTENT_HASH = "content_hash"
+# Metadata key of the collection set while a sync writes to it
+SYNC_IN_PROGRESS = "sync_in_progress"
+
 
 class VectorZurichChromaDbClient:
-    def __init__(self, retriever: Collection):
+    def __init__(
+        self,
+        retriever: Collection,
+        client: Optional[ClientAPI] = None,
+        embeddings: Optional[EmbeddingFunction] = None,
+        general_condition_check_interval: float = GENERAL_CONDITION_CHECK_INTERVAL,
+        embedding_batcher: Optional[EmbeddingBatcher] = None,
+    ):
         self.retriever = retriever
+        self.client = client
+        self.embeddings = embeddings
+        self.embedding_batcher = embedding_batcher
+
+        # General conditions per company (`None` for all companies). They only
+        # change when the collection is rebuilt, which is detected by comparing
+        # the collection version at most every `general_condition_check_interval`
+        # seconds.
+        self.general_condition_check_interval = general_condition_check_interval
+        self._general_conditions: Optional[Dict[Optional[str], str]] = None
+        self._general_condition_version = None
+        self._general_condition_checked_at = 0.0
+        self._general_condition_lock = threading.Lock()
 
     @classmethod
     def get_retriever(
         cls: VectorZurichChromaDbClient,
         db_path: str,
         collection_name: str,
-        embeddings: SentenceTransformerEmbeddingFunction,
+        embeddings: EmbeddingFunction,
+        embedding_batcher: Optional[EmbeddingBatcher] = None,
     ) -> VectorZurichChromaDbClient:
 
         client = chromadb.PersistentClient(path=db_path)
@@ -38,27 +79,168 @@ class VectorZurichChromaDbClient:
             name=collection_name, embedding_function=embeddings
         )
 
-        return cls(retriever)
+        vector_client = cls(
+            retriever,
+            client=client,
+            embeddings=embeddings,
+            embedding_batcher=embedding_batcher,
+        )
+        # Warm the cache so the first request does not scan the collection
+        vector_client.reload_general_condition()
+        return vector_client
 
     def get_zurich_package_info(
         self, filter_packages: dict, top_k: int, user_question: str
     ) -> str:
+        return self._query_package_info(
+            filter_packages, top_k, self._question(user_question)
+        )
+
+    def _question(self, user_question: str) -> dict:
+        if self.embeddings is not None:
+            # Embed through `self.embeddings`, which may be cached
+            return {"query_embeddings": self.embeddings([user_question])}
+        return {"query_texts": user_question}
+
+    def _package_documents(
+        self, filter_packages: dict, top_k: int, user_question: str
+    ) -> Tuple[List[str], List[str]]:
+        return self._query_package_documents(
+            filter_packages, top_k, self._question(user_question)
+        )
+
+    async def aembed_question(self, user_question: str) -> List[float]:
+        """Embed the question as `aget_zurich_package_info` does, so that the
+        embedding is cached for it by `embeddings`."""
+        if self.embedding_batcher is not None:
+            return await self.embedding_batcher.embed(user_question)
+        return (await run_blocking(self.embeddings, [user_question]))[0]
+
+    async def aget_zurich_package_info(
+        self, filter_packages: dict, top_k: int, user_question: str
+    ) -> str:
+        """Async `get_zurich_package_info`. The question is embedded by the
+        `embedding_batcher`, together with the concurrent questions, when one
+        is set."""
+        documents, ids = await self.aget_zurich_package_documents(
+            filter_packages, top_k, user_question
+        )
+        return "\n".join(documents), ids
+
+    async def aget_zurich_package_documents(
+        self, filter_packages: dict, top_k: int, user_question: str
+    ) -> Tuple[List[str], List[str]]:
+        """The documents of `aget_zurich_package_info` and their ids, most
+        relevant first, before they are joined."""
+        if self.embedding_batcher is None:
+            return await run_blocking(
+                self._package_documents, filter_packages, top_k, user_question
+            )
+
+        embedding = await self.embedding_batcher.embed(user_question)
+        return await run_blocking(
+            self._query_package_documents,
+            filter_packages,
+            top_k,
+            {"query_embeddings": [embedding]},
+        )
+
+    def _query_package_documents(
+        self, filter_packages: dict, top_k: int, question: dict
+    ) -> Tuple[List[str], List[str]]:
         data_retriever = self.retriever.query(
-            query_texts=user_question, n_results=top_k, where=filter_packages
+            n_results=top_k, where=filter_packages, **question
         )
-        
-        list_ids_retriever = data_retriever.get("ids")[0]
-        list_documents_retriver = data_retriever.get("documents")[0]
-        
-        data_string_document = "\n".join(list_documents_retriver)
+        return data_retriever.get("documents")[0], data_retriever.get("ids")[0]
+
+    def _query_package_info(
+        self, filter_packages: dict, top_k: int, question: dict
+    ) -> str:
+        documents, ids = self._query_package_documents(
+            filter_packages, top_k, question
+        )
+        return "\n".join(documents), ids
+
+    def get_zurich_general_condition(self, company: Optional[str] = None) -> str:
+        """Return the general conditions, loaded from the collection only when
+        the cache is empty or the collection changed.
+
+        Args:
+            company (str): only return the general conditions of this company.
+            Defaults to `None`, which returns the general conditions of all the
+            companies.
+        """
+        with self._general_condition_lock:
+            now = time.monotonic()
+            if (
+                now - self._general_condition_checked_at
+                >= self.general_condition_check_interval
+            ):
+                self._general_condition_checked_at = now
+                if self._collection_version() != self._general_condition_version:
+                    self._general_conditions = None
 
-        return data_string_document, list_ids_retriever
+            if self._general_conditions is None:
+                self._load_general_conditions()
 
-    def get_zurich_general_condition(self):
+            return self._general_conditions.get(company, "")
+
+    def reload_general_condition(self) -> None:
+        """Reload the general conditions, e.g. after rebuilding the collection."""
+        with self._general_condition_lock:
+            self._general_condition_checked_at = time.monotonic()
+            self._load_general_conditions()
+
+    def _collection_version(self) -> tuple:
+        collection = self.retriever
+        if self.client is not None:
+            # `self.retriever.metadata` is a snapshot taken when the collection
+            # was opened, read the current one
+            collection = self.client.get_collection(
+                name=self.retriever.name, embedding_function=self.embeddings
+            )
+        return collection.count(), (collection.metadata or {}).get("version")
+
+    def _load_general_conditions(self) -> None:
+        self._general_condition_version = self._collection_version()
         general_condition_retriever = self.retriever.get(
-            where={"mapping_package": {"$eq": [0]}}
+            where={"mapping_package": {"$eq": [0]}},
+            include=["documents", "metadatas"],
+        )
+        documents = general_condition_retriever.get("documents")
+        metadatas = general_condition_retriever.get("metadatas") or [{}] * len(
+            documents
         )
-        return "\n".join(general_condition_retriever.get("documents"))
+
+        documents_per_company: Dict[Optional[str], List[str]] = {None: documents}
+        for document, metadata in zip(documents, metadatas):
+            company = (metadata or {}).get(COL_COMPANY)
+            documents_per_company.setdefault(company, []).append(document)
+
+        self._general_conditions = {
+            company: "\n".join(company_documents)
+            for company, company_documents in documents_per_company.items()
+        }
+
+
+@dataclass
+class IngestionReport:
+    """Rows of the source added, updated, deleted and left unchanged in the
+    collection by `VectorDBCreator.sync_insurance_data_to_collection`."""
+
+    added: int = 0
+    updated: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.added or self.updated or self.deleted)
+
+
+def _batches(items: Sequence, size: int) -> Iterator[Sequence]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
 
 
 class VectorDBCreator:
@@ -100,28 +282,193 @@ class VectorDBCreator:
 
     @classmethod
     def create_collection_from_excel(
-        cls, db_path: str, collection_name: str, filepath: str
-    ):
-        """Creates a collection from an Excel file."""
+        cls,
+        db_path: str,
+        collection_name: str,
+        filepath: str,
+        batch_size: int = VECTOR_DB_BATCH_SIZE,
+    ) -> IngestionReport:
+        """Creates or updates a collection from an Excel file, see
+        `sync_insurance_data_to_collection`."""
         df = pd.read_excel(filepath)
         validated_df = cls.validate_dataframe(df)
         creator = cls(db_path, collection_name)
         creator.initialize_collection()
-        creator.add_insurance_data_to_collection(validated_df)
+        return creator.sync_insurance_data_to_collection(
+            validated_df, batch_size=batch_size
+        )
 
     def initialize_collection(self):
         """Initializes the collection in ChromaDB."""
-        if self.collection_name not in self._chroma_client.list_collections():
-            self._chroma_client.create_collection(self.collection_name)
+        self._chroma_client.get_or_create_collection(self.collection_name)
 
-    def add_insurance_data_to_collection(self, df: pd.DataFrame):
-        """Adds insurance data to the collection."""
-        collection = self._chroma_client.get_collection(self.collection_name)
-        collection.add(
-            ids=df[COL_INDEX].tolist(),
-            embeddings=df[COL_EMBEDDINGS].tolist(),
-            metadatas=df[
-                [COL_TYPE, COL_CATEGORY, COL_PACKAGE, COL_ARTICLE, COL_COMPANY]
-            ].to_dict("records"),
-            documents=df[COL_TEXT].tolist(),
+    def _batch_size(self, batch_size: int) -> int:
+        return max(min(batch_size, self._chroma_client.max_batch_size), 1)
+
+    @staticmethod
+    def _records(df: pd.DataFrame) -> Dict[str, dict]:
+        """The ids, documents, metadatas and embeddings of the rows, with the
+        hash of their content in the metadata."""
+        duplicated = df[COL_INDEX][df[COL_INDEX].duplicated()]
+        if not duplicated.empty:
+            raise ValueError(f"Duplicated {COL_INDEX}: {duplicated.tolist()}")
+
+        records = {}
+        missing = []
+        for row in df.to_dict("records"):
+            metadata = {column: row[column] for column in METADATA_COLUMNS}
+            embedding = VectorDBCreator._embedding(row.get(COL_EMBEDDINGS))
+            if embedding is None:
+                missing.append(row[COL_INDEX])
+                continue
+            content = json.dumps(
+                [row[COL_TEXT], metadata, embedding], sort_keys=True, default=str
+            )
+            metadata[CONTENT_HASH] = hashlib.sha256(content.encode()).hexdigest()
+            records[str(row[COL_INDEX])] = {
+                "document": row[COL_TEXT],
+                "metadata": metadata,
+                "embedding": embedding,
+            }
+
+        # Chroma would embed the rows without embeddings with its default
+        # model, not the model of the questions
+        if missing:
+            raise ValueError(
+                f"Missing or invalid {COL_EMBEDDINGS} of {COL_INDEX}: {missing}"
+            )
+        return records
+
+    @staticmethod
+    def _embedding(value) -> Optional[List[float]]:
+        """The embedding of a cell, `None` when it is missing or not a list of
+        finite numbers."""
+        if isinstance(value, str):
+            # A list stored in a cell of the Excel file
+            try:
+                value = json.loads(value)
+            except ValueError:
+                return None
+        if value is None or isinstance(value, (float, int)):
+            # An empty cell is read as NaN
+            return None
+        try:
+            embedding = [float(number) for number in value]
+        except (TypeError, ValueError):
+            return None
+        if not embedding or not all(math.isfinite(number) for number in embedding):
+            return None
+        return embedding
+
+    @staticmethod
+    def _write(collection: Collection, method: str, ids: Sequence[str], records):
+        rows = [records[row_id] for row_id in ids]
+        getattr(collection, method)(
+            ids=list(ids),
+            documents=[row["document"] for row in rows],
+            metadatas=[row["metadata"] for row in rows],
+            embeddings=[row["embedding"] for row in rows],
+        )
+
+    def _content_hashes(self, collection: Collection, batch_size: int) -> dict:
+        hashes = {}
+        offset = 0
+        while True:
+            result = collection.get(
+                include=["metadatas"], limit=batch_size, offset=offset
+            )
+            for row_id, metadata in zip(result["ids"], result["metadatas"]):
+                hashes[row_id] = (metadata or {}).get(CONTENT_HASH)
+            if len(result["ids"]) < batch_size:
+                return hashes
+            offset += batch_size
+
+    def sync_insurance_data_to_collection(
+        self, df: pd.DataFrame, batch_size: int = VECTOR_DB_BATCH_SIZE
+    ) -> IngestionReport:
+        """Makes the collection hold the rows of `df`, keyed on their `index`.
+
+        The hash of the content of each row (text, metadata and embedding) is
+        stored in its metadata: only the new rows and the rows whose hash
+        changed are upserted, and the rows no longer in `df` are deleted, each
+        in batches of at most `batch_size` rows. Running it again is a no-op,
+        and as every batch stores the hashes of its rows, a run interrupted
+        midway resumes where it stopped. The version of the collection is
+        bumped once the collection changed; the collection is marked while a
+        sync writes to it, so that the run resuming an interrupted one bumps
+        it too.
+
+        Every row needs its embedding, computed with the model of the
+        questions: a `ValueError` names the rows whose embedding is missing.
+        """
+        batch_size = self._batch_size(batch_size)
+        collection = self._chroma_client.get_or_create_collection(
+            self.collection_name
+        )
+        records = self._records(df)
+        stored = self._content_hashes(collection, batch_size)
+
+        added = [row_id for row_id in records if row_id not in stored]
+        updated = [
+            row_id
+            for row_id, row in records.items()
+            if row_id in stored and stored[row_id] != row["metadata"][CONTENT_HASH]
+        ]
+        deleted = [row_id for row_id in stored if row_id not in records]
+        report = IngestionReport(
+            added=len(added),
+            updated=len(updated),
+            deleted=len(deleted),
+            unchanged=len(records) - len(added) - len(updated),
         )
+
+        # A run interrupted after writing left the marker, without bumping the
+        # version: bump it now even if nothing is left to write
+        interrupted = bool((collection.metadata or {}).get(SYNC_IN_PROGRESS))
+        upserts = added + updated
+        if upserts or deleted:
+            self._set_metadata(collection, {SYNC_IN_PROGRESS: True})
+        for done, ids in enumerate(_batches(upserts, batch_size), start=1):
+            self._write(collection, "upsert", ids, records)
+            logger.info(
+                "Upserted %d/%d rows",
+                min(done * batch_size, len(upserts)),
+                len(upserts),
+            )
+        for ids in _batches(deleted, batch_size):
+            collection.delete(ids=list(ids))
+        if report.changed or interrupted:
+            self.bump_collection_version(collection)
+        logger.info("Synced %s: %s", self.collection_name, report)
+        return report
+
+    def add_insurance_data_to_collection(
+        self, df: pd.DataFrame, batch_size: int = VECTOR_DB_BATCH_SIZE
+    ):
+        """Adds insurance data to the collection, in batches of at most
+        `batch_size` rows."""
+        collection = self._chroma_client.get_collection(self.collection_name)
+        records = self._records(df)
+        for ids in _batches(list(records), self._batch_size(batch_size)):
+            self._write(collection, "add", ids, records)
+        self.bump_collection_version(collection)
+
+    @staticmethod
+    def _set_metadata(collection: Collection, values: dict):
+        metadata = {
+            key: value
+            for key, value in (collection.metadata or {}).items()
+            if key != SYNC_IN_PROGRESS
+        }
+        metadata.update(values)
+        # The metadata is replaced as a whole, and `Collection.modify` refuses
+        # `hnsw:space` even unchanged: write it through the client so that the
+        # collection keeps the distance it was created with
+        collection._client._modify(id=collection.id, new_metadata=metadata)
+        collection.metadata = metadata
+
+    @staticmethod
+    def bump_collection_version(collection: Collection):
+        """Mark the collection as changed so the readers reload their caches,
+        and clear the marker of a sync in progress."""
+        VectorDBCreator._set_metadata(collection, {"version": time.time_ns()})
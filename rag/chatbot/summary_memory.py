@@ -0,0 +1,134 @@
+import logging
+from typing import Callable, List, Optional, Set, Tuple
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+from rag.chatbot.memory import PostgresChatMessageHistory
+from rag.chatbot.templates import SUMMARY_MESSAGE
+from rag.config import SummaryMemory
+
+logger = logging.getLogger(__name__)
+
+ROLES = {"human": "Utilisateur", "ai": "Assistant"}
+
+# Conversations whose summary this worker is updating. It only saves the
+# duplicate model calls of one worker: the workers are kept from overwriting
+# a newer summary by the conditional update of
+# `PostgresChatMessageHistory.aupdate_summary`
+_summarizing: Set[str] = set()
+
+
+class ConversationSummaryBufferMemory:
+    """History of a conversation for the prompt: a rolling summary of its
+    older messages, stored with the conversation, and the messages after it.
+
+    `aload` reads the summary and at most `max_messages` messages after it in
+    one query, however long the conversation. Once the messages after the
+    summary take more than `max_tokens` tokens, counted by `count_tokens`,
+    `aupdate_summary` folds all but the last `max_turns` questions and answers
+    into the summary with the model. Run it in the background, after the turn
+    is stored.
+    """
+
+    def __init__(
+        self,
+        history: PostgresChatMessageHistory,
+        count_tokens: Callable[[str], int],
+        max_turns: int = 2,
+        max_tokens: int = 1000,
+        max_messages: int = 50,
+        summary_max_tokens: int = 300,
+    ):
+        if max_turns < 1:
+            raise ValueError("max_turns must be at least 1")
+        self.history = history
+        self.count_tokens = count_tokens
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        self.summary_max_tokens = summary_max_tokens
+        self.summary: Optional[str] = None
+        self._records: List[Tuple[int, BaseMessage]] = []
+
+    @classmethod
+    def from_config(
+        cls,
+        history: PostgresChatMessageHistory,
+        count_tokens: Callable[[str], int],
+        config: SummaryMemory,
+    ) -> "ConversationSummaryBufferMemory":
+        return cls(
+            history,
+            count_tokens,
+            max_turns=config.MAX_TURNS,
+            max_tokens=config.MAX_TOKENS,
+            max_messages=config.MAX_MESSAGES,
+            summary_max_tokens=config.SUMMARY_MAX_TOKENS,
+        )
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        """The messages after the summary, oldest first."""
+        return [message for _, message in self._records]
+
+    async def aload(self) -> "ConversationSummaryBufferMemory":
+        self.summary, self._records = await self.history.aget_summary_buffer(
+            self.max_messages
+        )
+        return self
+
+    def _to_summarize(
+        self, question: str, answer: str
+    ) -> List[Tuple[int, BaseMessage]]:
+        messages = [
+            *self.messages,
+            HumanMessage(content=question),
+            AIMessage(content=answer),
+        ]
+        tokens = sum(self.count_tokens(message.content) for message in messages)
+        if tokens <= self.max_tokens:
+            return []
+        # The new turn is one of the turns kept
+        kept = 2 * (self.max_turns - 1)
+        return self._records[: max(len(self._records) - kept, 0)]
+
+    async def aupdate_summary(
+        self, llm: BaseChatModel, question: str, answer: str
+    ) -> bool:
+        """Fold the older messages into the summary when the messages after
+        it, with the new `question` and `answer`, are over `max_tokens`.
+
+        Several workers may summarize the same messages concurrently, the
+        stored summary is only replaced by one of later messages.
+
+        Returns:
+            bool: whether a new summary was stored.
+        """
+        records = self._to_summarize(question, answer)
+        conversation_uuid = self.history.conversation_uuid
+        # Another request of the conversation is already summarizing in this
+        # worker
+        if not records or conversation_uuid in _summarizing:
+            return False
+
+        _summarizing.add(conversation_uuid)
+        try:
+            new_lines = "\n".join(
+                f"{ROLES.get(message.type, message.type)}: {message.content}"
+                for _, message in records
+            )
+            prompt = SUMMARY_MESSAGE.format(
+                summary=self.summary or "", new_lines=new_lines
+            )
+            response = await llm.bind(max_tokens=self.summary_max_tokens).ainvoke(
+                [HumanMessage(content=prompt)]
+            )
+            return await self.history.aupdate_summary(
+                response.content.strip(), records[-1][0]
+            )
+        except Exception:
+            logger.exception("Could not summarize conversation %s", conversation_uuid)
+            return False
+        finally:
+            _summarizing.discard(conversation_uuid)
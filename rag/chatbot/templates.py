@@ -22,8 +22,20 @@ Somme Assurée:
 Contexte de la demande :
 {context}
 
-Historique de la conversation :
-{chat_history}
+Résumé du début de la conversation :
+{summary}
 """
 
 HUMAN_MESSAGE = """Question: {question}"""
+
+SUMMARY_MESSAGE = """
+Résume progressivement la conversation entre un utilisateur et un spécialiste en assurances, en ajoutant les nouveaux messages au résumé existant. Garde les faits utiles pour répondre aux questions suivantes : l'événement décrit par l'utilisateur, les biens concernés, les couvertures, franchises et sommes assurées évoquées, et les réponses déjà données. Réponds uniquement avec le nouveau résumé, en quelques phrases.
+
+Résumé existant :
+{summary}
+
+Nouveaux messages :
+{new_lines}
+
+Nouveau résumé :
+"""
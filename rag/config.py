@@ -123,3 +123,245 @@ class Postgres:
             return f"postgresql://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@{self.POSTGRES_SERVER}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
         else:
             return f"postgresql://{self.POSTGRES_SERVER}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
+
+
+@dataclass
+class PostgresPool:
+    POOL_MIN_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("POSTGRES_POOL_MIN_SIZE", "1"))
+    )
+    POOL_MAX_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("POSTGRES_POOL_MAX_SIZE", "10"))
+    )
+    POOL_TIMEOUT: float = field(
+        default_factory=lambda: float(os.getenv("POSTGRES_POOL_TIMEOUT", "30"))
+    )
+    POOL_MAX_LIFETIME: float = field(
+        default_factory=lambda: float(os.getenv("POSTGRES_POOL_MAX_LIFETIME", "3600"))
+    )
+    POOL_MAX_IDLE: float = field(
+        default_factory=lambda: float(os.getenv("POSTGRES_POOL_MAX_IDLE", "600"))
+    )
+
+    @property
+    def pool_kwargs(self) -> dict:
+        """Keyword arguments shared by the sync and async psycopg pools."""
+        return {
+            "min_size": self.POOL_MIN_SIZE,
+            "max_size": self.POOL_MAX_SIZE,
+            "timeout": self.POOL_TIMEOUT,
+            "max_lifetime": self.POOL_MAX_LIFETIME,
+            "max_idle": self.POOL_MAX_IDLE,
+        }
+
+
+@dataclass
+class DatabasePool:
+    POOL_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("SQLALCHEMY_POOL_SIZE", "5"))
+    )
+    MAX_OVERFLOW: int = field(
+        default_factory=lambda: int(os.getenv("SQLALCHEMY_MAX_OVERFLOW", "10"))
+    )
+    POOL_TIMEOUT: float = field(
+        default_factory=lambda: float(os.getenv("SQLALCHEMY_POOL_TIMEOUT", "30"))
+    )
+    POOL_RECYCLE: int = field(
+        default_factory=lambda: int(os.getenv("SQLALCHEMY_POOL_RECYCLE", "1800"))
+    )
+    POOL_PRE_PING: bool = field(
+        default_factory=lambda: os.getenv("SQLALCHEMY_POOL_PRE_PING", "true").lower()
+        in ("1", "true", "yes")
+    )
+
+    @property
+    def engine_kwargs(self) -> dict:
+        """Keyword arguments for `create_async_engine`."""
+        return {
+            "pool_size": self.POOL_SIZE,
+            "max_overflow": self.MAX_OVERFLOW,
+            "pool_timeout": self.POOL_TIMEOUT,
+            "pool_recycle": self.POOL_RECYCLE,
+            "pool_pre_ping": self.POOL_PRE_PING,
+        }
+
+
+@dataclass
+class BlockingExecutor:
+    MAX_WORKERS: int = field(
+        default_factory=lambda: int(os.getenv("BLOCKING_EXECUTOR_MAX_WORKERS", "8"))
+    )
+
+
+@dataclass
+class EmbeddingCache:
+    CACHE_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+    )
+    # sqlite file of the on-disk tier, memory only when not set
+    CACHE_PATH: str = field(default_factory=lambda: os.getenv("EMBEDDING_CACHE_PATH"))
+
+
+@dataclass
+class EmbeddingBatching:
+    MAX_WAIT_MS: float = field(
+        default_factory=lambda: float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "5"))
+    )
+    MAX_BATCH_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))
+    )
+
+
+@dataclass
+class EmbeddingSidecar:
+    # Unix socket of the embedding sidecar, the model is loaded by each worker
+    # when not set
+    SOCKET_PATH: str = field(default_factory=lambda: os.getenv("EMBEDDING_SOCKET_PATH"))
+    TIMEOUT: float = field(
+        default_factory=lambda: float(os.getenv("EMBEDDING_SOCKET_TIMEOUT", "30"))
+    )
+
+
+@dataclass
+class PackageCache:
+    CACHE_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("PACKAGE_CACHE_SIZE", "10000"))
+    )
+    CACHE_TTL: float = field(
+        default_factory=lambda: float(os.getenv("PACKAGE_CACHE_TTL", "300"))
+    )
+
+
+@dataclass
+class OwnershipCache:
+    CACHE_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("OWNERSHIP_CACHE_SIZE", "10000"))
+    )
+    CACHE_TTL: float = field(
+        default_factory=lambda: float(os.getenv("OWNERSHIP_CACHE_TTL", "300"))
+    )
+
+
+@dataclass
+class Startup:
+    # Comma-separated names of the resources initialized on first use instead
+    # of at startup, e.g. "vector_store,llm"
+    LAZY_RESOURCES: frozenset = field(
+        default_factory=lambda: frozenset(
+            name.strip()
+            for name in os.getenv("STARTUP_LAZY_RESOURCES", "").split(",")
+            if name.strip()
+        )
+    )
+    # Serve while the resources warm up, /health/ready answers 503 until then
+    IN_BACKGROUND: bool = field(
+        default_factory=lambda: os.getenv("STARTUP_IN_BACKGROUND", "false").lower()
+        in ("1", "true", "yes")
+    )
+
+
+@dataclass
+class AnswerCache:
+    # Number of answers kept, 0 disables the cache
+    CACHE_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("ANSWER_CACHE_SIZE", "10000"))
+    )
+    CACHE_TTL: float = field(
+        default_factory=lambda: float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+    )
+    # Minimal cosine similarity of the questions
+    THRESHOLD: float = field(
+        default_factory=lambda: float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+    )
+    # Questions asked before in the conversation for the cache to be used
+    MAX_HISTORY: int = field(
+        default_factory=lambda: int(os.getenv("ANSWER_CACHE_MAX_HISTORY", "0"))
+    )
+    # sqlite file keeping the answers across restarts, memory only when not set
+    CACHE_PATH: str = field(default_factory=lambda: os.getenv("ANSWER_CACHE_PATH"))
+
+
+@dataclass
+class PromptCache:
+    # memory, sqlite or redis, no cache when empty
+    BACKEND: str = field(
+        default_factory=lambda: os.getenv("PROMPT_CACHE_BACKEND", "memory")
+    )
+    CACHE_SIZE: int = field(
+        default_factory=lambda: int(os.getenv("PROMPT_CACHE_SIZE", "10000"))
+    )
+    CACHE_TTL: float = field(
+        default_factory=lambda: float(os.getenv("PROMPT_CACHE_TTL", "86400"))
+    )
+    CACHE_PATH: str = field(
+        default_factory=lambda: os.getenv("PROMPT_CACHE_PATH", "prompt_cache.sqlite")
+    )
+    REDIS_URL: str = field(
+        default_factory=lambda: os.getenv(
+            "PROMPT_CACHE_REDIS_URL", "redis://localhost:6379/0"
+        )
+    )
+
+
+@dataclass
+class PromptBudget:
+    # Tokens of the prompt sent to the model, 0 disables the budget
+    MAX_TOKENS: int = field(
+        default_factory=lambda: int(os.getenv("PROMPT_MAX_TOKENS", "6000"))
+    )
+    # Most tokens of each section, which are filled in this order within
+    # what is left of MAX_TOKENS
+    PACKAGE_DOCUMENTS_TOKENS: int = field(
+        default_factory=lambda: int(
+            os.getenv("PROMPT_PACKAGE_DOCUMENTS_TOKENS", "2000")
+        )
+    )
+    CHAT_HISTORY_TOKENS: int = field(
+        default_factory=lambda: int(os.getenv("PROMPT_CHAT_HISTORY_TOKENS", "1000"))
+    )
+    GENERAL_CONDITIONS_TOKENS: int = field(
+        default_factory=lambda: int(
+            os.getenv("PROMPT_GENERAL_CONDITIONS_TOKENS", "3000")
+        )
+    )
+    # A document is cut to the tokens left rather than dropped when at least
+    # this many are left
+    MIN_CHUNK_TOKENS: int = field(
+        default_factory=lambda: int(os.getenv("PROMPT_MIN_CHUNK_TOKENS", "50"))
+    )
+
+
+@dataclass
+class SummaryMemory:
+    # Latest questions and answers sent as they are, the older ones are summarized
+    MAX_TURNS: int = field(
+        default_factory=lambda: int(os.getenv("SUMMARY_MEMORY_MAX_TURNS", "2"))
+    )
+    # Tokens of the messages after the summary above which it is updated
+    MAX_TOKENS: int = field(
+        default_factory=lambda: int(os.getenv("SUMMARY_MEMORY_MAX_TOKENS", "1000"))
+    )
+    # Most messages after the summary loaded per request
+    MAX_MESSAGES: int = field(
+        default_factory=lambda: int(os.getenv("SUMMARY_MEMORY_MAX_MESSAGES", "50"))
+    )
+    # Most tokens of the summary written by the model
+    SUMMARY_MAX_TOKENS: int = field(
+        default_factory=lambda: int(
+            os.getenv("SUMMARY_MEMORY_SUMMARY_MAX_TOKENS", "300")
+        )
+    )
+
+
+@dataclass
+class ChatHistory:
+    # Store the turn of /chat before the response is sent: a question sent
+    # right after the response reads it in the history, at the cost of one
+    # round trip in the response time. By default it is stored once the
+    # response has been sent
+    PERSIST_INLINE: bool = field(
+        default_factory=lambda: os.getenv(
+            "CHAT_HISTORY_PERSIST_INLINE", "false"
+        ).lower()
+        in ("1", "true", "yes")
+    )
@@ -7,6 +7,7 @@ FILENAME_DATASET_RAG = "./data/dataset_RAG.xlsx"
 TABLE_USER = "users"
 TABLE_CONVERSATIONS = "conversations"
 TABLE_CONVERSATION_MESSAGES = "conversation_messages"
+TABLE_CONVERSATION_USAGE = "conversation_usage_daily"
 TABLE_PACKAGE = "package"
 TABLE_LANGUAGE = "language"
 TABLE_COVERAGE_TYPE = "coverage_type"
@@ -22,3 +23,21 @@ COL_PACKAGE = "package"
 COL_ARTICLE = "article"
 COL_COMPANY = "company"
 COL_EMBEDDINGS = "embeddingd"
+
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_MAX_SIZE = 500
+CONVERSATIONS_PAGE_SIZE = 20
+CONVERSATIONS_PAGE_MAX_SIZE = 100
+USAGE_DEFAULT_DAYS = 30
+USAGE_MAX_DAYS = 366
+
+GENERAL_CONDITION_CHECK_INTERVAL = 60  # seconds
+# Rows written to or read from the vector database per call when ingesting,
+# bounded by the max batch size of the Chroma client
+VECTOR_DB_BATCH_SIZE = 1000
+
+# Headers of the Server-Sent Events responses, disable caching and proxy buffering
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# Language of the package names given to the LLM (`language.id`)
+DEFAULT_LANGUAGE_ID = 2
@@ -0,0 +1,122 @@
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from rag.config import DatabasePool
+from rag.migrations import upgrade
+from rag.query import QueryConversations
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PoolMetrics:
+    """Checkout statistics of a connection pool."""
+
+    checkouts: int = 0
+    failures: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, wait: float, failed: bool = False) -> None:
+        with self._lock:
+            if failed:
+                self.failures += 1
+                return
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def to_dict(self) -> dict:
+        return {
+            "checkouts": self.checkouts,
+            "failures": self.failures,
+            "avg_wait_ms": (
+                self.total_wait / self.checkouts * 1000 if self.checkouts else 0.0
+            ),
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+class InstrumentedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool recording how long each checkout waits for a connection.
+
+    The wait includes the time to open a new connection when the pool grows.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def recreate(self):
+        pool = super().recreate()
+        # Keep the statistics when the engine is disposed
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            self.metrics.record(time.perf_counter() - start, failed=True)
+            raise
+        self.metrics.record(time.perf_counter() - start)
+        return connection
+
+
+class Database:
+    """Engine and session factory of the conversation database.
+
+    The engine is created once per process. Each request gets its own session
+    through the `get_query_db` FastAPI dependency.
+    """
+
+    def __init__(
+        self, connection_string: str, pool_config: Optional[DatabasePool] = None
+    ):
+        # Use the async psycopg (v3) driver whatever the driver of the url
+        url = make_url(connection_string).set(drivername="postgresql+psycopg")
+        self.pool_config = pool_config or DatabasePool()
+        self.engine = create_async_engine(
+            url,
+            poolclass=InstrumentedAsyncQueuePool,
+            **self.pool_config.engine_kwargs,
+        )
+        self.Session = async_sessionmaker(bind=self.engine, expire_on_commit=False)
+
+    async def init_db(self):
+        """Migrate the schema. Called at startup, the dummy data is seeded
+        separately with `python -m rag.seed dummy`. Returns the database."""
+        async with self.engine.connect() as connection:
+            await connection.run_sync(upgrade)
+        return self
+
+    async def get_query_db(self) -> AsyncIterator[QueryConversations]:
+        """FastAPI dependency giving each request its own session."""
+        async with self.Session() as session:
+            yield QueryConversations(session)
+
+    def pool_status(self) -> dict:
+        """Return the state of the engine pool of this worker."""
+        pool = self.engine.pool
+        return {
+            "pid": os.getpid(),
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "max_overflow": self.pool_config.MAX_OVERFLOW,
+            **pool.metrics.to_dict(),
+        }
+
+    async def close(self):
+        await self.engine.dispose()
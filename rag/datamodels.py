@@ -3,12 +3,16 @@ import os
 from sqlalchemy import (
     Column,
     Integer,
+    BigInteger,
     String,
     ForeignKey,
     TIMESTAMP,
     Float,
+    Date,
     DateTime,
     Text,
+    Index,
+    text,
 )
 
 from sqlalchemy.dialects.postgresql import UUID, JSONB
@@ -19,6 +23,7 @@ from dotenv import load_dotenv
 from rag.constants import (
     TABLE_USER,
     TABLE_CONVERSATION_MESSAGES,
+    TABLE_CONVERSATION_USAGE,
     TABLE_CONVERSATIONS,
     TABLE_COVERAGE_TYPE,
     TABLE_LANGUAGE,
@@ -35,12 +40,30 @@ Base = declarative_base()
 
 class Conversation(Base):
     __tablename__ = TABLE_CONVERSATIONS
+    __table_args__ = (
+        Index("ix_conversations_user_uuid_name", "user_uuid", "name"),
+        Index(
+            "ix_conversations_user_uuid_last_message_at",
+            "user_uuid",
+            text("last_message_at DESC"),
+            text("id DESC"),
+            postgresql_include=["uuid", "name"],
+        ),
+    )
     id = Column(Integer, primary_key=True)
     uuid = Column(UUID(as_uuid=True), unique=True, nullable=False)
     name = Column(String, nullable=False)
     user_uuid = Column(UUID(as_uuid=True), nullable=False)
     created_by = Column(UUID(as_uuid=True), nullable=False)
     created_at = Column(TIMESTAMP, server_default=func.now())
+    # Maintained when messages are added, see `PostgresChatMessageHistory`
+    last_message_at = Column(TIMESTAMP)
+    message_count = Column(Integer, nullable=False, server_default="0")
+    total_tokens = Column(BigInteger, nullable=False, server_default="0")
+    # Rolling summary of the messages up to `summary_message_id` included, see
+    # `ConversationSummaryBufferMemory`
+    summary = Column(Text)
+    summary_message_id = Column(Integer)
     messages = relationship(
         "ConversationMessage",
         back_populates="conversation",
@@ -50,6 +73,11 @@ class Conversation(Base):
 
 class ConversationMessage(Base):
     __tablename__ = TABLE_CONVERSATION_MESSAGES
+    __table_args__ = (
+        Index(
+            "ix_conversation_messages_conversation_uuid_id", "conversation_uuid", "id"
+        ),
+    )
     id = Column(Integer, primary_key=True)
     conversation_uuid = Column(
         UUID(as_uuid=True), ForeignKey(Conversation.uuid), nullable=False
@@ -61,6 +89,25 @@ class ConversationMessage(Base):
     conversation = relationship("Conversation", back_populates="messages")
 
 
+class ConversationUsage(Base):
+    """Tokens and cost of the messages of a conversation per day.
+
+    Maintained when messages are added, see `PostgresChatMessageHistory`. The
+    rows are kept when the conversation is deleted, the usage is still billed.
+    """
+
+    __tablename__ = TABLE_CONVERSATION_USAGE
+    __table_args__ = (
+        Index("ix_conversation_usage_daily_user_uuid_day", "user_uuid", "day"),
+    )
+    conversation_uuid = Column(UUID(as_uuid=True), primary_key=True)
+    day = Column(Date, primary_key=True)
+    user_uuid = Column(UUID(as_uuid=True), nullable=False)
+    message_count = Column(Integer, nullable=False, server_default="0")
+    tokens = Column(BigInteger, nullable=False, server_default="0")
+    cost = Column(Float, nullable=False, server_default="0")
+
+
 class Package(Base):
     __tablename__ = TABLE_PACKAGE
     id = Column(Integer, primary_key=True)
@@ -120,7 +167,7 @@ class PackageDescription(Base):
 class UserInsurance(Base):
     __tablename__ = TABLE_USER_INSURANCE
     id = Column(Integer, primary_key=True)
-    user_sub = Column(String(255), nullable=False)
+    user_sub = Column(String(255), nullable=False, index=True)
     package_id = Column(
         Integer, ForeignKey("package.id", ondelete="CASCADE"), index=True
     )
@@ -1,21 +1,64 @@
 import uvicorn
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import date, datetime
 import uuid
+from typing import AsyncIterator, Optional
 import os
-from fastapi import FastAPI, Body, HTTPException, status, Depends, Header
-from fastapi.responses import JSONResponse
+from fastapi import (
+    BackgroundTasks,
+    FastAPI,
+    Body,
+    HTTPException,
+    Query,
+    status,
+    Depends,
+    Header,
+)
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
-from rag.constants import TABLE_CONVERSATION_MESSAGES
+from rag.constants import (
+    CONVERSATIONS_PAGE_MAX_SIZE,
+    CONVERSATIONS_PAGE_SIZE,
+    MESSAGES_PAGE_MAX_SIZE,
+    MESSAGES_PAGE_SIZE,
+    SSE_HEADERS,
+    TABLE_CONVERSATION_MESSAGES,
+    TABLE_CONVERSATION_USAGE,
+    TABLE_CONVERSATIONS,
+)
 from rag.datamodels import Base
-from rag.auth import decode_token, user_can_manage_client
+from rag.auth import decode_token, auser_can_manage_client, jwks_manager
 from rag.chatbot.memory import PostgresChatMessageHistory
 from rag.chatbot.llm import DummyConversation
-from rag.query import QueryConversations
+from rag.utils import (
+    decode_conversations_cursor,
+    usage_range,
+    encode_conversations_cursor,
+    format_sse,
+)
+from rag.database import Database
+from rag.ownership import ConversationOwnershipCache
+from rag.query import (
+    ConversationAccessError,
+    ConversationNameExistsError,
+    ConversationNotFoundError,
+    QueryConversations,
+)
+from rag.pool import (
+    open_connection_pools,
+    close_connection_pools,
+    get_pool_stats,
+)
+from rag.executor import shutdown_executor
+from rag.resources import Resources
 from rag.config import (
+    ChatHistory,
     ChatQuestion,
+    OwnershipCache,
     Postgres,
     ConversationUpdateRequest,
+    Startup,
 )
 
 from langchain_core.messages import message_to_dict
@@ -25,14 +68,77 @@ from langchain_core.messages import message_to_dict
 postgres_instance = Postgres()
 # Access the postgre_url property from the instance
 conn_string = postgres_instance.postgre_url
-# The instance for the db
-query_db = QueryConversations(connection_string=conn_string)
+# The database engine, each request gets its own session from its pool
+database = Database(connection_string=conn_string)
 
+# When the turns of /chat are stored
+chat_history_config = ChatHistory()
+
+# Owners of the conversations, checked on each chat question
+ownership_cache_config = OwnershipCache()
+ownership_cache = ConversationOwnershipCache(
+    max_size=ownership_cache_config.CACHE_SIZE, ttl=ownership_cache_config.CACHE_TTL
+)
+
+# Created in the lifespan, in parallel, rather than at import
+resources = Resources()
+resources.add("database", database.init_db, close=Database.close)
+# The shared chat history pool, opened once per worker
+resources.add(
+    "chat_history_pool",
+    lambda: open_connection_pools(conn_string),
+    close=lambda _: close_connection_pools(),
+)
 # The chain for the dummy rag
-chain_debug = DummyConversation(model="gpt-3.5-turbo")
+resources.add(
+    "llm",
+    lambda: DummyConversation(
+        model="gpt-3.5-turbo",
+        stream_delay=float(os.getenv("DUMMY_STREAM_DELAY", "0")),
+    ),
+    blocking=True,
+)
+
+
+async def get_query_db() -> AsyncIterator[QueryConversations]:
+    """The session of a request, once the database is migrated."""
+    await resources.get("database")
+    async for query_db in database.get_query_db():
+        yield query_db
+
+
+async def store_turn(
+    chat_memory: PostgresChatMessageHistory,
+    background_tasks: BackgroundTasks,
+    **turn,
+) -> None:
+    """Persist a turn in one INSERT.
+
+    By default once the response has been sent: a failure is only logged, and a
+    question sent right after the response may not read the turn in its history
+    yet. With CHAT_HISTORY_PERSIST_INLINE the turn is stored before the
+    response, which fails when the turn cannot be stored.
+    """
+    if chat_history_config.PERSIST_INLINE:
+        await chat_memory.aadd_turn(**turn)
+    else:
+        background_tasks.add_task(chat_memory.asave_turn, **turn)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup_config = Startup()
+    await resources.start(
+        lazy=startup_config.LAZY_RESOURCES, background=startup_config.IN_BACKGROUND
+    )
+    yield
+    await resources.close()
+    await jwks_manager.aclose()
+    shutdown_executor()
+
 
 # The app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware to the application
 app.add_middleware(
@@ -46,21 +152,29 @@ app.add_middleware(
 
 @app.post("/chat")
 async def chat(
+    background_tasks: BackgroundTasks,
     question: ChatQuestion = Body(...),
     playload=Depends(decode_token),
     managed_client_uuid: uuid.UUID = Header(...),
+    query_db: QueryConversations = Depends(get_query_db),
 ):
 
     # Check if the client is the owner of the conversation.
-    if not query_db.user_owns_conversation(
-        user_uuid=managed_client_uuid, conversation_uuid=question.conversation_uuid
-    ):
+    try:
+        await ownership_cache.check(
+            query_db,
+            user_uuid=managed_client_uuid,
+            conversation_uuid=question.conversation_uuid,
+        )
+    except (ConversationNotFoundError, ConversationAccessError):
+        # A missing conversation answers like the conversations of the other
+        # users, so that its existence is not revealed
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Client does not have the rights to access this conversation",
         )
 
-    if not user_can_manage_client(
+    if not await auser_can_manage_client(
         managed_client_uuid=managed_client_uuid,
         user_sub=playload["sub"],
         user_email=playload["email"],
@@ -74,17 +188,26 @@ async def chat(
         conversation_uuid=question.conversation_uuid,
         connection_string=conn_string,
         table_name=TABLE_CONVERSATION_MESSAGES,
+        conversations_table=TABLE_CONVERSATIONS,
+        usage_table=TABLE_CONVERSATION_USAGE,
     )
 
-    chat_history_dict = [message_to_dict(message) for message in chat_memory.messages]
+    chat_history_dict = [
+        message_to_dict(message) for message in await chat_memory.aget_messages()
+    ]
 
+    chain_debug = await resources.get("llm")
     res = chain_debug(question.question)
 
-    chat_memory.add_user_message(
-        message=question.question, tokens=res.get("prompt_tokens"), cost=0
-    )
-    chat_memory.add_ai_message(
-        message=res.get("answer"), tokens=res.get("completion_tokens"), cost=0
+    await store_turn(
+        chat_memory,
+        background_tasks,
+        human_message=question.question,
+        ai_message=res.get("answer"),
+        human_tokens=res.get("prompt_tokens"),
+        ai_tokens=res.get("completion_tokens"),
+        human_cost=0,
+        ai_cost=0,
     )
 
     response_json = {
@@ -98,15 +221,108 @@ async def chat(
     return JSONResponse(content=response_json, status_code=200)
 
 
+@app.post("/chat/stream")
+async def chat_stream(
+    question: ChatQuestion = Body(...),
+    playload=Depends(decode_token),
+    managed_client_uuid: uuid.UUID = Header(...),
+    query_db: QueryConversations = Depends(get_query_db),
+):
+    """
+    Streams the answer to a chat question as Server-Sent Events, see `/chat`.
+    """
+
+    # Check if the client is the owner of the conversation.
+    try:
+        await ownership_cache.check(
+            query_db,
+            user_uuid=managed_client_uuid,
+            conversation_uuid=question.conversation_uuid,
+        )
+    except (ConversationNotFoundError, ConversationAccessError):
+        # A missing conversation answers like the conversations of the other
+        # users, so that its existence is not revealed
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Client does not have the rights to access this conversation",
+        )
+
+    if not await auser_can_manage_client(
+        managed_client_uuid=managed_client_uuid,
+        user_sub=playload["sub"],
+        user_email=playload["email"],
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User does not manage this client",
+        )
+
+    chat_memory = PostgresChatMessageHistory(
+        conversation_uuid=question.conversation_uuid,
+        connection_string=conn_string,
+        table_name=TABLE_CONVERSATION_MESSAGES,
+        conversations_table=TABLE_CONVERSATIONS,
+        usage_table=TABLE_CONVERSATION_USAGE,
+    )
+
+    chat_history_dict = [
+        message_to_dict(message) for message in await chat_memory.aget_messages()
+    ]
+
+    chain_debug = await resources.get("llm")
+
+    async def event_stream():
+        answer = []
+        try:
+            async for chunk in chain_debug.astream(question.question):
+                answer.append(chunk)
+                yield format_sse("token", {"content": chunk})
+
+            response = "".join(answer)
+            prompt_tokens = chain_debug.count_tokens(text=question.question)
+            completion_tokens = chain_debug.count_tokens(text=response)
+
+            await chat_memory.aadd_turn(
+                human_message=question.question,
+                ai_message=response,
+                human_tokens=prompt_tokens,
+                ai_tokens=completion_tokens,
+                human_cost=0,
+                ai_cost=0,
+            )
+        except Exception as error:
+            yield format_sse("error", {"detail": str(error)})
+            return
+
+        yield format_sse(
+            "end",
+            {
+                "question": question.question,
+                "response": response,
+                "chat_history": chat_history_dict,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "total_cost": 444,
+            },
+        )
+
+    return StreamingResponse(
+        event_stream(), media_type="text/event-stream", headers=SSE_HEADERS
+    )
+
+
 @app.post("/conversation")
 async def create_new_conversation(
-    playload=Depends(decode_token), managed_client_uuid: uuid.UUID = Header(...)
+    playload=Depends(decode_token),
+    managed_client_uuid: uuid.UUID = Header(...),
+    query_db: QueryConversations = Depends(get_query_db),
 ):
 
     conv_uuid = str(uuid.uuid4())
     conv_name = f"conv_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
 
-    if not user_can_manage_client(
+    if not await auser_can_manage_client(
         managed_client_uuid=managed_client_uuid,
         user_sub=playload["sub"],
         user_email=playload["email"],
@@ -117,24 +333,27 @@ async def create_new_conversation(
         )
 
     try:
-        query_db.create_new_conversation(
+        await query_db.create_new_conversation(
             user_uuid=managed_client_uuid, conv_uuid=conv_uuid, conv_name=conv_name
         )
+        ownership_cache.add(user_uuid=managed_client_uuid, conversation_uuid=conv_uuid)
 
         chat_memory = PostgresChatMessageHistory(
             conversation_uuid=conv_uuid,
             connection_string=conn_string,
             table_name=TABLE_CONVERSATION_MESSAGES,
+            conversations_table=TABLE_CONVERSATIONS,
+            usage_table=TABLE_CONVERSATION_USAGE,
         )
 
-        chat_memory.add_ai_message(
+        await chat_memory.aadd_ai_message(
             message="Bienvenu chez Insurapolis, comment puis-je vous aider ?",
             cost=0,
             tokens=12,
         )
 
         chat_history_dict = [
-            message_to_dict(message) for message in chat_memory.messages
+            message_to_dict(message) for message in await chat_memory.aget_messages()
         ]
 
         response_data = {
@@ -152,10 +371,14 @@ async def create_new_conversation(
 
 @app.get("/conversations")
 async def list_conversations(
-    playload=Depends(decode_token), managed_client_uuid: uuid.UUID = Header(...)
+    before: Optional[str] = Query(default=None),
+    limit: Optional[int] = Query(default=None, ge=1, le=CONVERSATIONS_PAGE_MAX_SIZE),
+    playload=Depends(decode_token),
+    managed_client_uuid: uuid.UUID = Header(...),
+    query_db: QueryConversations = Depends(get_query_db),
 ):
 
-    if not user_can_manage_client(
+    if not await auser_can_manage_client(
         managed_client_uuid=managed_client_uuid,
         user_sub=playload["sub"],
         user_email=playload["email"],
@@ -166,10 +389,28 @@ async def list_conversations(
         )
 
     try:
-        list_conversations_uuid = query_db.get_list_conversations_by_user(
-            user_uuid=managed_client_uuid
+        cursor = decode_conversations_cursor(before) if before is not None else None
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
         )
 
+    try:
+        # Whole list, or one keyset page when requested
+        next_before = None
+        if limit is None and cursor is None:
+            list_conversations_uuid = await query_db.get_list_conversations_by_user(
+                user_uuid=managed_client_uuid
+            )
+        else:
+            list_conversations_uuid, next_before = (
+                await query_db.get_conversations_page(
+                    user_uuid=managed_client_uuid,
+                    before=cursor,
+                    limit=limit or CONVERSATIONS_PAGE_SIZE,
+                )
+            )
+
         response = {
             "user_email": playload["email"],
             "managed_client_uuid": str(managed_client_uuid),
@@ -181,6 +422,9 @@ async def list_conversations(
                 }
                 for row in list_conversations_uuid
             ],
+            "next_before": (
+                encode_conversations_cursor(next_before) if next_before else None
+            ),
         }
 
         return JSONResponse(content=response, status_code=status.HTTP_200_OK)
@@ -191,11 +435,14 @@ async def list_conversations(
 @app.get("/conversation/{conversation_uuid}")
 async def get_conversation(
     conversation_uuid: str,
+    after_id: Optional[int] = Query(default=None),
+    limit: Optional[int] = Query(default=None, ge=1, le=MESSAGES_PAGE_MAX_SIZE),
     playload=Depends(decode_token),
     managed_client_uuid: uuid.UUID = Header(...),
+    query_db: QueryConversations = Depends(get_query_db),
 ):
 
-    if not user_can_manage_client(
+    if not await auser_can_manage_client(
         managed_client_uuid=managed_client_uuid,
         user_sub=playload["sub"],
         user_email=playload["email"],
@@ -205,37 +452,51 @@ async def get_conversation(
             detail="Active user does not managed this client",
         )
 
-    # Check if the client is the owner of the conversation.
-    if not query_db.user_owns_conversation(
-        user_uuid=managed_client_uuid, conversation_uuid=conversation_uuid
-    ):
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="User does not have the rights to access this conversation",
-        )
-
     try:
-        # Fetch conversation messages by UUID
-        conversation = query_db.get_conversation_messages_by_uuid(
-            conv_uuid=conversation_uuid
-        )
-        if conversation:
-            return JSONResponse(
-                content={
-                    "user_email": playload["email"],
-                    "managed_client_uuid": str(managed_client_uuid),
-                    "conversation": conversation,
-                },
-                status_code=status.HTTP_200_OK,
+        # Fetch conversation messages by UUID, one keyset page when requested,
+        # the owner is checked in the same query
+        next_after_id = None
+        if limit is None and after_id is None:
+            conversation = await query_db.get_conversation_messages_by_uuid(
+                conv_uuid=conversation_uuid, user_uuid=managed_client_uuid
             )
         else:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+            conversation, next_after_id = await query_db.get_conversation_messages_page(
+                conv_uuid=conversation_uuid,
+                after_id=after_id,
+                limit=limit or MESSAGES_PAGE_SIZE,
+                user_uuid=managed_client_uuid,
             )
+    except ConversationNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+        )
+    except ConversationAccessError:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User does not have the rights to access this conversation",
+        )
     except ValueError as e:
         # Handle potential ValueError from the database operation or data processing
         raise HTTPException(status_code=500, detail=str(e))
 
+    # A conversation without messages is not found, as before the owner check;
+    # only a page after the last message is empty
+    if not conversation and after_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+        )
+
+    return JSONResponse(
+        content={
+            "user_email": playload["email"],
+            "managed_client_uuid": str(managed_client_uuid),
+            "conversation": conversation,
+            "next_after_id": next_after_id,
+        },
+        status_code=status.HTTP_200_OK,
+    )
+
 
 @app.put("/conversation/{conversation_uuid}")
 async def update_conversation(
@@ -243,9 +504,10 @@ async def update_conversation(
     request_body: ConversationUpdateRequest,
     playload=Depends(decode_token),
     managed_client_uuid: uuid.UUID = Header(...),
+    query_db: QueryConversations = Depends(get_query_db),
 ):
 
-    if not user_can_manage_client(
+    if not await auser_can_manage_client(
         managed_client_uuid=managed_client_uuid,
         user_sub=playload["sub"],
         user_email=playload["email"],
@@ -258,45 +520,48 @@ async def update_conversation(
     # Extract the new name from the request body
     new_name = request_body.name
 
-    if not query_db.user_owns_conversation(
-        user_uuid=managed_client_uuid, conversation_uuid=conversation_uuid
-    ):
+    try:
+        # Update the conversation name by UUID, the owner and the name are
+        # checked in the same statement
+        success = await query_db.update_conversation_name(
+            conversation_uuid, new_name, user_uuid=managed_client_uuid
+        )
+    except ConversationNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+        )
+    except ConversationAccessError:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="User does not have the rights to access this conversation",
         )
-
-    if query_db.conversation_name_exists(
-        user_uuid=managed_client_uuid, conversation_name=new_name
-    ):
+    except ConversationNameExistsError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Conversation name already exists",
         )
-    try:
-        # Update the conversation name by UUID
-        success = query_db.update_conversation_name(conversation_uuid, new_name)
-        if success:
-            return {
-                "managed_client_uuid": str(managed_client_uuid),
-                "message": "Conversation name updated successfully",
-            }
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
-            )
     except Exception as e:
         # Log the error or handle it as per your application's requirements
         raise HTTPException(status_code=500, detail=str(e))
 
+    if success:
+        return {
+            "managed_client_uuid": str(managed_client_uuid),
+            "message": "Conversation name updated successfully",
+        }
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+    )
+
 
 @app.delete("/conversation/{conversation_uuid}")
 async def delete_conversation(
     conversation_uuid: str,
     playload=Depends(decode_token),
     managed_client_uuid: uuid.UUID = Header(...),
+    query_db: QueryConversations = Depends(get_query_db),
 ):
-    if not user_can_manage_client(
+    if not await auser_can_manage_client(
         managed_client_uuid=managed_client_uuid,
         user_sub=playload["sub"],
         user_email=playload["email"],
@@ -308,30 +573,92 @@ async def delete_conversation(
 
     try:
         # Call the method to delete the conversation by UUID
-        success = query_db.delete_conversation(conversation_uuid)
-        if success:
-            return JSONResponse(
-                content={
-                    "managed_client_uuid": str(managed_client_uuid),
-                    "message": "Conversation deleted successfully",
-                },
-                status_code=200,
-            )
-        else:
-            raise HTTPException(status_code=404, detail="Conversation not found")
+        success = await query_db.delete_conversation(
+            conversation_uuid, user_uuid=managed_client_uuid
+        )
+    except ConversationNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+        )
+    except ConversationAccessError:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User does not have the rights to access this conversation",
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    if success:
+        ownership_cache.invalidate(conversation_uuid)
+        return JSONResponse(
+            content={
+                "managed_client_uuid": str(managed_client_uuid),
+                "message": "Conversation deleted successfully",
+            },
+            status_code=200,
+        )
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+    )
+
 
 @app.post("/get-user-tokens")
-async def get_user_tokens(playload=Depends(decode_token)):
-    tokens_used = query_db.get_total_tokens_used_per_user(user_uuid=playload["sub"])
+async def get_user_tokens(
+    playload=Depends(decode_token),
+    query_db: QueryConversations = Depends(get_query_db),
+):
+    tokens_used = await query_db.get_total_tokens_used_per_user(
+        user_uuid=playload["sub"]
+    )
 
     return JSONResponse(
         content={"tokens": tokens_used, "user_uuid": playload["sub"]}, status_code=200
     )
 
 
+@app.get("/usage")
+async def get_usage(
+    start: Optional[date] = Query(default=None),
+    end: Optional[date] = Query(default=None),
+    playload=Depends(decode_token),
+    managed_client_uuid: uuid.UUID = Header(...),
+    query_db: QueryConversations = Depends(get_query_db),
+):
+    """
+    Returns the tokens and cost used by the managed client from `start` to `end`
+    included (ISO dates, the last USAGE_DEFAULT_DAYS days by default), in total,
+    per day and per conversation. Served from the daily usage rollups, for
+    dashboards and quota checks.
+    """
+    if not await auser_can_manage_client(
+        managed_client_uuid=managed_client_uuid,
+        user_sub=playload["sub"],
+        user_email=playload["email"],
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Active user does not managed this client",
+        )
+
+    try:
+        start, end = usage_range(start, end)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    usage = await query_db.get_usage(
+        user_uuid=managed_client_uuid, start=start, end=end
+    )
+
+    return JSONResponse(
+        content={
+            "managed_client_uuid": str(managed_client_uuid),
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            **usage,
+        },
+        status_code=status.HTTP_200_OK,
+    )
+
+
 @app.get("/get-sub")
 async def get_sub(playload=Depends(decode_token)):
 
@@ -340,5 +667,52 @@ async def get_sub(playload=Depends(decode_token)):
     return JSONResponse(status_code=status.HTTP_200_OK, content=response)
 
 
+@app.get("/health/live")
+async def liveness():
+    """
+    Returns 200 as long as the worker serves requests, even while its resources
+    are warming up.
+    """
+    return JSONResponse(content={"status": "alive"}, status_code=status.HTTP_200_OK)
+
+
+@app.get("/health/ready")
+async def readiness():
+    """
+    Returns 200 once the resources created at startup (database, chat history
+    pool, models, ...) are ready and 503 before, with the state and the startup
+    time of each resource.
+    """
+    return JSONResponse(
+        content=resources.status(),
+        status_code=status.HTTP_200_OK
+        if resources.ready
+        else status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
+
+@app.get("/metrics/db-pool", dependencies=[Depends(decode_token)])
+async def db_pool_metrics():
+    """
+    Returns the state of the connection pools of this worker: the SQLAlchemy
+    engine pool (size, checked out connections, overflow, checkout wait time)
+    and the psycopg pools of the chat history.
+    """
+    return JSONResponse(
+        content={"engine": database.pool_status(), "chat_history": get_pool_stats()},
+        status_code=status.HTTP_200_OK,
+    )
+
+
+@app.get("/metrics/ownership", dependencies=[Depends(decode_token)])
+async def ownership_metrics():
+    """
+    Returns the hit ratio of the conversation ownership cache of this worker.
+    """
+    return JSONResponse(
+        content=ownership_cache.stats.to_dict(), status_code=status.HTTP_200_OK
+    )
+
+
 if __name__ == "__main__":
     uvicorn.run("dummy_app_b2b:app", host="localhost", port=8000, reload=True)
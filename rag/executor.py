@@ -0,0 +1,43 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from rag.config import BlockingExecutor
+
+# Bounded pool for the calls that are still synchronous (boto3, Chroma, ...)
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor(config: Optional[BlockingExecutor] = None) -> ThreadPoolExecutor:
+    """Return the process-wide executor used for blocking calls, creating it on
+    first use.
+
+    Args:
+        config (BlockingExecutor): size of the executor. Only used when the
+        executor is created. Defaults to the values from the environment.
+    """
+    global _executor
+    if _executor is None:
+        config = config or BlockingExecutor()
+        _executor = ThreadPoolExecutor(
+            max_workers=config.MAX_WORKERS, thread_name_prefix="blocking"
+        )
+    return _executor
+
+
+async def run_blocking(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run a synchronous function in the bounded executor without blocking the
+    event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+def shutdown_executor() -> None:
+    """Wait for the pending blocking calls and release the threads."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,118 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, Optional
+
+import httpx
+
+from rag.executor import run_blocking
+
+logger = logging.getLogger(__name__)
+
+
+class JWKSManager:
+    """JSON Web Key Set of the token issuer, per kid.
+
+    - Concurrent requests share a single fetch (single flight).
+    - Once the keys are older than `ttl`, they are still served while they are
+      refreshed in the background (stale-while-revalidate). A failed refresh
+      keeps the stale keys and is retried after `retry_interval` seconds.
+    - A token signed with an unknown kid triggers a refetch, at most once every
+      `unknown_kid_interval` seconds, to pick up rotated keys.
+    - When `local_path` is given the keys are read from this JSON file instead
+      of `jwks_uri`, e.g. for tests and air-gapped environments.
+
+    The HTTP client is created on first use and kept for the following
+    refreshes, `aclose` closes it.
+    """
+
+    def __init__(
+        self,
+        jwks_uri: str,
+        ttl: float = 86400.0,
+        retry_interval: float = 60.0,
+        unknown_kid_interval: float = 60.0,
+        local_path: Optional[str] = None,
+        timeout: float = 5.0,
+    ):
+        self.jwks_uri = jwks_uri
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.unknown_kid_interval = unknown_kid_interval
+        self.local_path = local_path
+        self.timeout = timeout
+        self._keys: Optional[Dict[str, dict]] = None
+        self._expires_at = 0.0
+        self._unknown_kid_refreshed_at = float("-inf")
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def get_keys(self) -> Dict[str, dict]:
+        """Return the keys per kid, fetching them on first use."""
+        if self._keys is None:
+            return await self.refresh()
+        if time.monotonic() >= self._expires_at:
+            # Serve the stale keys while they are refreshed
+            self._start_refresh()
+        return self._keys
+
+    async def refresh_unknown_kid(self, kid: str) -> Dict[str, dict]:
+        """Refetch the keys for a token signed with the unknown `kid`, unless
+        they were refetched for an unknown kid less than
+        `unknown_kid_interval` seconds ago."""
+        now = time.monotonic()
+        if now - self._unknown_kid_refreshed_at >= self.unknown_kid_interval:
+            self._unknown_kid_refreshed_at = now
+            logger.info("Refreshing the JWKS for the unknown kid %s", kid)
+            try:
+                await self.refresh()
+            except Exception:
+                # Logged by `_log_refresh_error`
+                pass
+        return self._keys or {}
+
+    async def refresh(self) -> Dict[str, dict]:
+        """Fetch the keys, sharing the fetch already in flight if any."""
+        self._start_refresh()
+        # A cancelled request must not cancel the fetch awaited by the others
+        return await asyncio.shield(self._refresh_task)
+
+    def _start_refresh(self) -> None:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._fetch())
+            self._refresh_task.add_done_callback(self._log_refresh_error)
+
+    def _log_refresh_error(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("JWKS refresh failed: %s", task.exception())
+
+    async def _fetch(self) -> Dict[str, dict]:
+        try:
+            if self.local_path:
+                jwks = await run_blocking(self._read_local_file)
+            else:
+                if self._client is None:
+                    self._client = httpx.AsyncClient(timeout=self.timeout)
+                response = await self._client.get(self.jwks_uri)
+                response.raise_for_status()
+                jwks = response.json()
+        except Exception:
+            # Keep serving the stale keys, if any, until the next retry
+            self._expires_at = time.monotonic() + self.retry_interval
+            raise
+
+        self._keys = {key["kid"]: key for key in jwks["keys"]}
+        self._expires_at = time.monotonic() + self.ttl
+        return self._keys
+
+    def _read_local_file(self) -> dict:
+        with open(self.local_path) as file:
+            return json.load(file)
+
+    async def aclose(self) -> None:
+        if self._refresh_task is not None and not self._refresh_task.done():
+            self._refresh_task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
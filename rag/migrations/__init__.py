@@ -0,0 +1,51 @@
+"""Versioned migrations of the database schema, managed by Alembic.
+
+Run them with `alembic upgrade head` from the root of the repository, or with
+`upgrade` on a connection; the apps do the latter at startup.
+"""
+
+from pathlib import Path
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import inspect, text
+
+from rag.constants import TABLE_CONVERSATIONS
+
+MIGRATIONS_PATH = Path(__file__).parent
+# Schema created by `Base.metadata.create_all` before the migrations
+BASELINE_REVISION = "0001"
+# Key of the advisory lock serializing the migrations of concurrent workers
+MIGRATION_LOCK_ID = 4_120_561
+
+
+def get_config(connection=None) -> Config:
+    config = Config()
+    config.set_main_option("script_location", str(MIGRATIONS_PATH))
+    config.attributes["connection"] = connection
+    return config
+
+
+def upgrade(connection, revision: str = "head") -> None:
+    """Upgrade the schema to `revision` on a synchronous `connection`.
+
+    The workers starting together wait for each other on an advisory lock.
+    A database created with `create_all` before the migrations existed is
+    stamped with the baseline revision first, so only the new migrations run.
+    """
+    connection.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+    try:
+        table_names = inspect(connection).get_table_names()
+        # The lock is held by the session, the migrations begin and commit
+        # their own transactions
+        connection.commit()
+
+        config = get_config(connection)
+        if "alembic_version" not in table_names and TABLE_CONVERSATIONS in table_names:
+            command.stamp(config, BASELINE_REVISION)
+        command.upgrade(config, revision)
+    finally:
+        connection.execute(
+            text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID}
+        )
+        connection.commit()
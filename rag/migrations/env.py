@@ -0,0 +1,63 @@
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+from rag.config import Postgres
+from rag.datamodels import Base
+
+config = context.config
+
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+
+def database_url():
+    # Same database as the apps, with the psycopg (v3) driver
+    return make_url(Postgres().postgre_url).set(drivername="postgresql+psycopg")
+
+
+def run_migrations_offline() -> None:
+    """Emit the SQL of the migrations instead of running them (`--sql`)."""
+    context.configure(
+        url=database_url(),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        transaction_per_migration=True,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online() -> None:
+    # `rag.migrations.upgrade` passes the connection of the app
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        do_run_migrations(connection)
+        return
+
+    engine = create_engine(database_url())
+    with engine.connect() as connection:
+        do_run_migrations(connection)
+    engine.dispose()
+
+
+def do_run_migrations(connection) -> None:
+    # One transaction per migration, the index migrations need to commit
+    # before creating their indexes concurrently
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        transaction_per_migration=True,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,143 @@
+"""Initial schema, as created by Base.metadata.create_all
+
+Revision ID: 0001
+Revises:
+Create Date: 2024-07-15 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "conversations",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("uuid", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("user_uuid", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("created_by", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column(
+            "created_at", sa.TIMESTAMP(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("uuid"),
+    )
+    op.create_table(
+        "coverage_type",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("type", sa.String(length=50), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "language",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("lang_code", sa.String(length=255), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "package",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("company", sa.String(length=255), nullable=False),
+        sa.Column("name_base", sa.String(length=255), nullable=True),
+        sa.Column("product_base", sa.String(length=255), nullable=True),
+        sa.Column("version", sa.String(length=255), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_package_company", "package", ["company"])
+    op.create_table(
+        "conversation_messages",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column(
+            "conversation_uuid", postgresql.UUID(as_uuid=True), nullable=False
+        ),
+        sa.Column("message", postgresql.JSONB(), nullable=False),
+        sa.Column("tokens", sa.Integer(), nullable=False),
+        sa.Column("cost", sa.Float(), nullable=False),
+        sa.Column(
+            "send_at", sa.TIMESTAMP(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.ForeignKeyConstraint(["conversation_uuid"], ["conversations.uuid"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "package_description",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("package_id", sa.Integer(), nullable=True),
+        sa.Column("type_id", sa.Integer(), nullable=True),
+        sa.Column("case", sa.Text(), nullable=True),
+        sa.Column("details", sa.Text(), nullable=True),
+        sa.Column("language_id", sa.Integer(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["language_id"], ["language.id"]),
+        sa.ForeignKeyConstraint(["package_id"], ["package.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["type_id"], ["coverage_type.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_package_description_language_id", "package_description", ["language_id"]
+    )
+    op.create_index(
+        "ix_package_description_package_id", "package_description", ["package_id"]
+    )
+    op.create_index(
+        "ix_package_description_type_id", "package_description", ["type_id"]
+    )
+    op.create_table(
+        "package_language",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("package_id", sa.Integer(), nullable=True),
+        sa.Column("name", sa.String(length=255), nullable=False),
+        sa.Column("product", sa.String(length=255), nullable=False),
+        sa.Column("language_id", sa.Integer(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["language_id"], ["language.id"]),
+        sa.ForeignKeyConstraint(["package_id"], ["package.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_package_language_language_id", "package_language", ["language_id"]
+    )
+    op.create_index(
+        "ix_package_language_package_id", "package_language", ["package_id"]
+    )
+    op.create_table(
+        "user_insurances",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_sub", sa.String(length=255), nullable=False),
+        sa.Column("package_id", sa.Integer(), nullable=True),
+        sa.Column("deductible", sa.Float(), nullable=True),
+        sa.Column("sum_insured", sa.String(length=255), nullable=True),
+        sa.Column("net_premium", sa.Float(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["package_id"], ["package.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_user_insurances_package_id", "user_insurances", ["package_id"]
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("user_insurances")
+    op.drop_table("package_language")
+    op.drop_table("package_description")
+    op.drop_table("conversation_messages")
+    op.drop_table("package")
+    op.drop_table("language")
+    op.drop_table("coverage_type")
+    op.drop_table("conversations")
@@ -0,0 +1,55 @@
+"""Indexes of the hot conversation and package queries
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2024-07-15 10:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, Sequence[str], None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# name, table, columns
+INDEXES = [
+    # Messages of a conversation in order, and keyset pagination
+    (
+        "ix_conversation_messages_conversation_uuid_id",
+        "conversation_messages",
+        ["conversation_uuid", "id"],
+    ),
+    # Conversations of a user, and name uniqueness per user
+    ("ix_conversations_user_uuid_name", "conversations", ["user_uuid", "name"]),
+    # Packages of a user
+    ("ix_user_insurances_user_sub", "user_insurances", ["user_sub"]),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Build the indexes without locking the writes to the tables
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, _ in INDEXES:
+            op.drop_index(
+                name, table_name=table, postgresql_concurrently=True, if_exists=True
+            )
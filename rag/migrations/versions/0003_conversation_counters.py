@@ -0,0 +1,75 @@
+"""Last message time, message count and total tokens of each conversation
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2024-07-22 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, Sequence[str], None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        "conversations", sa.Column("last_message_at", sa.TIMESTAMP(), nullable=True)
+    )
+    op.add_column(
+        "conversations",
+        sa.Column("message_count", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.add_column(
+        "conversations",
+        sa.Column("total_tokens", sa.BigInteger(), server_default="0", nullable=False),
+    )
+    op.execute(
+        """
+        UPDATE conversations
+        SET message_count = stats.message_count,
+            total_tokens = stats.total_tokens,
+            last_message_at = stats.last_message_at
+        FROM (
+            SELECT conversation_uuid,
+                   count(*) AS message_count,
+                   coalesce(sum(tokens), 0) AS total_tokens,
+                   max(send_at) AS last_message_at
+            FROM conversation_messages
+            GROUP BY conversation_uuid
+        ) AS stats
+        WHERE conversations.uuid = stats.conversation_uuid
+        """
+    )
+
+    # Listing of the conversations of a user by last message, from the index only
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_conversations_user_uuid_last_message_at",
+            "conversations",
+            ["user_uuid", sa.text("last_message_at DESC"), sa.text("id DESC")],
+            postgresql_include=["uuid", "name"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_conversations_user_uuid_last_message_at",
+            table_name="conversations",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+    op.drop_column("conversations", "total_tokens")
+    op.drop_column("conversations", "message_count")
+    op.drop_column("conversations", "last_message_at")
@@ -0,0 +1,61 @@
+"""Daily tokens and cost of each conversation
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2024-07-29 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, Sequence[str], None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "conversation_usage_daily",
+        sa.Column("conversation_uuid", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("user_uuid", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("message_count", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("tokens", sa.BigInteger(), server_default="0", nullable=False),
+        sa.Column("cost", sa.Float(), server_default="0", nullable=False),
+        sa.PrimaryKeyConstraint("conversation_uuid", "day"),
+    )
+    op.create_index(
+        "ix_conversation_usage_daily_user_uuid_day",
+        "conversation_usage_daily",
+        ["user_uuid", "day"],
+    )
+    # The apps used to store the total cost of a call with both the question
+    # and the answer, so the backfilled cost of the messages stored before the
+    # prompt and completion costs were split is twice the real spend, and so is
+    # their usage once rebuilt from the messages
+    op.execute(
+        """
+        INSERT INTO conversation_usage_daily
+            (conversation_uuid, day, user_uuid, message_count, tokens, cost)
+        SELECT messages.conversation_uuid, messages.send_at::date,
+               conversations.user_uuid, count(*), sum(messages.tokens),
+               sum(messages.cost)
+        FROM conversation_messages AS messages
+        JOIN conversations ON conversations.uuid = messages.conversation_uuid
+        WHERE messages.send_at IS NOT NULL
+        GROUP BY messages.conversation_uuid, messages.send_at::date,
+                 conversations.user_uuid
+        """
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("conversation_usage_daily")
@@ -0,0 +1,47 @@
+from typing import Optional
+
+from rag.cache import TTLCache
+from rag.query import QueryConversations, check_conversation_owner
+
+
+class ConversationOwnershipCache:
+    """Cache of the conversations each user is known to own.
+
+    Only the positive checks are cached: the owner of a conversation never
+    changes, so an entry only goes stale when the conversation is deleted.
+    Call `invalidate` when deleting a conversation; the other workers rely on
+    the TTL, in the meantime writing to the deleted conversation fails on its
+    foreign key.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        self.cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    @property
+    def stats(self):
+        return self.cache.stats
+
+    async def check(
+        self, query_db: QueryConversations, user_uuid, conversation_uuid
+    ) -> None:
+        """Raise `ConversationNotFoundError` or `ConversationAccessError`
+        unless the conversation belongs to `user_uuid`."""
+        key = (str(user_uuid), str(conversation_uuid))
+        if self.cache.get(key):
+            return
+        owner = await query_db.get_conversation_owner(conversation_uuid)
+        check_conversation_owner(owner, user_uuid)
+        self.cache.set(key, True)
+
+    def add(self, user_uuid, conversation_uuid) -> None:
+        """Record a conversation just created by `user_uuid`."""
+        self.cache.set((str(user_uuid), str(conversation_uuid)), True)
+
+    def invalidate(self, conversation_uuid: Optional[str] = None) -> None:
+        """Drop the cached owner of `conversation_uuid`, or of every
+        conversation when `conversation_uuid` is `None`."""
+        if conversation_uuid is None:
+            self.cache.clear()
+            return
+        conversation_uuid = str(conversation_uuid)
+        self.cache.pop_matching(lambda key: key[1] == conversation_uuid)
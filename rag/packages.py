@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import weakref
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from sqlalchemy import event, inspect
+
+from rag.cache import TTLCache
+from rag.config import VectorDatabaseFilter
+from rag.constants import DEFAULT_LANGUAGE_ID
+from rag.datamodels import UserInsurance
+from rag.query import QueryConversations
+from rag.utils import format_package_data
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class UserPackageContext:
+    """The packages of a user, formatted for the prompt and the retriever.
+
+    It is shared by the requests of the user through `UserPackageCache`, hence
+    immutable: `filter` is a new dict on each read.
+    """
+
+    package_ids: Tuple[int, ...]
+    deductible: str
+    sum_insured: str
+
+    @property
+    def filter(self) -> dict:
+        """Filter of the retriever on the packages of the user."""
+        return VectorDatabaseFilter(mapping_package=list(self.package_ids)).filters()
+
+    @property
+    def answer_cache_key(self) -> str:
+        """Partition of the `SemanticAnswerCache`: the users sharing the
+        packages, deductibles and sums insured of the prompt share answers."""
+        return hashlib.sha256(
+            json.dumps(
+                [sorted(self.package_ids), self.deductible, self.sum_insured]
+            ).encode()
+        ).hexdigest()
+
+
+class UserPackageCache:
+    """Cache of the package context of each user, per language.
+
+    Entries expire after `ttl` seconds. They are also invalidated when a
+    `UserInsurance` row is inserted, updated or deleted through the ORM in this
+    process; the other workers and the bulk `update()`/`delete()` statements
+    rely on the TTL, or on an explicit call to `invalidate`.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        self.cache = TTLCache(max_size=max_size, ttl=ttl)
+        _caches.add(self)
+
+    @property
+    def stats(self):
+        return self.cache.stats
+
+    async def get(
+        self,
+        query_db: QueryConversations,
+        user_uuid,
+        language_id: int = DEFAULT_LANGUAGE_ID,
+    ) -> UserPackageContext:
+        key = (str(user_uuid), language_id)
+        context = self.cache.get(key)
+        if context is None:
+            user_package = await query_db.get_user_packages(
+                user_uuid=user_uuid, language_id=language_id
+            )
+            package_ids, deductible, sum_insured = format_package_data(
+                data=user_package
+            )
+            context = UserPackageContext(
+                package_ids=tuple(package_ids),
+                deductible=deductible,
+                sum_insured=sum_insured,
+            )
+            self.cache.set(key, context)
+        return context
+
+    def invalidate(self, user_uuid: Optional[str] = None) -> None:
+        """Drop the cached context of `user_uuid` in every language, or of
+        every user when `user_uuid` is `None`."""
+        if user_uuid is None:
+            self.cache.clear()
+            return
+        user_uuid = str(user_uuid)
+        self.cache.pop_matching(lambda key: key[0] == user_uuid)
+
+
+# The package caches of the process, invalidated by the ORM events below. The
+# listeners are registered once for all the caches, which are only weakly
+# referenced so that a discarded cache is not kept alive by the mapper
+_caches: "weakref.WeakSet[UserPackageCache]" = weakref.WeakSet()
+
+
+def _on_user_insurance_change(mapper, connection, target) -> None:
+    # Also invalidate the previous owner when `user_sub` changed
+    history = inspect(target).attrs.user_sub.history
+    for user_sub in {target.user_sub, *(history.deleted or ())}:
+        if user_sub is not None:
+            for cache in list(_caches):
+                cache.invalidate(user_sub)
+
+
+for _event_name in ("after_insert", "after_update", "after_delete"):
+    event.listen(UserInsurance, _event_name, _on_user_insurance_change)
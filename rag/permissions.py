@@ -0,0 +1,155 @@
+import logging
+import sqlite3
+import threading
+import uuid
+from typing import Dict, FrozenSet, Iterable, Optional, Protocol, Tuple
+
+from rag.cache import TTLCache
+from rag.executor import run_blocking
+
+logger = logging.getLogger(__name__)
+
+ManagedClients = FrozenSet[uuid.UUID]
+
+
+class ManagedClientsBackend(Protocol):
+    """Source of the clients managed by each user."""
+
+    def get_managed_clients(
+        self, user_sub: str, user_email: str
+    ) -> Optional[ManagedClients]:
+        """Return the UUIDs of the clients managed by the user, `None` when the
+        user is unknown. May block, it runs in the executor."""
+
+
+class DynamoDBManagedClients:
+    """Managed clients stored in the `managedUsers` attribute of the DynamoDB
+    item of each user."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def get_managed_clients(
+        self, user_sub: str, user_email: str
+    ) -> Optional[ManagedClients]:
+        response = self.table.get_item(
+            Key={"id": str(user_sub), "email": str(user_email)}
+        )
+        item = response.get("Item")
+        if item is None:
+            return None
+        return frozenset(
+            uuid.UUID(user_dict["id"]) for user_dict in item.get("managedUsers") or []
+        )
+
+
+class InMemoryManagedClients:
+    """In-memory stand-in of the DynamoDB table, for tests and benchmarks."""
+
+    def __init__(
+        self, managed_clients: Optional[Dict[Tuple[str, str], Iterable]] = None
+    ):
+        self.managed_clients = {
+            key: frozenset(uuid.UUID(str(client)) for client in clients)
+            for key, clients in (managed_clients or {}).items()
+        }
+
+    def get_managed_clients(
+        self, user_sub: str, user_email: str
+    ) -> Optional[ManagedClients]:
+        return self.managed_clients.get((str(user_sub), str(user_email)))
+
+
+class SqliteManagedClients:
+    """Sqlite stand-in of the DynamoDB table, for local runs without AWS.
+
+    One row per managed client in the `managed_clients` table; a user without
+    any row is unknown.
+    """
+
+    def __init__(self, path: str):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS managed_clients "
+                "(user_sub TEXT NOT NULL, email TEXT NOT NULL, "
+                "client_uuid TEXT NOT NULL, "
+                "PRIMARY KEY (user_sub, email, client_uuid))"
+            )
+
+    def add(self, user_sub: str, user_email: str, client_uuid: uuid.UUID) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO managed_clients VALUES (?, ?, ?)",
+                (str(user_sub), str(user_email), str(client_uuid)),
+            )
+
+    def get_managed_clients(
+        self, user_sub: str, user_email: str
+    ) -> Optional[ManagedClients]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT client_uuid FROM managed_clients "
+                "WHERE user_sub = ? AND email = ?",
+                (str(user_sub), str(user_email)),
+            ).fetchall()
+        if not rows:
+            return None
+        return frozenset(uuid.UUID(client_uuid) for client_uuid, in rows)
+
+
+class PermissionCache:
+    """Cache of the clients managed by each user, keyed by (sub, email).
+
+    The managed clients are kept `ttl` seconds. Users that are unknown or
+    manage no client are cached for `negative_ttl` seconds, so that repeated
+    forbidden requests do not reach the backend either. Failed lookups are not
+    cached.
+    """
+
+    def __init__(
+        self,
+        backend: ManagedClientsBackend,
+        max_size: int = 10000,
+        ttl: float = 300.0,
+        negative_ttl: float = 60.0,
+    ):
+        self.backend = backend
+        self.negative_ttl = negative_ttl
+        self.cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    @property
+    def stats(self):
+        return self.cache.stats
+
+    async def get_managed_clients(
+        self, user_sub: str, user_email: str
+    ) -> ManagedClients:
+        key = (str(user_sub), str(user_email))
+        managed_clients = self.cache.get(key)
+        if managed_clients is None:
+            managed_clients = (
+                await run_blocking(self.backend.get_managed_clients, *key)
+                or frozenset()
+            )
+            self.cache.set(
+                key,
+                managed_clients,
+                ttl=None if managed_clients else self.negative_ttl,
+            )
+        return managed_clients
+
+    async def can_manage(
+        self, managed_client_uuid: uuid.UUID, user_sub: str, user_email: str
+    ) -> bool:
+        try:
+            managed_clients = await self.get_managed_clients(user_sub, user_email)
+        except Exception as error:
+            logger.error("Failed to look up the managed clients: %s", error)
+            return False
+        return uuid.UUID(str(managed_client_uuid)) in managed_clients
+
+    def invalidate(self, user_sub: str, user_email: str) -> None:
+        """Drop the cached clients of a user, e.g. after changing them."""
+        self.cache.pop((str(user_sub), str(user_email)))
@@ -0,0 +1,109 @@
+import hashlib
+import logging
+from typing import Dict, Optional
+
+from psycopg_pool import AsyncConnectionPool, ConnectionPool, PoolTimeout
+
+from rag.config import PostgresPool
+
+logger = logging.getLogger(__name__)
+
+# Process-wide pools, one per connection string, shared by every chat history.
+_pools: Dict[str, ConnectionPool] = {}
+_async_pools: Dict[str, AsyncConnectionPool] = {}
+
+
+def _pool_name(prefix: str, conninfo: str) -> str:
+    # Unique per connection string, without exposing its password
+    return f"{prefix}-{hashlib.sha256(conninfo.encode()).hexdigest()[:8]}"
+
+
+def get_connection_pool(
+    conninfo: str, config: Optional[PostgresPool] = None
+) -> ConnectionPool:
+    """Return the shared synchronous pool for `conninfo`, creating it on first use.
+
+    Args:
+        conninfo (str): the PostgreSQL connection string.
+        config (PostgresPool): sizing and lifetime of the pool. Only used when
+        the pool is created. Defaults to the values from the environment.
+    """
+    pool = _pools.get(conninfo)
+    if pool is None:
+        config = config or PostgresPool()
+        pool = ConnectionPool(
+            conninfo,
+            check=ConnectionPool.check_connection,
+            name=_pool_name("chat-history", conninfo),
+            open=True,
+            **config.pool_kwargs,
+        )
+        _pools[conninfo] = pool
+    return pool
+
+
+async def get_async_connection_pool(
+    conninfo: str, config: Optional[PostgresPool] = None
+) -> AsyncConnectionPool:
+    """Return the shared asynchronous pool for `conninfo`, opening it on first use.
+
+    Args:
+        conninfo (str): the PostgreSQL connection string.
+        config (PostgresPool): sizing and lifetime of the pool. Only used when
+        the pool is created. Defaults to the values from the environment.
+    """
+    pool = _async_pools.get(conninfo)
+    if pool is None:
+        config = config or PostgresPool()
+        pool = AsyncConnectionPool(
+            conninfo,
+            check=AsyncConnectionPool.check_connection,
+            name=_pool_name("chat-history-async", conninfo),
+            open=False,
+            **config.pool_kwargs,
+        )
+        _async_pools[conninfo] = pool
+    # Opening an already opened pool is a no-op.
+    await pool.open()
+    return pool
+
+
+async def open_connection_pools(
+    conninfo: str, config: Optional[PostgresPool] = None
+) -> AsyncConnectionPool:
+    """Open the async pool at startup so the first request does not pay for it.
+
+    Waits for the first connections of the pool, and raises `PoolTimeout` when
+    Postgres cannot be reached within the timeout of the pool; the next call
+    opens a new pool.
+    """
+    config = config or PostgresPool()
+    pool = await get_async_connection_pool(conninfo, config)
+    try:
+        await pool.wait(timeout=config.POOL_TIMEOUT)
+    except PoolTimeout:
+        # The pool is closed by the failed wait and cannot be reopened
+        if _async_pools.get(conninfo) is pool:
+            del _async_pools[conninfo]
+        await pool.close()
+        raise
+    return pool
+
+
+async def close_connection_pools() -> None:
+    """Close every pool created by this process."""
+    for pool in list(_async_pools.values()):
+        await pool.close()
+    for pool in list(_pools.values()):
+        pool.close()
+    _async_pools.clear()
+    _pools.clear()
+
+
+def get_pool_stats() -> Dict[str, Dict[str, int]]:
+    """Return the psycopg statistics of every open pool, keyed by pool name,
+    which tells the sync and async pools of each connection string apart."""
+    return {
+        pool.name: pool.get_stats()
+        for pool in [*_pools.values(), *_async_pools.values()]
+    }
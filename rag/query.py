@@ -1,39 +1,66 @@
 import uuid
-import pandas as pd
-from sqlalchemy import create_engine
+from datetime import date, datetime
+from typing import Optional, Tuple
+from sqlalchemy import and_, delete, func, insert, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
 
-from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy.sql import func
 from dotenv import load_dotenv
 import logging
 
+from rag.constants import DEFAULT_LANGUAGE_ID
 from rag.datamodels import (
     Conversation,
     ConversationMessage,
+    ConversationUsage,
     UserInsurance,
     Package,
     PackageLanguage,
-    Base,
 )
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
 
+class ConversationError(Exception):
+    """Base class of the errors of the queries that check the owner of a
+    conversation."""
+
+
+class ConversationNotFoundError(ConversationError, LookupError):
+    """The conversation does not exist."""
+
+
+class ConversationAccessError(ConversationError, PermissionError):
+    """The conversation belongs to another user."""
+
+
+class ConversationNameExistsError(ConversationError, ValueError):
+    """The user already has a conversation with this name."""
+
+
+def check_conversation_owner(owner, user_uuid) -> None:
+    """Raise when the conversation of `owner` (`None` when the conversation
+    does not exist) cannot be accessed by `user_uuid`."""
+    if owner is None:
+        raise ConversationNotFoundError
+    if str(owner) != str(user_uuid):
+        raise ConversationAccessError
+
+
 class QueryConversations:
-    def __init__(self, connection_string: str):
-        try:
-            self.engine = create_engine(connection_string)
-            Session = sessionmaker(bind=self.engine)
-            self.session = Session()
-            Base.metadata.create_all(self.engine)
-            self.insert_dummy_data()
-
-        except Exception as error:
-            logger.error(error)
-
-    def create_new_conversation(
+    """Async queries on the conversation tables, bound to the session of one
+    request (see `rag.database.Database.get_query_db`).
+
+    Every method runs in its own transaction, so the pooled connection is
+    returned as soon as the query is done and not held for the whole request.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def create_new_conversation(
         self,
         user_uuid: uuid.UUID,
         conv_uuid: str,
@@ -44,150 +71,374 @@ class QueryConversations:
         new_conversation = Conversation(
             uuid=conv_uuid, user_uuid=user_uuid, name=conv_name, created_by=created_by
         )
-        self.session.add(new_conversation)
-        self.session.commit()
-        self.session.close()
+        async with self.session.begin():
+            self.session.add(new_conversation)
 
-    def get_conversation_messages_by_uuid(self, conv_uuid):
+    async def get_conversation_owner(self, conversation_uuid) -> Optional[uuid.UUID]:
+        """The `user_uuid` of the conversation, `None` when it does not exist."""
+        async with self.session.begin():
+            return await self.session.scalar(
+                select(Conversation.user_uuid).where(
+                    Conversation.uuid == conversation_uuid
+                )
+            )
 
-        messages = (
-            self.session.query(ConversationMessage.message)
-            .filter(ConversationMessage.conversation_uuid == conv_uuid)
-            .all()
+    @staticmethod
+    def _owned_messages_query(conv_uuid, user_uuid, *columns, after_id=None):
+        # One row per message, or a single row without message when the
+        # conversation is empty or belongs to another user, so the owner is
+        # checked in the same statement as the messages are fetched
+        join_on = [
+            ConversationMessage.conversation_uuid == Conversation.uuid,
+            Conversation.user_uuid == user_uuid,
+        ]
+        if after_id is not None:
+            join_on.append(ConversationMessage.id > after_id)
+        return (
+            select(Conversation.user_uuid, *columns)
+            .select_from(Conversation)
+            .outerjoin(ConversationMessage, and_(*join_on))
+            .where(Conversation.uuid == conv_uuid)
+            .order_by(ConversationMessage.id)
         )
 
-        self.session.close()
-        return [message[0] for message in messages]
+    @staticmethod
+    def _owned_rows(rows, user_uuid) -> list:
+        check_conversation_owner(rows[0][0] if rows else None, user_uuid)
+        return [row for row in rows if row[-1] is not None]
 
-    def get_list_conversations_by_user(self, user_uuid):
+    async def get_conversation_messages_by_uuid(self, conv_uuid, user_uuid=None):
+        """The messages of a conversation. When `user_uuid` is given, raises
+        `ConversationNotFoundError` or `ConversationAccessError` unless the
+        conversation belongs to `user_uuid`, in the same query."""
+        if user_uuid is None:
+            query = (
+                select(ConversationMessage.message)
+                .where(ConversationMessage.conversation_uuid == conv_uuid)
+                .order_by(ConversationMessage.id)
+            )
+            async with self.session.begin():
+                return list(await self.session.scalars(query))
 
-        conversations = (
-            self.session.query(
+        async with self.session.begin():
+            result = await self.session.execute(
+                self._owned_messages_query(
+                    conv_uuid, user_uuid, ConversationMessage.message
+                )
+            )
+            rows = result.all()
+        return [row[1] for row in self._owned_rows(rows, user_uuid)]
+
+    async def get_conversation_messages_page(
+        self,
+        conv_uuid,
+        after_id: Optional[int] = None,
+        limit: int = 50,
+        user_uuid=None,
+    ) -> Tuple[list, Optional[int]]:
+        """Keyset pagination over the messages of a conversation.
+
+        Returns the messages with an id greater than `after_id` and the
+        `after_id` of the next page, `None` when there is no next page. The
+        owner is checked as in `get_conversation_messages_by_uuid`.
+        """
+        if user_uuid is None:
+            query = select(ConversationMessage.id, ConversationMessage.message).where(
+                ConversationMessage.conversation_uuid == conv_uuid
+            )
+            if after_id is not None:
+                query = query.where(ConversationMessage.id > after_id)
+            query = query.order_by(ConversationMessage.id)
+        else:
+            query = self._owned_messages_query(
+                conv_uuid,
+                user_uuid,
+                ConversationMessage.id,
+                ConversationMessage.message,
+                after_id=after_id,
+            )
+
+        async with self.session.begin():
+            result = await self.session.execute(query.limit(limit))
+            rows = result.all()
+
+        if user_uuid is not None:
+            rows = [row[1:] for row in self._owned_rows(rows, user_uuid)]
+        next_after_id = rows[-1][0] if len(rows) == limit else None
+        return [row[1] for row in rows], next_after_id
+
+    @staticmethod
+    def _list_conversations_query(user_uuid):
+        # Read from `ix_conversations_user_uuid_last_message_at` only, the
+        # conversations without messages are not listed
+        return (
+            select(
                 Conversation.uuid,
                 Conversation.name,
-                func.max(ConversationMessage.send_at),
+                Conversation.last_message_at,
+                Conversation.id,
             )
-            .join(ConversationMessage)
-            .filter(Conversation.user_uuid == user_uuid)
-            .group_by(Conversation.uuid, Conversation.name)
-            .all()
+            .where(
+                Conversation.user_uuid == user_uuid,
+                Conversation.last_message_at.is_not(None),
+            )
+            .order_by(Conversation.last_message_at.desc(), Conversation.id.desc())
         )
 
-        self.session.close()
-        return conversations
+    async def get_list_conversations_by_user(self, user_uuid):
+
+        async with self.session.begin():
+            result = await self.session.execute(
+                self._list_conversations_query(user_uuid)
+            )
+            return result.all()
+
+    async def get_conversations_page(
+        self,
+        user_uuid,
+        before: Optional[Tuple[datetime, int]] = None,
+        limit: int = 20,
+    ) -> Tuple[list, Optional[Tuple[datetime, int]]]:
+        """Keyset pagination over the conversations of a user, most recent first.
+
+        Returns the conversations whose `(last_message_at, id)` is lower than
+        `before` and the `before` of the next page, `None` when there is no
+        next page.
+        """
+        query = self._list_conversations_query(user_uuid)
+        if before is not None:
+            query = query.where(
+                tuple_(Conversation.last_message_at, Conversation.id)
+                < tuple_(*before)
+            )
 
-    def update_conversation_name(self, conversation_uuid: str, new_name: str):
+        async with self.session.begin():
+            result = await self.session.execute(query.limit(limit))
+            rows = result.all()
 
-        result = (
-            self.session.query(Conversation)
-            .filter(Conversation.uuid == conversation_uuid)
-            .update({Conversation.name: new_name})
+        next_before = (rows[-1][2], rows[-1][3]) if len(rows) == limit else None
+        return rows, next_before
+
+    async def update_conversation_name(
+        self, conversation_uuid: str, new_name: str, user_uuid=None
+    ):
+        """Rename a conversation. When `user_uuid` is given, the owner and the
+        uniqueness of the name for the user are checked in the same statement
+        as the update, which raises `ConversationNotFoundError`,
+        `ConversationAccessError` or `ConversationNameExistsError`."""
+        if user_uuid is None:
+            async with self.session.begin():
+                result = await self.session.execute(
+                    update(Conversation)
+                    .where(Conversation.uuid == conversation_uuid)
+                    .values(name=new_name)
+                )
+            return result.rowcount > 0
+
+        target, named = aliased(Conversation), aliased(Conversation)
+        name_exists = (
+            select(named.id)
+            .where(named.user_uuid == user_uuid, named.name == new_name)
+            .exists()
         )
-        self.session.commit()
-        self.session.close()
-        return result > 0
-
-    def delete_conversation(self, conversation_uuid: str):
-
-        # First delete all messages associated with the conversation
-        self.session.query(ConversationMessage).filter(
-            ConversationMessage.conversation_uuid == conversation_uuid
-        ).delete()
-
-        # Now delete the conversation itself
-        result = (
-            self.session.query(Conversation)
-            .filter(Conversation.uuid == conversation_uuid)
-            .delete()
+        updated = (
+            update(Conversation)
+            .where(
+                Conversation.uuid == conversation_uuid,
+                Conversation.user_uuid == user_uuid,
+                ~name_exists,
+            )
+            .values(name=new_name)
+            .returning(Conversation.id)
+            .cte("updated")
+        )
+        query = select(
+            select(target.user_uuid)
+            .where(target.uuid == conversation_uuid)
+            .scalar_subquery(),
+            name_exists,
+            select(updated.c.id).exists(),
         )
-        self.session.commit()
-        return result > 0
 
-    def get_total_tokens_used_per_user(self, user_uuid):
-        result = (
-            self.session.query(
-                func.sum(ConversationMessage.tokens).label("total_tokens")
+        async with self.session.begin():
+            owner, exists, success = (await self.session.execute(query)).one()
+
+        check_conversation_owner(owner, user_uuid)
+        if exists:
+            raise ConversationNameExistsError
+        return success
+
+    async def delete_conversation(self, conversation_uuid: str, user_uuid=None):
+        """Delete a conversation and its messages. When `user_uuid` is given,
+        raises `ConversationNotFoundError` or `ConversationAccessError` unless
+        the conversation belongs to `user_uuid`."""
+
+        async with self.session.begin():
+            if user_uuid is not None:
+                owner = await self.session.scalar(
+                    select(Conversation.user_uuid)
+                    .where(Conversation.uuid == conversation_uuid)
+                    .with_for_update()
+                )
+                check_conversation_owner(owner, user_uuid)
+
+            # First delete all messages associated with the conversation
+            await self.session.execute(
+                delete(ConversationMessage).where(
+                    ConversationMessage.conversation_uuid == conversation_uuid
+                )
             )
-            .join(
-                Conversation, ConversationMessage.conversation_uuid == Conversation.uuid
+
+            # Now delete the conversation itself
+            result = await self.session.execute(
+                delete(Conversation).where(Conversation.uuid == conversation_uuid)
             )
-            .filter(Conversation.user_uuid == user_uuid)
-            .scalar()
-        )
-        return result or 0
+        return result.rowcount > 0
 
-    def conversation_name_exists(self, user_uuid, conversation_name: str) -> bool:
-        count = (
-            self.session.query(Conversation)
-            .filter(
-                Conversation.name == conversation_name,
-                Conversation.user_uuid == user_uuid,
+    async def get_total_tokens_used_per_user(self, user_uuid):
+        async with self.session.begin():
+            result = await self.session.scalar(
+                select(func.sum(Conversation.total_tokens)).where(
+                    Conversation.user_uuid == user_uuid
+                )
             )
-            .count()
+        # The sum of a bigint column is a numeric, returned as a Decimal
+        return int(result or 0)
+
+    async def get_usage(self, user_uuid, start: date, end: date) -> dict:
+        """Tokens and cost of a user from `start` to `end` included, in total,
+        per day and per conversation, read from the daily rollups."""
+        totals = (
+            func.sum(ConversationUsage.message_count).label("message_count"),
+            func.sum(ConversationUsage.tokens).label("tokens"),
+            func.sum(ConversationUsage.cost).label("cost"),
+        )
+        where = (
+            ConversationUsage.user_uuid == user_uuid,
+            ConversationUsage.day.between(start, end),
         )
-        return count > 0
 
-    def user_owns_conversation(self, user_uuid, conversation_uuid: str) -> bool:
-        exists = (
-            self.session.query(Conversation)
-            .filter(
-                Conversation.uuid == conversation_uuid,
-                Conversation.user_uuid == user_uuid,
+        async with self.session.begin():
+            days = await self.session.execute(
+                select(ConversationUsage.day, *totals)
+                .where(*where)
+                .group_by(ConversationUsage.day)
+                .order_by(ConversationUsage.day)
             )
-            .count()
-            > 0
-        )
-        return exists
+            conversations = await self.session.execute(
+                select(ConversationUsage.conversation_uuid, *totals)
+                .where(*where)
+                .group_by(ConversationUsage.conversation_uuid)
+                .order_by(func.sum(ConversationUsage.tokens).desc())
+            )
+            days, conversations = days.all(), conversations.all()
 
-    def get_user_packages(self, user_uuid):
-        return (
-            self.session.query(
-                UserInsurance.package_id,
-                PackageLanguage.name,
-                UserInsurance.deductible,
-                UserInsurance.sum_insured,
-            )
-            .join(Package, UserInsurance.package_id == Package.id)
-            .join(PackageLanguage, Package.id == PackageLanguage.package_id)
-            .filter(
-                PackageLanguage.language_id == 2,
-                UserInsurance.user_sub == user_uuid,
-            )
-            .all()
-        )
+        def usage(row) -> dict:
+            return {
+                "message_count": int(row.message_count),
+                "tokens": int(row.tokens),
+                "cost": row.cost,
+            }
+
+        return {
+            "total": {
+                "message_count": sum(row.message_count for row in days),
+                "tokens": int(sum(row.tokens for row in days)),
+                "cost": sum(row.cost for row in days),
+            },
+            "days": [{"day": row.day.isoformat(), **usage(row)} for row in days],
+            "conversations": [
+                {"uuid": str(row.conversation_uuid), **usage(row)}
+                for row in conversations
+            ],
+        }
+
+    async def conversation_name_exists(
+        self, user_uuid, conversation_name: str
+    ) -> bool:
+        async with self.session.begin():
+            count = await self.session.scalar(
+                select(func.count())
+                .select_from(Conversation)
+                .where(
+                    Conversation.name == conversation_name,
+                    Conversation.user_uuid == user_uuid,
+                )
+            )
+        return count > 0
+
+    async def user_owns_conversation(self, user_uuid, conversation_uuid: str) -> bool:
+        async with self.session.begin():
+            count = await self.session.scalar(
+                select(func.count())
+                .select_from(Conversation)
+                .where(
+                    Conversation.uuid == conversation_uuid,
+                    Conversation.user_uuid == user_uuid,
+                )
+            )
+        return count > 0
 
-    def insert_dummy_data(self):
-        import json
-
-        if self.session.query(Conversation).count() == 0:
-            # Insert conversation data from CSV
-            df_conversation = pd.read_csv("./data/conversation.csv")
-            for index, row in df_conversation.iterrows():
-                conversation = Conversation(
-                    uuid=row["uuid"],
-                    user_uuid=row["user_uuid"],
-                    name=row["name"],
-                    created_by=row["created_by"],
+    async def get_user_packages(
+        self, user_uuid, language_id: int = DEFAULT_LANGUAGE_ID
+    ):
+        async with self.session.begin():
+            result = await self.session.execute(
+                select(
+                    UserInsurance.package_id,
+                    PackageLanguage.name,
+                    UserInsurance.deductible,
+                    UserInsurance.sum_insured,
                 )
-                self.session.add(conversation)
-
-        if self.session.query(ConversationMessage).count() == 0:
-            # Insert message data from XLS
-            df_messages = pd.read_excel("./data/messages.xls")
-            df_messages["message"] = df_messages["message"].apply(
-                lambda x: json.loads(x)
-            )
-            for index, row in df_messages.iterrows():
-                message = ConversationMessage(
-                    conversation_uuid=row["conversation_uuid"],
-                    message=row["message"],
-                    tokens=row["tokens"],
-                    cost=row["cost"],
-                    send_at=row["send_at"],
+                .join(Package, UserInsurance.package_id == Package.id)
+                .join(PackageLanguage, Package.id == PackageLanguage.package_id)
+                .where(
+                    PackageLanguage.language_id == language_id,
+                    UserInsurance.user_sub == user_uuid,
                 )
-                self.session.add(message)
+            )
+            return result.all()
 
-        self.session.commit()
+    @staticmethod
+    def rebuild_usage(session) -> None:
+        """Recompute the daily usage rollups from the messages, runs with a
+        synchronous session via `run_sync`.
 
-    def close(self):
-        self.session.close()
+        The rollups are maintained when messages are added, rebuild them after
+        inserting messages by other means. The rollups of the deleted
+        conversations are kept.
+        """
+        day = func.date(ConversationMessage.send_at)
+        stats = (
+            select(
+                ConversationMessage.conversation_uuid,
+                day,
+                Conversation.user_uuid,
+                func.count(),
+                func.sum(ConversationMessage.tokens),
+                func.sum(ConversationMessage.cost),
+            )
+            .join(Conversation)
+            .where(ConversationMessage.send_at.is_not(None))
+            .group_by(
+                ConversationMessage.conversation_uuid, day, Conversation.user_uuid
+            )
+        )
+        session.execute(
+            delete(ConversationUsage).where(
+                ConversationUsage.conversation_uuid.in_(select(Conversation.uuid))
+            )
+        )
+        session.execute(
+            insert(ConversationUsage).from_select(
+                [
+                    "conversation_uuid",
+                    "day",
+                    "user_uuid",
+                    "message_count",
+                    "tokens",
+                    "cost",
+                ],
+                stats,
+            )
+        )
@@ -0,0 +1,204 @@
+import asyncio
+import inspect
+import logging
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from rag.executor import run_blocking
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+STARTING = "starting"
+READY = "ready"
+FAILED = "failed"
+CLOSED = "closed"
+
+
+class Resource:
+    """A resource of the app, created once by `factory` and shared by the
+    requests of the worker.
+
+    `factory` returns the resource or an awaitable of it; a `blocking` factory
+    (loading a model, opening a Chroma client, ...) runs in the blocking
+    executor so that the resources are created in parallel. `close` is called
+    with the resource at shutdown.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        factory: Callable[[], Any],
+        close: Optional[Callable[[Any], Any]] = None,
+        blocking: bool = False,
+        lazy: bool = False,
+    ):
+        self.name = name
+        self.factory = factory
+        self.close_function = close
+        self.blocking = blocking
+        self.lazy = lazy
+        self.value: Any = None
+        self.state = PENDING
+        self.error: Optional[str] = None
+        self.startup_time: Optional[float] = None
+        self._task: Optional[asyncio.Future] = None
+
+    async def _create(self) -> Any:
+        self.state = STARTING
+        start = time.perf_counter()
+        try:
+            if self.blocking:
+                value = await run_blocking(self.factory)
+            else:
+                value = self.factory()
+                if inspect.isawaitable(value):
+                    value = await value
+        except Exception as error:
+            self.startup_time = time.perf_counter() - start
+            self.state = FAILED
+            self.error = repr(error)
+            logger.exception("Could not initialize %s", self.name)
+            raise
+
+        self.startup_time = time.perf_counter() - start
+        self.value = value
+        self.state = READY
+        self.error = None
+        logger.info("%s ready in %.0f ms", self.name, self.startup_time * 1000)
+        return value
+
+    async def get(self) -> Any:
+        """Return the resource, creating it on first use. Concurrent callers
+        wait for the same creation; a failed creation is retried by the next
+        call."""
+        if self.state == READY:
+            return self.value
+        if self._task is None or (self._task.done() and self.state != READY):
+            self._task = asyncio.ensure_future(self._create())
+        # A cancelled request must not cancel the creation shared with others
+        return await asyncio.shield(self._task)
+
+    async def close(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        if self.state == READY and self.close_function is not None:
+            result = self.close_function(self.value)
+            if inspect.isawaitable(result):
+                await result
+        self.value = None
+        self.state = CLOSED
+
+    def to_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "lazy": self.lazy,
+            "startup_ms": self.startup_time * 1000
+            if self.startup_time is not None
+            else None,
+            "error": self.error,
+        }
+
+
+class Resources:
+    """Container of the resources of an app (database, vector store, models,
+    ...), created in the lifespan rather than at import.
+
+    `start` creates the resources that are not lazy in parallel, either before
+    serving or in the background; the lazy ones are created by their first
+    `get`. `ready` tells whether the resources created at startup are ready,
+    for the readiness probe, and `status` reports the state and the startup
+    time of each.
+    """
+
+    def __init__(self):
+        self._resources: Dict[str, Resource] = {}
+        self.startup_time: Optional[float] = None
+        self._warmup: Optional[asyncio.Future] = None
+
+    def add(
+        self,
+        name: str,
+        factory: Callable[[], Any],
+        close: Optional[Callable[[Any], Any]] = None,
+        blocking: bool = False,
+        lazy: bool = False,
+    ) -> None:
+        """Register a resource, see `Resource`."""
+        if name in self._resources:
+            raise ValueError(f"Resource {name} is already registered")
+        self._resources[name] = Resource(
+            name, factory, close=close, blocking=blocking, lazy=lazy
+        )
+
+    async def get(self, name: str) -> Any:
+        """Return the resource `name`, waiting for its creation."""
+        return await self._resources[name].get()
+
+    def dependency(self, name: str) -> Callable:
+        """FastAPI dependency giving the resource `name` to an endpoint."""
+
+        async def get_resource() -> Any:
+            return await self.get(name)
+
+        return get_resource
+
+    @property
+    def eager(self) -> list:
+        return [
+            resource for resource in self._resources.values() if not resource.lazy
+        ]
+
+    async def _warm(self) -> None:
+        start = time.perf_counter()
+        # The failures are logged and reported by `status`
+        await asyncio.gather(
+            *(resource.get() for resource in self.eager), return_exceptions=True
+        )
+        self.startup_time = time.perf_counter() - start
+        logger.info("Resources ready in %.0f ms", self.startup_time * 1000)
+
+    async def start(self, lazy: Iterable[str] = (), background: bool = False) -> None:
+        """Create the resources that are not lazy, in parallel.
+
+        Args:
+            lazy (Iterable[str]): names of more resources to create on first
+            use only.
+            background (bool): return at once and create the resources in the
+            background; the requests needing one wait for it.
+        """
+        for name in lazy:
+            if name not in self._resources:
+                logger.warning("Unknown lazy resource %s", name)
+                continue
+            self._resources[name].lazy = True
+
+        if background:
+            self._warmup = asyncio.ensure_future(self._warm())
+        else:
+            await self._warm()
+
+    @property
+    def ready(self) -> bool:
+        return all(resource.state == READY for resource in self.eager)
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "startup_ms": self.startup_time * 1000
+            if self.startup_time is not None
+            else None,
+            "resources": {
+                name: resource.to_dict() for name, resource in self._resources.items()
+            },
+        }
+
+    async def close(self) -> None:
+        """Close the resources in the reverse order of their registration."""
+        if self._warmup is not None and not self._warmup.done():
+            self._warmup.cancel()
+        for resource in reversed(list(self._resources.values())):
+            try:
+                await resource.close()
+            except Exception as error:
+                logger.error("Could not close %s: %s", resource.name, error)
@@ -0,0 +1,340 @@
+"""Bulk seeding of the conversation tables, for development and load tests.
+
+The rows are built as DataFrames and streamed to Postgres with `COPY`, with
+the conversation counters and the daily usage rollups computed from the
+messages, so no per-row statement is sent. The schema is migrated first.
+
+    python -m rag.seed dummy
+    python -m rag.seed synthetic --users 10000 --conversations-per-user 10
+
+Run it with the `POSTGRES_*` environment variables of the app.
+"""
+
+import argparse
+import io
+import json
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import psycopg
+from langchain_core.messages import AIMessage, HumanMessage, message_to_dict
+from psycopg import sql
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+from rag.config import Postgres
+from rag.constants import (
+    TABLE_CONVERSATION_MESSAGES,
+    TABLE_CONVERSATION_USAGE,
+    TABLE_CONVERSATIONS,
+)
+from rag.migrations import upgrade
+
+logger = logging.getLogger(__name__)
+
+DUMMY_CONVERSATIONS_PATH = "./data/conversation.csv"
+DUMMY_MESSAGES_PATH = "./data/messages.xls"
+
+CONVERSATION_COLUMNS = [
+    "uuid",
+    "name",
+    "user_uuid",
+    "created_by",
+    "last_message_at",
+    "message_count",
+    "total_tokens",
+]
+MESSAGE_COLUMNS = ["conversation_uuid", "message", "tokens", "cost", "send_at"]
+USAGE_COLUMNS = [
+    "conversation_uuid",
+    "day",
+    "user_uuid",
+    "message_count",
+    "tokens",
+    "cost",
+]
+
+# Rows written to the COPY stream at once
+COPY_CHUNK_SIZE = 50000
+
+# Lognormal parameters of the length in characters of the synthetic messages,
+# a median of ~90 characters for the questions and ~700 for the answers
+HUMAN_LENGTH = (4.5, 0.6)
+AI_LENGTH = (6.55, 0.5)
+# Prices per token of the synthetic messages, those of gpt-3.5-turbo
+HUMAN_TOKEN_COST = 0.5e-6
+AI_TOKEN_COST = 1.5e-6
+WORDS = (
+    "assurance couverture franchise sinistre contrat prime police garantie "
+    "dommage vol incendie responsabilité civile ménage bâtiment voyage véhicule "
+    "remboursement déclaration expertise valeur à neuf somme assurée exclusion "
+    "je suis mon votre est pour avec dans les des une pas que qui "
+).split()
+
+
+def copy_dataframe(connection, table: str, df: pd.DataFrame, columns=None) -> int:
+    """Stream the rows of `df` into `table` with a single CSV `COPY`.
+
+    The empty values (`None`, `NaN`, `NaT`) are written as NULL. Returns the
+    number of rows copied.
+    """
+    columns = list(columns or df.columns)
+    query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+        sql.Identifier(table), sql.SQL(", ").join(map(sql.Identifier, columns))
+    )
+    with connection.cursor() as cursor:
+        with cursor.copy(query) as copy:
+            for start in range(0, len(df), COPY_CHUNK_SIZE):
+                buffer = io.StringIO()
+                df[columns].iloc[start : start + COPY_CHUNK_SIZE].to_csv(
+                    buffer, index=False, header=False
+                )
+                copy.write(buffer.getvalue())
+    return len(df)
+
+
+def summarize_messages(
+    conversations: pd.DataFrame, messages: pd.DataFrame
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Fill the counters of `conversations` and compute the daily usage rollups
+    from `messages`, as `PostgresChatMessageHistory` maintains them."""
+    counters = messages.groupby("conversation_uuid").agg(
+        message_count=("tokens", "size"),
+        total_tokens=("tokens", "sum"),
+        last_message_at=("send_at", "max"),
+    )
+    conversations = conversations.drop(
+        columns=["message_count", "total_tokens", "last_message_at"], errors="ignore"
+    ).join(counters, on="uuid")
+    conversations["message_count"] = (
+        conversations["message_count"].fillna(0).astype("int64")
+    )
+    conversations["total_tokens"] = conversations["total_tokens"].fillna(0).astype(
+        "int64"
+    )
+
+    owners = conversations.set_index("uuid")["user_uuid"]
+    usage = (
+        messages.assign(day=messages["send_at"].dt.date)
+        .groupby(["conversation_uuid", "day"], as_index=False)
+        .agg(
+            message_count=("tokens", "size"),
+            tokens=("tokens", "sum"),
+            cost=("cost", "sum"),
+        )
+    )
+    usage["user_uuid"] = usage["conversation_uuid"].map(owners)
+    return conversations, usage
+
+
+def copy_conversations(
+    connection, conversations: pd.DataFrame, messages: pd.DataFrame
+) -> None:
+    """Copy the conversations, their messages and their usage rollups in one
+    transaction."""
+    conversations, usage = summarize_messages(conversations, messages)
+    with connection.transaction():
+        for table, df, columns in (
+            (TABLE_CONVERSATIONS, conversations, CONVERSATION_COLUMNS),
+            (TABLE_CONVERSATION_MESSAGES, messages, MESSAGE_COLUMNS),
+            (TABLE_CONVERSATION_USAGE, usage, USAGE_COLUMNS),
+        ):
+            copy_dataframe(connection, table, df, columns)
+
+
+def load_dummy_data(
+    conversations_path: str = DUMMY_CONVERSATIONS_PATH,
+    messages_path: str = DUMMY_MESSAGES_PATH,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """The dummy conversations and messages of the `data` folder."""
+    conversations = pd.read_csv(conversations_path)
+    messages = pd.read_excel(messages_path)
+    # Validate the messages, Postgres parses them again as JSONB
+    messages["message"] = messages["message"].map(lambda m: json.dumps(json.loads(m)))
+    # Postgres drops the offset of a timestamp without time zone, so do pandas
+    messages["send_at"] = pd.to_datetime(messages["send_at"]).dt.tz_localize(None)
+    return conversations, messages
+
+
+def _message_template(message_class) -> Tuple[str, str]:
+    # The JSON of `message_to_dict` around the content, to build the messages
+    # without serializing a dict each
+    prefix, suffix = json.dumps(message_to_dict(message_class(content="\0"))).split(
+        json.dumps("\0")
+    )
+    return prefix, suffix
+
+
+def generate_synthetic_data(
+    users: int,
+    conversations_per_user: int,
+    messages_per_conversation: int,
+    start: datetime,
+    days: int = 90,
+    seed: Optional[int] = None,
+    chunk_size: int = 10000,
+) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """Generate synthetic conversations and messages, `chunk_size` conversations
+    at a time.
+
+    Each user gets `conversations_per_user` conversations started at a random
+    time within `days` days after `start`. A conversation opens with the
+    welcome message of the chatbot, then alternates questions and answers;
+    their number follows a Poisson distribution of mean
+    `messages_per_conversation` and their lengths a lognormal distribution.
+    """
+    rng = np.random.default_rng(seed)
+    user_uuids = np.array(
+        [str(uuid.UUID(bytes=rng.bytes(16), version=4)) for _ in range(users)]
+    )
+    templates = {
+        "human": _message_template(HumanMessage),
+        "ai": _message_template(AIMessage),
+    }
+    text = " ".join(rng.choice(WORDS, size=20000))
+
+    total = users * conversations_per_user
+    for first in range(0, total, chunk_size):
+        count = min(chunk_size, total - first)
+        conversation_uuids = np.array(
+            [str(uuid.UUID(bytes=rng.bytes(16), version=4)) for _ in range(count)]
+        )
+        owners = user_uuids[np.arange(first, first + count) // conversations_per_user]
+        created_at = pd.Timestamp(start) + pd.to_timedelta(
+            rng.uniform(0, days * 86400, size=count), unit="s"
+        )
+
+        sizes = np.maximum(rng.poisson(messages_per_conversation, size=count), 1)
+        conversation_index = np.repeat(np.arange(count), sizes)
+        # Position of each message in its conversation, the welcome message and
+        # the answers are at the even positions
+        position = np.arange(len(conversation_index)) - np.repeat(
+            np.cumsum(sizes) - sizes, sizes
+        )
+        is_ai = position % 2 == 0
+        lengths = np.where(
+            is_ai,
+            rng.lognormal(*AI_LENGTH, size=len(position)),
+            rng.lognormal(*HUMAN_LENGTH, size=len(position)),
+        ).astype(int).clip(1, len(text) // 2)
+        offsets = rng.integers(0, len(text) // 2, size=len(position))
+        # The messages follow each other by ~30 seconds
+        delays = rng.exponential(30, size=len(position))
+        delays[position == 0] = 0
+        elapsed = pd.Series(delays).groupby(conversation_index).cumsum().to_numpy()
+
+        messages = pd.DataFrame(
+            {
+                "conversation_uuid": conversation_uuids[conversation_index],
+                "message": [
+                    "{}{}{}".format(
+                        templates[kind][0],
+                        json.dumps(text[offset : offset + length]),
+                        templates[kind][1],
+                    )
+                    for kind, offset, length in zip(
+                        np.where(is_ai, "ai", "human"), offsets, lengths
+                    )
+                ],
+                "tokens": np.maximum(lengths // 4, 1),
+                "send_at": created_at[conversation_index]
+                + pd.to_timedelta(elapsed, unit="s"),
+            }
+        )
+        messages["cost"] = messages["tokens"] * np.where(
+            is_ai, AI_TOKEN_COST, HUMAN_TOKEN_COST
+        )
+
+        conversations = pd.DataFrame(
+            {
+                "uuid": conversation_uuids,
+                "name": created_at.strftime("conv_%Y%m%d_%H%M%S"),
+                "user_uuid": owners,
+                "created_by": owners,
+            }
+        )
+        yield conversations, messages
+
+
+def migrate(connection_string: str) -> None:
+    url = make_url(connection_string).set(drivername="postgresql+psycopg")
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        upgrade(connection)
+    engine.dispose()
+
+
+def seed_dummy(connection_string: str) -> None:
+    """Copy the dummy data, unless the database already has conversations."""
+    with psycopg.connect(connection_string) as connection:
+        if connection.execute(
+            sql.SQL("SELECT EXISTS (SELECT 1 FROM {})").format(
+                sql.Identifier(TABLE_CONVERSATIONS)
+            )
+        ).fetchone()[0]:
+            logger.info("The database already has conversations, not seeded")
+            return
+        conversations, messages = load_dummy_data()
+        copy_conversations(connection, conversations, messages)
+    logger.info(
+        "Seeded %d conversations and %d messages", len(conversations), len(messages)
+    )
+
+
+def seed_synthetic(connection_string: str, args) -> None:
+    """Copy synthetic conversations, one transaction per chunk."""
+    started = time.perf_counter()
+    conversations_count = messages_count = 0
+    with psycopg.connect(connection_string, autocommit=True) as connection:
+        for conversations, messages in generate_synthetic_data(
+            users=args.users,
+            conversations_per_user=args.conversations_per_user,
+            messages_per_conversation=args.messages_per_conversation,
+            start=datetime.now() - timedelta(days=args.days),
+            days=args.days,
+            seed=args.seed,
+            chunk_size=args.chunk_size,
+        ):
+            copy_conversations(connection, conversations, messages)
+            conversations_count += len(conversations)
+            messages_count += len(messages)
+            logger.info(
+                "%d conversations, %d messages (%.0f messages/s)",
+                conversations_count,
+                messages_count,
+                messages_count / (time.perf_counter() - started),
+            )
+        connection.execute("ANALYZE")
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("dummy", help="the dummy data of the data folder")
+    synthetic = subparsers.add_parser("synthetic", help="synthetic conversations")
+    synthetic.add_argument("--users", type=int, default=1000)
+    synthetic.add_argument("--conversations-per-user", type=int, default=10)
+    synthetic.add_argument("--messages-per-conversation", type=int, default=20)
+    synthetic.add_argument(
+        "--days", type=int, default=90, help="the period of the conversations"
+    )
+    synthetic.add_argument("--chunk-size", type=int, default=10000)
+    synthetic.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    connection_string = Postgres().postgre_url
+    migrate(connection_string)
+    if args.command == "dummy":
+        seed_dummy(connection_string)
+    else:
+        seed_synthetic(connection_string, args)
+
+
+if __name__ == "__main__":
+    main()
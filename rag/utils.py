@@ -1,12 +1,21 @@
+import json
 import yaml
-from typing import ChainMap
-from chromadb.utils import embedding_functions
-from rag.constants import MODEL_NAME
+from datetime import date, datetime, timedelta
+from typing import ChainMap, Optional, Tuple
+from rag.constants import MODEL_NAME, USAGE_DEFAULT_DAYS, USAGE_MAX_DAYS
 
 
-# sentence_transformer_ef = embedding_functions.SentenceTransformerEmbeddingFunction(
-#     model_name=MODEL_NAME
-# )
+def load_sentence_transformer_ef():
+    """Load the SentenceTransformer embedding function of `MODEL_NAME`.
+
+    Slow, call it once per process. chromadb is imported here so that
+    importing this module does not pay for it.
+    """
+    from chromadb.utils import embedding_functions
+
+    return embedding_functions.SentenceTransformerEmbeddingFunction(
+        model_name=MODEL_NAME
+    )
 
 
 def load_conf(*file_paths: list[str]) -> ChainMap:
@@ -36,3 +45,34 @@ def format_package_data(data: list):
     sum_insured_string = "".join(formatted_strings_sum_insured)
 
     return first_elements, deductible_string, sum_insured_string
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Format a Server-Sent Event whose data is `data` serialized in JSON."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def encode_conversations_cursor(before: Tuple[datetime, int]) -> str:
+    """Encode the `(last_message_at, id)` keyset of a conversations page."""
+    last_message_at, conversation_id = before
+    return f"{last_message_at.isoformat()}_{conversation_id}"
+
+
+def decode_conversations_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Decode a cursor of `encode_conversations_cursor`, raises `ValueError`
+    when it is malformed."""
+    last_message_at, _, conversation_id = cursor.rpartition("_")
+    return datetime.fromisoformat(last_message_at), int(conversation_id)
+
+
+def usage_range(start: Optional[date], end: Optional[date]) -> Tuple[date, date]:
+    """Date range of a usage query, the last `USAGE_DEFAULT_DAYS` days up to
+    `end` (today by default) when `start` is not given. Raises `ValueError` when
+    the range is empty or longer than `USAGE_MAX_DAYS` days."""
+    end = end or date.today()
+    start = start or end - timedelta(days=USAGE_DEFAULT_DAYS - 1)
+    if start > end:
+        raise ValueError("start must not be after end")
+    if (end - start).days + 1 > USAGE_MAX_DAYS:
+        raise ValueError(f"The range must not exceed {USAGE_MAX_DAYS} days")
+    return start, end
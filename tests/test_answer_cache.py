@@ -0,0 +1,142 @@
+import numpy as np
+from langchain_core.messages import AIMessage, HumanMessage
+
+from rag.chatbot.answer_cache import SemanticAnswerCache
+
+
+def embedding(*values):
+    return np.array(values, dtype=np.float32)
+
+
+def test_lookup_hits_above_threshold():
+    cache = SemanticAnswerCache(threshold=0.9)
+    cache.add("p", embedding(1, 0, 0), "question", "answer")
+
+    cached = cache.lookup("p", embedding(1, 0.1, 0))
+
+    assert cached.question == "question"
+    assert cached.answer == "answer"
+    assert cache.stats.hits == 1
+
+
+def test_lookup_misses_below_threshold():
+    cache = SemanticAnswerCache(threshold=0.9)
+    cache.add("p", embedding(1, 0, 0), "question", "answer")
+
+    # cosine similarity of 1 / sqrt(2)
+    assert cache.lookup("p", embedding(1, 1, 0)) is None
+    assert cache.stats.misses == 1
+
+
+def test_lookup_returns_most_similar_answer():
+    cache = SemanticAnswerCache(threshold=0.5)
+    cache.add("p", embedding(1, 1, 0), "far", "far answer")
+    cache.add("p", embedding(1, 0.1, 0), "near", "near answer")
+
+    assert cache.lookup("p", embedding(1, 0, 0)).question == "near"
+
+
+def test_partitions_are_isolated():
+    cache = SemanticAnswerCache(threshold=0.9)
+    cache.add("p1", embedding(1, 0, 0), "question", "answer")
+
+    assert cache.lookup("p2", embedding(1, 0, 0)) is None
+    assert cache.lookup("p1", embedding(1, 0, 0)) is not None
+
+
+def test_expired_answer_is_removed_on_lookup():
+    cache = SemanticAnswerCache(threshold=0.9)
+    cache.add("p", embedding(1, 0, 0), "question", "answer")
+    cache.ttl = 0
+
+    assert cache.lookup("p", embedding(1, 0, 0)) is None
+    assert len(cache) == 0
+    assert cache.stats.expirations == 1
+
+
+def test_least_recently_used_answer_is_evicted_across_partitions():
+    cache = SemanticAnswerCache(threshold=0.9, max_size=2)
+    cache.add("p1", embedding(1, 0, 0), "first", "answer")
+    cache.add("p2", embedding(0, 1, 0), "second", "answer")
+    # A hit makes the first answer the most recently used
+    assert cache.lookup("p1", embedding(1, 0, 0)) is not None
+
+    cache.add("p3", embedding(0, 0, 1), "third", "answer")
+
+    assert len(cache) == 2
+    assert cache.stats.evictions == 1
+    assert cache.lookup("p2", embedding(0, 1, 0)) is None
+    assert cache.lookup("p1", embedding(1, 0, 0)).question == "first"
+    assert cache.lookup("p3", embedding(0, 0, 1)).question == "third"
+
+
+def test_disabled_cache_stores_nothing():
+    cache = SemanticAnswerCache(max_size=0)
+    cache.add("p", embedding(1, 0, 0), "question", "answer")
+
+    assert not cache.enabled
+    assert len(cache) == 0
+    assert not cache.accepts([])
+
+
+def test_accepts_questions_up_to_max_history():
+    cache = SemanticAnswerCache(max_history=1)
+    turn = [HumanMessage(content="question"), AIMessage(content="answer")]
+
+    assert cache.accepts([])
+    assert cache.accepts(turn)
+    assert not cache.accepts(turn * 2)
+    assert cache.stats.skipped == 1
+
+
+def test_answers_are_reloaded_from_disk(tmp_path):
+    path = str(tmp_path / "answers.sqlite")
+    cache = SemanticAnswerCache(threshold=0.9, disk_path=path)
+    cache.add("p", embedding(1, 0, 0), "first", "answer")
+    cache.add("p", embedding(0, 1, 0), "second", "answer")
+    cache.close()
+
+    cache = SemanticAnswerCache(threshold=0.9, disk_path=path)
+
+    assert len(cache) == 2
+    assert cache.lookup("p", embedding(1, 0, 0)).question == "first"
+    # The ids of the new answers follow the rowids of the reloaded ones
+    cache.add("p", embedding(0, 0, 1), "third", "answer")
+    assert len(cache) == 3
+    assert cache.lookup("p", embedding(0, 1, 0)).question == "second"
+    assert cache.lookup("p", embedding(0, 0, 1)).question == "third"
+    cache.close()
+
+
+def test_reload_skips_expired_and_keeps_newest_answers(tmp_path):
+    path = str(tmp_path / "answers.sqlite")
+    cache = SemanticAnswerCache(threshold=0.9, disk_path=path)
+    for index in range(3):
+        vector = np.zeros(3, dtype=np.float32)
+        vector[index] = 1
+        cache.add("p", vector, f"question {index}", "answer")
+    cache.close()
+
+    cache = SemanticAnswerCache(threshold=0.9, max_size=2, disk_path=path)
+    assert len(cache) == 2
+    assert cache.lookup("p", embedding(1, 0, 0)) is None
+    assert cache.lookup("p", embedding(0, 0, 1)).question == "question 2"
+    cache.close()
+
+    cache = SemanticAnswerCache(threshold=0.9, ttl=0, disk_path=path)
+    assert len(cache) == 0
+    cache.close()
+
+
+def test_evicted_and_expired_answers_are_deleted_from_disk(tmp_path):
+    path = str(tmp_path / "answers.sqlite")
+    cache = SemanticAnswerCache(threshold=0.9, max_size=1, disk_path=path)
+    cache.add("p", embedding(1, 0, 0), "first", "answer")
+    cache.add("p", embedding(0, 1, 0), "second", "answer")
+    cache.ttl = 0
+    assert cache.lookup("p", embedding(0, 1, 0)) is None
+    cache.close()
+
+    cache = SemanticAnswerCache(threshold=0.9, disk_path=path)
+    assert len(cache) == 0
+    cache.close()
@@ -0,0 +1,215 @@
+import logging
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from rag.chatbot.llm import LangChainChatbot
+from rag.chatbot.prompt_assembly import (
+    GENERAL_CONDITION_SEPARATOR,
+    TOKENS_PER_MESSAGE,
+    TOKENS_PER_REPLY,
+    PromptAssembler,
+)
+
+
+class ByteEncoding:
+    """One token per byte, so that the tokens of joined texts add up."""
+
+    def encode(self, text, disallowed_special=()):
+        return list(text.encode())
+
+    def decode(self, tokens):
+        return bytes(tokens).decode(errors="ignore")
+
+
+def assembler(budget=None, **limits):
+    """An assembler whose `budget` is on top of the fixed sections of
+    `assemble_prompt`, every section whole when it is `None`."""
+    limits = {
+        "package_documents_tokens": 20,
+        "chat_history_tokens": 20,
+        "general_conditions_tokens": 20,
+        "min_chunk_tokens": 3,
+        **limits,
+    }
+    prompt_assembler = PromptAssembler(ByteEncoding(), max_tokens=0, **limits)
+    if budget is not None:
+        prompt_assembler.max_tokens = prompt_assembler.template_tokens + 4 + budget
+    return prompt_assembler
+
+
+def assemble_prompt(prompt_assembler, documents=(), history=(), general=""):
+    # 4 tokens of fixed sections besides the template
+    return prompt_assembler.assemble(
+        question="q",
+        deductible="d",
+        sum_insured="s",
+        package_documents=list(documents),
+        general_condition=general,
+        chat_history=list(history),
+        summary="x",
+    )
+
+
+def test_documents_are_joined_within_their_limit():
+    # 4 + 1 newline + 5 tokens fill the 10 left to the documents
+    prompt = assemble_prompt(
+        assembler(budget=100, package_documents_tokens=10),
+        documents=["aaaa", "bbbbb"],
+    )
+    assert prompt.package_documents == ["aaaa", "bbbbb"]
+    assert prompt.tokens["package_documents"] == 10
+    assert "package_documents" not in prompt.dropped
+
+
+def test_separator_counts_in_the_document_limit():
+    prompt = assemble_prompt(
+        assembler(budget=100, package_documents_tokens=10),
+        documents=["aaaa", "bbbbbb"],
+    )
+
+    # 5 tokens are left after the first document and its newline
+    assert prompt.package_documents == ["aaaa", "bbbbb"]
+    assert prompt.truncated == ["package_documents"]
+    assert prompt.tokens["package_documents"] == 10
+
+
+def test_document_is_dropped_below_min_chunk_tokens():
+    prompt = assemble_prompt(
+        assembler(budget=100, package_documents_tokens=10, min_chunk_tokens=6),
+        documents=["aaaa", "bbbbbb", "cc"],
+    )
+
+    assert prompt.package_documents == ["aaaa"]
+    assert prompt.dropped == {"package_documents": 2}
+    assert prompt.truncated == []
+    assert prompt.tokens["package_documents"] == 4
+
+
+def test_history_keeps_the_latest_messages():
+    history = [
+        HumanMessage(content="first"),
+        AIMessage(content="one"),
+        HumanMessage(content="second"),
+        AIMessage(content="two"),
+    ]
+    limit = 6 + 3 + 2 * TOKENS_PER_MESSAGE
+
+    prompt = assemble_prompt(
+        assembler(budget=100, chat_history_tokens=limit), history=history
+    )
+
+    assert prompt.chat_history == history[2:]
+    assert prompt.dropped == {"chat_history": 2}
+    # Each message counts its content and the tokens of the chat format
+    assert prompt.tokens["chat_history"] == limit
+
+
+def test_general_conditions_get_what_is_left():
+    prompt = assemble_prompt(
+        assembler(budget=15), documents=["aaaa", "bbbbb"], general="g" * 30
+    )
+
+    assert prompt.tokens["package_documents"] == 10
+    assert prompt.general_condition == "g" * 5
+    assert prompt.truncated == ["general_conditions"]
+    assert prompt.total_tokens == prompt.max_tokens
+
+
+def test_no_budget_keeps_every_section_whole():
+    history = [HumanMessage(content="h" * 50), AIMessage(content="a" * 50)]
+
+    prompt = assemble_prompt(
+        assembler(), documents=["d" * 50, "e" * 50], history=history, general="g" * 50
+    )
+
+    assert prompt.package_documents == ["d" * 50, "e" * 50]
+    assert prompt.chat_history == history
+    assert prompt.general_condition == "g" * 50
+    assert prompt.dropped == {}
+    assert prompt.truncated == []
+    assert prompt.tokens["package_documents"] == 101
+    assert prompt.tokens["chat_history"] == 100 + 2 * TOKENS_PER_MESSAGE
+    assert prompt.tokens["general_conditions"] == 50
+
+
+def test_fixed_sections_over_the_budget_leave_the_other_sections_empty(caplog):
+    prompt_assembler = assembler()
+    prompt_assembler.max_tokens = 10
+
+    with caplog.at_level(logging.WARNING):
+        prompt = assemble_prompt(
+            prompt_assembler,
+            documents=["aaaa"],
+            history=[HumanMessage(content="h")],
+            general="g",
+        )
+
+    assert "over the budget" in caplog.text
+    assert prompt.package_documents == []
+    assert prompt.chat_history == []
+    assert prompt.general_condition == ""
+    assert prompt.tokens["package_documents"] == 0
+    assert prompt.tokens["chat_history"] == 0
+    assert prompt.tokens["general_conditions"] == 0
+
+
+@pytest.mark.parametrize("budget", [0, 5, 12, 25, 40, 70, 200])
+def test_every_section_stays_within_its_limit(budget):
+    prompt_assembler = assembler(budget=budget, min_chunk_tokens=1)
+    history = [
+        HumanMessage(content="question " * 3),
+        AIMessage(content="answer " * 4),
+    ] * 3
+
+    prompt = assemble_prompt(
+        prompt_assembler,
+        documents=["document " * 2, "document " * 4, "document"],
+        history=history,
+        general="general " * 10,
+    )
+
+    for section, limit in prompt_assembler.limits.items():
+        assert 0 <= prompt.tokens[section] <= limit
+    assert prompt.total_tokens <= prompt.max_tokens
+    # The tokens reported are the tokens sent
+    assert prompt.tokens["package_documents"] == prompt_assembler.count(
+        "\n".join(prompt.package_documents)
+    )
+    assert prompt.tokens["chat_history"] == sum(
+        prompt_assembler.count_message(message) for message in prompt.chat_history
+    )
+    assert prompt.tokens["general_conditions"] == prompt_assembler.count(
+        prompt.general_condition
+    )
+    assert prompt.context.endswith(
+        GENERAL_CONDITION_SEPARATOR + prompt.general_condition
+    )
+    assert prompt.breakdown()["total"] == prompt.total_tokens
+
+
+def test_total_tokens_are_the_tokens_of_the_rendered_prompt():
+    prompt_assembler = assembler(budget=40)
+    history = [HumanMessage(content="first"), AIMessage(content="one")] * 3
+
+    prompt = assemble_prompt(
+        prompt_assembler, documents=["aaaa", "bbbbb"], history=history, general="g"
+    )
+    messages = (
+        LangChainChatbot("config.env")
+        .prompt.invoke(
+            {
+                "question": "q",
+                "deductible": "d",
+                "sum_insured": "s",
+                "summary": "x",
+                "context": prompt.context,
+                "chat_history": prompt.chat_history,
+            }
+        )
+        .to_messages()
+    )
+
+    assert prompt.total_tokens == TOKENS_PER_REPLY + sum(
+        prompt_assembler.count_message(message) for message in messages
+    )
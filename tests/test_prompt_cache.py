@@ -0,0 +1,186 @@
+import asyncio
+import sqlite3
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from rag.chatbot.prompt_cache import (
+    MemoryPromptCacheBackend,
+    PromptResponseCache,
+    SqlitePromptCacheBackend,
+)
+from rag.config import PromptCache
+
+
+class FakeLLM:
+    def __init__(self, temperature=0.0, model_name="gpt-4", deployment_name=None):
+        self.temperature = temperature
+        self.model_name = model_name
+        self.deployment_name = deployment_name
+
+
+MESSAGES = [
+    SystemMessage(content="system"),
+    HumanMessage(content="question"),
+    AIMessage(content="answer"),
+    HumanMessage(content="follow-up"),
+]
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        backend = MemoryPromptCacheBackend(max_size=10, ttl=60)
+    else:
+        backend = SqlitePromptCacheBackend(str(tmp_path / "prompts.sqlite"), ttl=60)
+    yield backend
+    backend.close()
+
+
+def test_key_is_stable():
+    copy = [type(message)(content=message.content) for message in MESSAGES]
+
+    assert PromptResponseCache.key(MESSAGES, "gpt-4") == PromptResponseCache.key(
+        copy, "gpt-4"
+    )
+
+
+@pytest.mark.parametrize(
+    "messages, model_name",
+    [
+        (MESSAGES[:-1], "gpt-4"),
+        (MESSAGES[:-1] + [HumanMessage(content="other")], "gpt-4"),
+        # The same content from another role
+        (MESSAGES[:-1] + [AIMessage(content="follow-up")], "gpt-4"),
+        (MESSAGES, "gpt-4o"),
+    ],
+)
+def test_key_changes_with_the_prompt_and_the_model(messages, model_name):
+    assert PromptResponseCache.key(messages, model_name) != PromptResponseCache.key(
+        MESSAGES, "gpt-4"
+    )
+
+
+def test_model_name_is_the_azure_deployment():
+    llm = FakeLLM(model_name="gpt-4", deployment_name="gpt-4-0613")
+
+    assert PromptResponseCache.model_name(llm) == "gpt-4-0613"
+    assert PromptResponseCache.model_name(FakeLLM()) == "gpt-4"
+
+
+def test_backend_round_trip(backend):
+    assert backend.get("key") is None
+
+    backend.set("key", "response")
+    backend.set("key", "new response")
+
+    assert backend.get("key") == "new response"
+    backend.clear()
+    assert backend.get("key") is None
+
+
+@pytest.mark.parametrize("backend_name", ["memory", "sqlite"])
+def test_expired_response_is_not_returned(backend_name, tmp_path):
+    if backend_name == "memory":
+        backend = MemoryPromptCacheBackend(ttl=0)
+    else:
+        backend = SqlitePromptCacheBackend(str(tmp_path / "prompts.sqlite"), ttl=0)
+
+    backend.set("key", "response")
+
+    assert backend.get("key") is None
+    backend.close()
+
+
+def test_sqlite_purges_expired_responses_on_write(tmp_path):
+    path = str(tmp_path / "prompts.sqlite")
+    backend = SqlitePromptCacheBackend(path, ttl=0)
+    backend.set("old", "response")
+    backend.ttl = 60
+
+    backend.set("new", "response")
+    backend.close()
+
+    with sqlite3.connect(path) as connection:
+        keys = connection.execute("SELECT key FROM prompt_responses").fetchall()
+    assert keys == [("new",)]
+
+
+def test_sqlite_is_shared_in_wal_mode(tmp_path):
+    path = str(tmp_path / "prompts.sqlite")
+    first = SqlitePromptCacheBackend(path)
+    second = SqlitePromptCacheBackend(path)
+
+    first.set("key", "response")
+
+    assert second.get("key") == "response"
+    (mode,) = second._connection.execute("PRAGMA journal_mode").fetchone()
+    assert mode == "wal"
+    first.close()
+    second.close()
+
+
+def test_response_is_cached_at_temperature_zero(backend):
+    cache = PromptResponseCache(backend)
+    llm = FakeLLM()
+
+    async def run():
+        missed = await cache.aget(MESSAGES, llm)
+        await cache.aset(MESSAGES, llm, "response")
+        return missed, await cache.aget(MESSAGES, llm)
+
+    assert asyncio.run(run()) == (None, "response")
+    stats = cache.stats.to_dict()
+    assert (stats["hits"], stats["misses"], stats["bypassed"]) == (1, 1, 0)
+    assert cache.stats.sets == 1
+
+
+def test_other_temperatures_are_bypassed_once_per_call(backend):
+    cache = PromptResponseCache(backend)
+    llm = FakeLLM(temperature=0.7)
+
+    async def run():
+        missed = await cache.aget(MESSAGES, llm)
+        await cache.aset(MESSAGES, llm, "response")
+        return missed
+
+    assert asyncio.run(run()) is None
+    assert backend.get(PromptResponseCache.key(MESSAGES, "gpt-4")) is None
+    assert cache.stats.bypassed == 1
+    assert (cache.stats.gets, cache.stats.sets) == (0, 0)
+
+
+def test_cache_without_backend_does_nothing():
+    cache = PromptResponseCache.from_config(PromptCache(BACKEND=""))
+
+    async def run():
+        await cache.aset(MESSAGES, FakeLLM(), "response")
+        return await cache.aget(MESSAGES, FakeLLM())
+
+    assert asyncio.run(run()) is None
+    assert cache.stats.to_dict()["bypassed"] == 0
+    cache.close()
+
+
+def test_backend_errors_are_counted_not_raised(caplog):
+    class FailingBackend(MemoryPromptCacheBackend):
+        def get(self, key):
+            raise RuntimeError("backend down")
+
+        def set(self, key, response):
+            raise RuntimeError("backend down")
+
+    cache = PromptResponseCache(FailingBackend())
+
+    async def run():
+        await cache.aset(MESSAGES, FakeLLM(), "response")
+        return await cache.aget(MESSAGES, FakeLLM())
+
+    assert asyncio.run(run()) is None
+    assert cache.stats.errors == 2
+    assert "backend down" in caplog.text
+
+
+def test_unsupported_backend_is_rejected():
+    with pytest.raises(ValueError):
+        PromptResponseCache.from_config(PromptCache(BACKEND="memcached"))
@@ -0,0 +1,231 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+from sqlalchemy import create_engine, make_url, text
+
+from rag.chatbot import summary_memory
+from rag.chatbot.memory import PostgresChatMessageHistory
+from rag.chatbot.summary_memory import ConversationSummaryBufferMemory
+from rag.constants import TABLE_CONVERSATION_MESSAGES, TABLE_CONVERSATIONS
+from rag.migrations import upgrade
+from rag.pool import close_connection_pools
+
+
+class FakeHistory:
+    """The summary and the messages of a conversation, in memory."""
+
+    def __init__(self, records, summary=None):
+        self.conversation_uuid = str(uuid.uuid4())
+        self.records = records
+        self.summary = summary
+        self.updates = []
+
+    async def aget_summary_buffer(self, max_messages):
+        return self.summary, self.records[-max_messages:]
+
+    async def aupdate_summary(self, summary, message_id):
+        self.updates.append((summary, message_id))
+        return True
+
+
+class FakeLLM:
+    def __init__(self, answer="new summary", started=None, release=None):
+        self.answer = answer
+        self.prompts = []
+        self.started = started
+        self.release = release
+
+    def bind(self, **kwargs):
+        return self
+
+    async def ainvoke(self, messages):
+        self.prompts.append(messages[0].content)
+        if self.started is not None:
+            self.started.set()
+            await self.release.wait()
+        return AIMessage(content=f" {self.answer} ")
+
+
+def turns(count):
+    """`count` questions and answers of one token each, with their ids."""
+    records = []
+    for index in range(count):
+        records.append((2 * index + 1, HumanMessage(content=f"question{index}")))
+        records.append((2 * index + 2, AIMessage(content=f"answer{index}")))
+    return records
+
+
+async def load(history, **kwargs):
+    memory = ConversationSummaryBufferMemory(
+        history, count_tokens=lambda text: len(text.split()), **kwargs
+    )
+    return await memory.aload()
+
+
+def test_no_summary_below_max_tokens():
+    history = FakeHistory(turns(2))
+    llm = FakeLLM()
+
+    async def run():
+        memory = await load(history, max_turns=1, max_tokens=6)
+        return await memory.aupdate_summary(llm, "question", "answer")
+
+    # 4 messages and the new turn take 6 tokens
+    assert asyncio.run(run()) is False
+    assert llm.prompts == []
+    assert history.updates == []
+
+
+def test_summary_above_max_tokens_keeps_the_last_turns():
+    history = FakeHistory(turns(3), summary="old summary")
+    llm = FakeLLM()
+
+    async def run():
+        memory = await load(history, max_turns=2, max_tokens=7)
+        return await memory.aupdate_summary(llm, "question", "answer")
+
+    assert asyncio.run(run()) is True
+    # The new turn and the last stored one are kept, the 2 turns before are
+    # folded into the summary, up to the id of the last of their messages
+    assert history.updates == [("new summary", 4)]
+    assert "old summary" in llm.prompts[0]
+    assert "question1" in llm.prompts[0]
+    assert "question2" not in llm.prompts[0]
+
+
+@pytest.mark.parametrize(
+    "max_turns, summarized",
+    [(1, [1, 2, 3, 4, 5, 6]), (2, [1, 2, 3, 4]), (3, [1, 2]), (4, [])],
+)
+def test_kept_turns_slicing(max_turns, summarized):
+    history = FakeHistory(turns(3))
+
+    async def run():
+        memory = await load(history, max_turns=max_turns, max_tokens=0)
+        return memory._to_summarize("question", "answer")
+
+    assert [message_id for message_id, _ in asyncio.run(run())] == summarized
+
+
+def test_max_turns_must_keep_the_new_turn():
+    with pytest.raises(ValueError):
+        ConversationSummaryBufferMemory(FakeHistory([]), len, max_turns=0)
+
+
+def test_failed_summary_is_logged_and_released(caplog):
+    history = FakeHistory(turns(2))
+
+    class FailingLLM(FakeLLM):
+        async def ainvoke(self, messages):
+            raise RuntimeError("model down")
+
+    async def run():
+        memory = await load(history, max_turns=1, max_tokens=0)
+        return await memory.aupdate_summary(FailingLLM(), "question", "answer")
+
+    assert asyncio.run(run()) is False
+    assert history.conversation_uuid in caplog.text
+    assert history.conversation_uuid not in summary_memory._summarizing
+
+
+def test_one_summary_at_a_time_per_conversation_in_a_worker():
+    history = FakeHistory(turns(2))
+
+    async def run():
+        started, release = asyncio.Event(), asyncio.Event()
+        llm = FakeLLM(started=started, release=release)
+        first = await load(history, max_turns=1, max_tokens=0)
+        second = await load(history, max_turns=1, max_tokens=0)
+        task = asyncio.create_task(first.aupdate_summary(llm, "q", "a"))
+        await started.wait()
+        skipped = await second.aupdate_summary(llm, "q", "a")
+        release.set()
+        return skipped, await task, len(llm.prompts)
+
+    assert asyncio.run(run()) == (False, True, 1)
+
+
+@pytest.fixture(scope="module")
+def conninfo():
+    """An empty Postgres database, migrated, given by TEST_POSTGRES_URL."""
+    url = os.getenv("TEST_POSTGRES_URL")
+    if not url:
+        pytest.skip("TEST_POSTGRES_URL is not set")
+    engine = create_engine(make_url(url).set(drivername="postgresql+psycopg"))
+    with engine.connect() as connection:
+        upgrade(connection)
+    engine.dispose()
+    yield url
+    asyncio.run(close_connection_pools())
+
+
+@pytest.fixture
+def history(conninfo):
+    conversation_uuid = str(uuid.uuid4())
+    engine = create_engine(make_url(conninfo).set(drivername="postgresql+psycopg"))
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                f"INSERT INTO {TABLE_CONVERSATIONS} "
+                "(uuid, name, user_uuid, created_by) "
+                "VALUES (:uuid, 'test', :user_uuid, :user_uuid)"
+            ),
+            {"uuid": conversation_uuid, "user_uuid": str(uuid.uuid4())},
+        )
+    engine.dispose()
+    history = PostgresChatMessageHistory(
+        conversation_uuid=conversation_uuid,
+        connection_string=conninfo,
+        table_name=TABLE_CONVERSATION_MESSAGES,
+        conversations_table=TABLE_CONVERSATIONS,
+    )
+    for index in range(3):
+        history.add_turn(f"question{index}", f"answer{index}", 1, 1, 0.0, 0.0)
+    return history
+
+
+def test_summary_buffer_reads_the_messages_after_the_summary(history):
+    summary, records = history.get_summary_buffer()
+    assert summary is None
+    assert len(records) == 6
+
+    assert history.update_summary("summary", records[3][0])
+
+    summary, after = history.get_summary_buffer()
+    assert summary == "summary"
+    assert after == records[4:]
+    assert [message.content for _, message in after] == ["question2", "answer2"]
+
+
+def test_stale_summary_is_rejected(history):
+    _, records = history.get_summary_buffer()
+
+    assert history.update_summary("newer", records[3][0])
+    # A worker that summarized fewer messages finishes later
+    assert not history.update_summary("older", records[1][0])
+    assert not history.update_summary("same", records[3][0])
+
+    summary, after = history.get_summary_buffer()
+    assert summary == "newer"
+    assert after == records[4:]
+
+
+def test_memory_stores_the_summary_of_a_postgres_conversation(history):
+    _, records = history.get_summary_buffer()
+    memory = ConversationSummaryBufferMemory(
+        history, count_tokens=lambda text: 1, max_turns=1, max_tokens=0
+    )
+
+    async def run():
+        await memory.aload()
+        stored = await memory.aupdate_summary(FakeLLM(), "question", "answer")
+        await close_connection_pools()
+        return stored
+
+    assert asyncio.run(run())
+    summary, after = history.get_summary_buffer()
+    assert summary == "new summary"
+    assert after == []
@@ -0,0 +1,179 @@
+import uuid
+
+import chromadb
+import pandas as pd
+import pytest
+
+from rag.chatbot.retriever import SYNC_IN_PROGRESS, VectorDBCreator
+
+
+def rows(*texts):
+    return pd.DataFrame(
+        [
+            {
+                "index": index,
+                "text": text,
+                "type": "package",
+                "category": "category",
+                "package": "package",
+                "article": f"article {index}",
+                "company": "company",
+                "embeddingd": [float(index), 1.0],
+            }
+            for index, text in enumerate(texts)
+        ]
+    )
+
+
+@pytest.fixture
+def creator(tmp_path):
+    creator = VectorDBCreator(str(tmp_path), f"test_{uuid.uuid4().hex}")
+    creator._chroma_client = chromadb.EphemeralClient()
+    creator._chroma_client.create_collection(
+        creator.collection_name, metadata={"hnsw:space": "cosine"}
+    )
+    return creator
+
+
+def collection(creator):
+    return creator._chroma_client.get_collection(creator.collection_name)
+
+
+def version(creator):
+    return collection(creator).metadata.get("version")
+
+
+def test_first_sync_adds_every_row(creator):
+    report = creator.sync_insurance_data_to_collection(rows("a", "b", "c"))
+
+    assert (report.added, report.updated, report.deleted) == (3, 0, 0)
+    assert collection(creator).get(ids=["1"])["documents"] == ["b"]
+    assert version(creator) is not None
+    assert SYNC_IN_PROGRESS not in collection(creator).metadata
+
+
+def test_sync_keeps_the_distance_of_the_collection(creator):
+    creator.sync_insurance_data_to_collection(rows("a", "b"))
+
+    assert collection(creator).metadata["hnsw:space"] == "cosine"
+
+
+def test_unchanged_rows_are_not_written(creator, monkeypatch):
+    creator.sync_insurance_data_to_collection(rows("a", "b"))
+    first_version = version(creator)
+    writes = []
+    monkeypatch.setattr(VectorDBCreator, "_write", lambda *args: writes.append(args))
+
+    report = creator.sync_insurance_data_to_collection(rows("a", "b"))
+
+    assert report.unchanged == 2
+    assert not report.changed
+    assert writes == []
+    assert version(creator) == first_version
+
+
+def test_changed_row_is_upserted(creator):
+    creator.sync_insurance_data_to_collection(rows("a", "b"))
+    first_version = version(creator)
+
+    report = creator.sync_insurance_data_to_collection(rows("a", "new b"))
+
+    assert (report.added, report.updated, report.unchanged) == (0, 1, 1)
+    assert collection(creator).get(ids=["1"])["documents"] == ["new b"]
+    assert version(creator) != first_version
+
+
+def test_removed_row_is_deleted(creator):
+    creator.sync_insurance_data_to_collection(rows("a", "b", "c"))
+
+    report = creator.sync_insurance_data_to_collection(rows("a", "b"))
+
+    assert report.deleted == 1
+    assert collection(creator).count() == 2
+    assert collection(creator).get(ids=["2"])["ids"] == []
+
+
+def test_rows_are_written_in_batches(creator, monkeypatch):
+    batches = []
+    write = VectorDBCreator._write
+
+    def spy(collection, method, ids, records):
+        batches.append(len(ids))
+        write(collection, method, ids, records)
+
+    monkeypatch.setattr(VectorDBCreator, "_write", staticmethod(spy))
+
+    creator.sync_insurance_data_to_collection(
+        rows("a", "b", "c", "d", "e"), batch_size=2
+    )
+
+    assert batches == [2, 2, 1]
+    assert collection(creator).count() == 5
+
+
+def test_interrupted_sync_resumes_and_bumps_the_version(creator, monkeypatch):
+    creator.sync_insurance_data_to_collection(rows("a", "b", "c"))
+    first_version = version(creator)
+    write = VectorDBCreator._write
+    calls = []
+
+    def fail_second_batch(collection, method, ids, records):
+        calls.append(ids)
+        if len(calls) == 2:
+            raise RuntimeError("interrupted")
+        write(collection, method, ids, records)
+
+    monkeypatch.setattr(VectorDBCreator, "_write", staticmethod(fail_second_batch))
+    with pytest.raises(RuntimeError):
+        creator.sync_insurance_data_to_collection(
+            rows("new a", "new b", "new c"), batch_size=2
+        )
+    assert collection(creator).metadata[SYNC_IN_PROGRESS]
+    assert version(creator) == first_version
+    monkeypatch.setattr(VectorDBCreator, "_write", staticmethod(write))
+
+    report = creator.sync_insurance_data_to_collection(
+        rows("new a", "new b", "new c"), batch_size=2
+    )
+
+    # The first batch was stored with its hashes
+    assert (report.updated, report.unchanged) == (1, 2)
+    assert version(creator) != first_version
+    assert SYNC_IN_PROGRESS not in collection(creator).metadata
+
+
+def test_sync_interrupted_before_the_version_bump_bumps_it(creator, monkeypatch):
+    creator.sync_insurance_data_to_collection(rows("a", "b"))
+    first_version = version(creator)
+
+    def fail(collection):
+        raise RuntimeError("interrupted")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(VectorDBCreator, "bump_collection_version", staticmethod(fail))
+        with pytest.raises(RuntimeError):
+            creator.sync_insurance_data_to_collection(rows("a", "new b"))
+
+    report = creator.sync_insurance_data_to_collection(rows("a", "new b"))
+
+    assert not report.changed
+    assert version(creator) != first_version
+    assert SYNC_IN_PROGRESS not in collection(creator).metadata
+    assert collection(creator).metadata["hnsw:space"] == "cosine"
+
+
+def test_missing_embeddings_are_rejected(creator):
+    df = rows("a", "b", "c")
+    df["embeddingd"] = [[1.0, 0.0], None, [float("nan"), 1.0]]
+
+    with pytest.raises(ValueError, match=r"\[1, 2\]"):
+        creator.sync_insurance_data_to_collection(df)
+    assert collection(creator).count() == 0
+
+
+def test_duplicated_index_is_rejected(creator):
+    df = rows("a", "b")
+    df["index"] = [0, 0]
+
+    with pytest.raises(ValueError, match="Duplicated"):
+        creator.sync_insurance_data_to_collection(df)